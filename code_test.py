@@ -0,0 +1,166 @@
+# %% Code Tests Overview
+
+# Tests that don't need a database (run from the repository root: python -m pytest code_test.py)
+# The experimenter log query modes are checked against a live database by scripts/check_experimenter_log_query_modes.py
+
+# %% Set Up
+
+# %%% Import standard modules
+import os, sys
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+from types import MappingProxyType
+import pytz
+
+# %%% Import custom modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "functions"))
+from catalog_functions import Catalog
+from data_retrieval_functions import stitch_experimenter_log_rows, format_experimenter_log_data, ExperimenterLogRow
+
+logger = logging.getLogger("code_test")
+
+
+# %% Experimenter log: catalog mode vs rows mode
+# The catalog mode stitches the user's own rows (EXPERIMENTER_LOG_USER_ROWS_SQL_STATEMENT) together with the catalog; the result has to serialize
+# exactly like the rows mode's response for the same content (EXPERIMENTER_LOG_SQL_STATEMENT's joins and ordering, rebuilt here from the same content)
+
+GroupRow = namedtuple("GroupRow", ["group_id", "group_name"])
+SubGroupRow = namedtuple("SubGroupRow", ["sub_group_id", "sub_group_name", "group_id"])
+ExperimentPromptRow = namedtuple("ExperimentPromptRow", ["experiment_prompt_id", "sub_group_id", "experiment_prompt", "display_order"])
+ObservationPromptRow = namedtuple("ObservationPromptRow", ["observation_prompt_id", "experiment_prompt_id", "observation_prompt", "display_order"])
+UserRow = namedtuple("UserRow", ["row_type", "first_name", "next_display_datetime", "content_id", "display_datetime", "observation_id", "observation", "observation_formatted"])
+
+NOW = pytz.timezone('UTC').localize(datetime.utcnow())
+
+GROUPS = [GroupRow("g1", "Working \"well\""), GroupRow("g2", "Team's habits")]
+SUB_GROUPS = [SubGroupRow("sg1", "Week 1 -- start", "g1"), SubGroupRow("sg2", "Week 2", "g1"), SubGroupRow("sg3", "Week 1", "g2")]
+SUB_GROUP_ACTION_TEMPLATES = {"t1": "sg1", "t2": "sg2", "t3": "sg3"}
+
+# Experiment prompt ids don't sort in display order (the response lists experiments by experiment_prompt_id), NULL display orders go last,
+# and ep4 has no observation prompts (the rows mode's inner joins leave it out)
+EXPERIMENT_PROMPTS = [
+    ExperimentPromptRow("ep2", "sg1", "Celebrate something.", 1),
+    ExperimentPromptRow("ep1", "sg1", "Seek \"feedback\".", 2),
+    ExperimentPromptRow("ep3", "sg1", "Keep quiet -- for once.", None),
+    ExperimentPromptRow("ep4", "sg1", "No observation prompts.", 3),
+    ExperimentPromptRow("ep5", "sg2", "Say thanks.", 1),
+    ExperimentPromptRow("ep6", "sg3", "Take a walk.", 1)]
+
+OBSERVATION_PROMPTS = [
+    ObservationPromptRow("op2", "ep2", "What's different?", 1),
+    ObservationPromptRow("op1", "ep2", "What makes you \"happier\"?", 2),
+    ObservationPromptRow("op3", "ep1", "What did you learn?", None),
+    ObservationPromptRow("op4", "ep3", "What did you hear?", 1),
+    ObservationPromptRow("op5", "ep5", "Who did you thank?", 1),
+    ObservationPromptRow("op6", "ep6", "Where did you go?", 1)]
+
+# observation_prompt_id -> (observation_id, observation, observation_formatted); observation_formatted is NULL for observations written before it existed
+OBSERVATIONS = {
+    "op1": ("o1", "I'm \"happier\" when it's quiet.", "I&#8217;m &#8220;happier&#8221; when it&#8217;s quiet."),
+    "op3": ("o3", "That I don't -- always -- listen.", None),
+    "op6": ("o6", "Around the block.", "Around the block.")}
+
+# sub_group_action_template_id -> action_datetime (sg3 and sg1 unlocked at the same time; the oldest is 20 days and an hour ago)
+SUB_GROUP_ACTIONS = {"t1": NOW - timedelta(days=20, hours=1), "t2": NOW - timedelta(days=13, hours=1), "t3": NOW - timedelta(days=20, hours=1)}
+
+def make_catalog():
+
+    dict_experiment_prompts_by_sub_group = {}
+    for row in EXPERIMENT_PROMPTS:
+        dict_experiment_prompts_by_sub_group.setdefault(row.sub_group_id, []).append(row)
+
+    dict_observation_prompts_by_experiment_prompt = {}
+    for row in OBSERVATION_PROMPTS:
+        dict_observation_prompts_by_experiment_prompt.setdefault(row.experiment_prompt_id, []).append(row)
+
+    # Prompts ordered by display_order NULLS LAST, id (as load_catalog() selects them)
+    nulls_last = lambda row: (row.display_order is None, row.display_order or 0, row[0])
+
+    return Catalog(
+        version="test",
+        loaded_datetime=datetime.utcnow(),
+        groups=MappingProxyType({row.group_id: row for row in GROUPS}),
+        sub_groups=MappingProxyType({row.sub_group_id: row for row in SUB_GROUPS}),
+        sub_group_id_by_template=MappingProxyType(dict(SUB_GROUP_ACTION_TEMPLATES)),
+        experiment_prompts_by_sub_group=MappingProxyType({key: tuple(sorted(rows, key=nulls_last)) for key, rows in dict_experiment_prompts_by_sub_group.items()}),
+        observation_prompts_by_experiment_prompt=MappingProxyType({key: tuple(sorted(rows, key=nulls_last)) for key, rows in dict_observation_prompts_by_experiment_prompt.items()}))
+
+# What EXPERIMENTER_LOG_USER_ROWS_SQL_STATEMENT returns: 'sub_group_action' rows (with the user's info) first, then 'observation' rows
+def make_user_rows(sub_group_actions):
+
+    if len(sub_group_actions) == 0:
+        return [UserRow("sub_group_action", "Ann", None, None, None, None, None, None)]
+
+    user_rows = [UserRow("sub_group_action", "Ann", None, template_id, action_datetime, None, None, None) for template_id, action_datetime in sub_group_actions.items()]
+    user_rows += [UserRow("observation", None, None, observation_prompt_id, None, *observation) for observation_prompt_id, observation in OBSERVATIONS.items()]
+
+    return user_rows
+
+# What EXPERIMENTER_LOG_SQL_STATEMENT returns for the same content: inner joins down to observation prompts, observations left joined,
+# ORDER BY display_datetime DESC, ep_display_order, op_display_order (NULLS LAST)
+def make_rows_mode_rows(sub_group_actions):
+
+    if len(sub_group_actions) == 0:
+        return [ExperimenterLogRow(first_name="Ann", **{field: None for field in ExperimenterLogRow._fields[1:]})]
+
+    dict_groups = {row.group_id: row for row in GROUPS}
+    dict_sub_groups = {row.sub_group_id: row for row in SUB_GROUPS}
+    rows = []
+
+    for template_id, action_datetime in sub_group_actions.items():
+
+        sub_group = dict_sub_groups[SUB_GROUP_ACTION_TEMPLATES[template_id]]
+        group = dict_groups[sub_group.group_id]
+
+        for experiment_prompt in [row for row in EXPERIMENT_PROMPTS if row.sub_group_id == sub_group.sub_group_id]:
+            for observation_prompt in [row for row in OBSERVATION_PROMPTS if row.experiment_prompt_id == experiment_prompt.experiment_prompt_id]:
+
+                observation_id, observation, observation_formatted = OBSERVATIONS.get(observation_prompt.observation_prompt_id, (None, None, None))
+                rows.append((
+                    (-action_datetime.timestamp(), experiment_prompt.display_order is None, experiment_prompt.display_order or 0, observation_prompt.display_order is None, observation_prompt.display_order or 0),
+                    ExperimenterLogRow(
+                        "Ann", None, action_datetime, group.group_id, group.group_name, sub_group.sub_group_id, sub_group.sub_group_name,
+                        experiment_prompt.experiment_prompt_id, experiment_prompt.experiment_prompt, observation_prompt.observation_prompt_id, observation_prompt.observation_prompt,
+                        observation_id, observation, observation_formatted)))
+
+    return [row for _, row in sorted(rows, key=lambda sort_key_row: sort_key_row[0])]
+
+def format_both_modes(sub_group_actions):
+
+    rows_mode_response = format_experimenter_log_data(rows=make_rows_mode_rows(sub_group_actions), public_user_id="p1", logger=logger)
+    catalog_rows = stitch_experimenter_log_rows(user_rows=make_user_rows(sub_group_actions), catalog=make_catalog(), logger=logger)
+    catalog_mode_response = format_experimenter_log_data(rows=catalog_rows, public_user_id="p1", logger=logger)
+
+    return rows_mode_response, catalog_mode_response
+
+def test_experimenter_log_catalog_mode_matches_rows_mode():
+
+    rows_mode_response, catalog_mode_response = format_both_modes(SUB_GROUP_ACTIONS)
+
+    assert json.dumps(catalog_mode_response) == json.dumps(rows_mode_response)
+
+    # The newest sub_group first; groups in the order they first appear
+    assert [group["group_id"] for group in catalog_mode_response["groups"]] == ["g1", "g2"]
+    assert [sub_group["sub_group_id"] for sub_group in catalog_mode_response["groups"][0]["sub_groups"]] == ["sg2", "sg1"]
+
+    # Experiments within a sub_group are listed by experiment_prompt_id (not display order); ep4 has no observation prompts so neither mode shows it
+    sub_group = catalog_mode_response["groups"][0]["sub_groups"][1]
+    assert [experiment["experiment_prompt_id"] for experiment in sub_group["experiments"]] == ["ep1", "ep2", "ep3"]
+
+    # Observations keep the observation prompts' display order; prompts without an observation have "" (not the "None" placeholder, which is for experiments without observation prompts)
+    assert [observation["observation_prompt_id"] for observation in sub_group["experiments"][1]["observations"]] == ["op2", "op1"]
+    assert sub_group["experiments"][1]["observations"][0]["observation"] == ""
+    assert all(experiment["observations"] != "None" for experiment in sub_group["experiments"])
+
+    # Counted from the oldest displayed sub_group, including today
+    assert catalog_mode_response["days_of_experimenting"] == rows_mode_response["days_of_experimenting"] == 21
+
+def test_experimenter_log_catalog_mode_matches_rows_mode_without_experiments():
+
+    rows_mode_response, catalog_mode_response = format_both_modes({})
+
+    assert json.dumps(catalog_mode_response) == json.dumps(rows_mode_response)
+    assert catalog_mode_response["experiments_to_display"] == "False"
+    assert "days_of_experimenting" not in catalog_mode_response
@@ -4,22 +4,25 @@ from honeybadger import honeybadger
 import traceback
 
 # Custom imports
-from postgresql_db_functions import create_db_connection, execute_sql_return_status_message
+from postgresql_db_functions import execute_sql_return_status_message
+from async_postgresql_db_functions import async_execute_sql_return_status_message
 
-def log_api_call(environment, endpoint, db_connection_parameters, logger):
+LOG_API_CALL_SQL_STATEMENT = "INSERT INTO api_calls (environment, endpoint) VALUES (%(environment)s, %(endpoint)s);"
+
+def log_api_call(environment, endpoint, db_pool, logger):
 
     try:
 
-        # Get database connection
+        # Get database connection from the pool
         db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
-        db_conn = create_db_connection(db_connection_parameters, logger)
+        db_conn = db_pool.getconn() # check out a connection from the shared pool (created once in main.py)
 
         logger.info(f"Logging api call in api_calls table: environment: {environment}, endpoint: {endpoint}")
 
         sql_params = {'environment': environment, 'endpoint': endpoint}
-        sql_statement = "INSERT INTO api_calls (environment, endpoint) VALUES (%(environment)s, %(endpoint)s);"
+        sql_statement = LOG_API_CALL_SQL_STATEMENT
 
-        response = execute_sql_return_status_message(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger)
+        response = execute_sql_return_status_message(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="log_api_call")
 
         logger.info(f"Logging api call in api_calls table: response: {response}")
 
@@ -35,6 +38,33 @@ def log_api_call(environment, endpoint, db_connection_parameters, logger):
 
     finally:
 
-        # Close database connection if it exists    
+        # Return database connection to the pool if we checked one out
         if db_conn is not None:
-            db_conn.close()        
+            db_pool.putconn(db_conn)
+
+
+# Awaitable counterpart of log_api_call() for our async endpoints (doesn't block the event loop while waiting on the database)
+async def async_log_api_call(environment, endpoint, async_db_pool, logger):
+
+    try:
+
+        logger.info(f"Logging api call in api_calls table: environment: {environment}, endpoint: {endpoint}")
+
+        sql_params = {'environment': environment, 'endpoint': endpoint}
+        sql_statement = LOG_API_CALL_SQL_STATEMENT
+
+        # Check out a database connection from the async pool (returned to the pool at the end of the with block)
+        async with async_db_pool.connection() as db_conn:
+            response = await async_execute_sql_return_status_message(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="log_api_call")
+
+        logger.info(f"Logging api call in api_calls table: response: {response}")
+
+    # If there is an error, log it
+    # Note that we are not raising an error because we don't want to interrupt the API call
+    except Exception as e:
+
+        error_class = f"API | async_log_api_call()"
+        error_message = f"Error with async_log_api_call(); Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
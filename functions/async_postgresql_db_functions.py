@@ -0,0 +1,444 @@
+import psycopg # pip install "psycopg[binary]" (psycopg 3; async counterpart of psycopg2)
+from psycopg_pool import AsyncConnectionPool # pip install psycopg-pool
+from psycopg.rows import namedtuple_row
+from psycopg.pq import TransactionStatus
+import pandas as pd
+from honeybadger import honeybadger
+import traceback
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+# Custom imports
+from postgresql_db_functions import prepared_statements, statement_is_prepared_on_connection, record_prepared_statement_prepare, record_prepared_statement_execution, get_one_row
+from read_replica_functions import get_replica_connection_parameters, get_replica_staleness_window_seconds, attach_replica_db_pools
+from query_instrumentation_functions import query_instrumentation_settings, get_statement_identity, statement_is_read_only, record_query_timing, log_slow_query
+
+# %% Async Postgresql Overview
+
+# Async counterparts of the functions in postgresql_db_functions.py for use inside our async FastAPI endpoints
+# The psycopg2 functions block the event loop for the full database round trip (so one slow query stalls every in-flight request on the worker)
+# These functions await the round trip instead, so concurrent requests on one worker overlap their database I/O
+# Documentation: https://www.psycopg.org/psycopg3/docs/advanced/async.html and https://www.psycopg.org/psycopg3/docs/advanced/pool.html
+
+# ## Sample Use (inside an async function)
+
+# # Create the pool once at app startup (main.py does this in a startup event and shares it with every function)
+# async_db_pool = await create_async_db_connection_pool(db_connection_parameters = db_connection_parameters, logger = logger)
+
+# # Check out a connection (returned to the pool at the end of the with block)
+# async with async_db_pool.connection() as db_conn:
+
+#     df = await async_execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
+
+# # Check on the pool (e.g., how long requests are waiting for a connection)
+# async_db_pool.get_stats()
+
+# # Read-only queries can be routed to read replicas (if db_connection_parameters lists any; see read_replica_functions.py)
+# async with async_read_connection(async_db_pool = async_db_pool, routing_key = public_user_id, logger = logger) as db_conn:
+
+#     df = await async_execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
+
+# # Close the pool at app shutdown
+# await async_db_pool.close()
+
+
+# %% Create Async Database Connection Pool
+async def create_async_db_connection_pool(
+        db_connection_parameters,
+        logger,
+        min_connections=1,
+        max_connections=10,
+        checkout_timeout_seconds=30,
+        max_idle_seconds=300):
+
+    try:
+
+        logger.info(f"Creating async database connection pool: min_connections = {min_connections}, max_connections = {max_connections}")
+
+        async_db_pool = await _open_async_db_connection_pool(db_connection_parameters, min_connections, max_connections, checkout_timeout_seconds, max_idle_seconds)
+
+        # Open a pool per read replica (if any are configured; see read_replica_functions.py)
+        # A replica we can't reach at startup is skipped so its reads go to the primary
+        replica_async_db_pools = []
+        for replica_connection_parameters in get_replica_connection_parameters(db_connection_parameters):
+
+            try:
+
+                logger.info(f"Creating async read replica connection pool: host = {replica_connection_parameters['host']}")
+                replica_async_db_pools.append(await _open_async_db_connection_pool(replica_connection_parameters, min_connections, max_connections, checkout_timeout_seconds, max_idle_seconds))
+
+            except Exception as e:
+
+                logger.error(f"create_async_db_connection_pool() skipping read replica {replica_connection_parameters['host']}; Error: {e}")
+
+        attach_replica_db_pools(async_db_pool, replica_async_db_pools, get_replica_staleness_window_seconds(db_connection_parameters))
+
+        return async_db_pool
+
+    except Exception as e:
+
+        error_class = f"API | create_async_db_connection_pool()"
+        error_message = f"create_async_db_connection_pool() failed; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+
+async def _open_async_db_connection_pool(db_connection_parameters, min_connections, max_connections, checkout_timeout_seconds, max_idle_seconds):
+
+    async_db_pool = AsyncConnectionPool(
+        conninfo="",
+        kwargs={
+            "dbname": db_connection_parameters['db'],
+            "host": db_connection_parameters['host'],
+            "user": db_connection_parameters['user'],
+            "password": db_connection_parameters['password'],
+            "port": db_connection_parameters['port']},
+        min_size=min_connections,
+        max_size=max_connections,
+        timeout=checkout_timeout_seconds, # how long async_db_pool.connection() waits for a free connection before raising an error
+        max_idle=max_idle_seconds, # connections (above min_size) idle longer than this are closed
+        check=AsyncConnectionPool.check_connection, # health check connections as they are checked out
+        open=False) # pools can't be opened in the constructor outside of a running event loop
+
+    try:
+        await async_db_pool.open(wait=True) # wait for min_connections to be ready so the first requests don't pay for the connection setup
+    except Exception:
+        await async_db_pool.close() # stop the pool's background workers from retrying
+        raise
+
+    return async_db_pool
+
+
+# %% Query timing (see query_instrumentation_functions.py and _finish_query_timing() in postgresql_db_functions.py)
+async def _async_finish_query_timing(statement_identity, sql_statement, sql_params, start_time, row_count, db_conn, logger):
+
+    # Instrumentation should never break the query it's measuring
+    try:
+
+        elapsed_seconds = time.perf_counter() - start_time
+
+        if record_query_timing(statement_identity, elapsed_seconds, row_count):
+
+            explain_plan = None
+            if query_instrumentation_settings["capture_explain_plans"] and sql_statement is not None and statement_is_read_only(sql_statement):
+                explain_plan = await _async_capture_explain_plan(sql_statement, sql_params, db_conn)
+
+            log_slow_query(statement_identity, sql_statement, sql_params, elapsed_seconds, row_count, explain_plan, logger)
+
+    except Exception as e:
+
+        logger.error(f"_async_finish_query_timing() failed for {statement_identity}; Error: {e}")
+
+# Re-run a (read-only) statement under EXPLAIN (ANALYZE, BUFFERS); db_conn.transaction() rolls back to a savepoint on failure (or rolls back the whole transaction if it opened one)
+async def _async_capture_explain_plan(sql_statement, sql_params, db_conn):
+
+    async with db_conn.transaction(force_rollback=True):
+
+        async with db_conn.cursor() as cursor:
+
+            await cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql_statement, sql_params)
+
+            return "\n".join(row[0] for row in await cursor.fetchall())
+
+
+# %% Transaction scopes (async counterpart of transaction() in postgresql_db_functions.py)
+# Helpers inside async_transaction() skip their commit / rollback and the scope commits once at the end (or rolls back if anything fails)
+# read_only=True runs the statements in autocommit mode instead (no BEGIN / COMMIT round trips)
+
+# Sample Use:
+# async with async_transaction(db_conn = db_conn, logger = logger):
+#     response = await async_execute_prepared_sql_return_status_message(statement_name = "insert_observation", sql_params = sql_params, db_conn = db_conn, logger = logger)
+
+_async_transaction_scopes = weakref.WeakKeyDictionary() # db_conn -> {"read_only": bool} for connections inside async_transaction()
+
+def async_in_transaction(db_conn):
+
+    return db_conn in _async_transaction_scopes
+
+async def _async_commit_unless_in_transaction(db_conn):
+
+    if db_conn not in _async_transaction_scopes:
+        await db_conn.commit()
+
+async def _async_rollback_unless_in_transaction(db_conn):
+
+    if db_conn not in _async_transaction_scopes:
+        await db_conn.rollback()
+
+@asynccontextmanager
+async def async_transaction(db_conn, logger, read_only=False):
+
+    # Nested scopes join the enclosing one (its commit / rollback covers our statements)
+    if db_conn in _async_transaction_scopes:
+
+        if not read_only and _async_transaction_scopes[db_conn]["read_only"]:
+            raise ValueError("async_transaction() can't open a read-write transaction inside a read-only transaction")
+
+        yield db_conn
+        return
+
+    if db_conn.info.transaction_status != TransactionStatus.IDLE:
+        raise ValueError("async_transaction() requires a connection without an open transaction")
+
+    _async_transaction_scopes[db_conn] = {"read_only": read_only}
+
+    try:
+
+        if read_only:
+
+            await db_conn.set_autocommit(True) # client side only; psycopg simply stops sending BEGIN / COMMIT
+
+            try:
+                yield db_conn
+            finally:
+                await db_conn.set_autocommit(False)
+
+        else:
+
+            try:
+
+                yield db_conn
+
+            except BaseException:
+
+                await db_conn.rollback()
+                raise
+
+            # A statement failed but the caller carried on (e.g., a status message helper returned {"status": "failure"}); the transaction can only be rolled back
+            if db_conn.info.transaction_status == TransactionStatus.INERROR:
+                await db_conn.rollback()
+                error_message = "async_transaction() rolled back: a statement inside the transaction failed"
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            await db_conn.commit()
+
+    finally:
+
+        del _async_transaction_scopes[db_conn]
+
+
+# %% Excute a SQL statement, return dataframe
+# We use SQL parameters (rather than inserting user generated info into a SQL statement with f-strings) to prevent SQL injection attacks (https://www.psycopg.org/psycopg3/docs/basic/params.html)
+async def async_execute_sql_return_df(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    try:
+
+        async with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            if sql_params is None:
+
+                await cursor.execute(sql_statement)
+
+            else:
+
+                await cursor.execute(sql_statement, sql_params)
+
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            data = await cursor.fetchall()
+            await _async_finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, len(data), db_conn, logger)
+            col_names = [desc.name for desc in cursor.description]
+            return pd.DataFrame(data, columns=col_names)
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_sql_return_df()"
+        error_message = f"async_execute_sql_return_df() failed; Error: {e}, SQL Statement: {sql_statement}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+# %% Excute a SQL statement, return rows (named tuples; see execute_sql_return_rows() in postgresql_db_functions.py)
+async def async_execute_sql_return_rows(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    try:
+
+        async with db_conn.cursor(row_factory=namedtuple_row) as cursor:
+
+            start_time = time.perf_counter()
+
+            if sql_params is None:
+
+                await cursor.execute(sql_statement)
+
+            else:
+
+                await cursor.execute(sql_statement, sql_params)
+
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            rows = await cursor.fetchall()
+            await _async_finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, len(rows), db_conn, logger)
+
+            return rows
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_sql_return_rows()"
+        error_message = f"async_execute_sql_return_rows() failed; Error: {e}, SQL Statement: {sql_statement}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+async def async_execute_sql_return_one_row(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    rows = await async_execute_sql_return_rows(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name=statement_name)
+    return get_one_row(rows, f"SQL Statement: {sql_statement}")
+
+async def async_execute_sql_return_scalar(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    row = await async_execute_sql_return_one_row(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name=statement_name)
+    return row[0] if row is not None else None
+
+# %% Excute a SQL statement, return status message (no data returned)
+# We use SQL parameters (rather than inserting user generated info into a SQL statement with f-strings) to prevent SQL injection attacks (https://www.psycopg.org/psycopg3/docs/basic/params.html)
+async def async_execute_sql_return_status_message(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    try:
+
+        async with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            if sql_params is None:
+
+                await cursor.execute(sql_statement)
+
+            else:
+
+                await cursor.execute(sql_statement, sql_params)
+            
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            await _async_finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, cursor.rowcount, db_conn, logger)
+
+            return {"status": "success", "status_message": cursor.statusmessage} # the message like 'INSERT 0 1' that is returned after running a postgresql command
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_sql_return_status_message()"
+        error_message = f"async_execute_sql_return_status_message() failed; Error: {e}, SQL Statement: {sql_statement}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        
+        return {"status": "failure", "status_message": f"error: {e}"}
+
+
+# %% Excute a registered prepared statement (see register_prepared_statement() in postgresql_db_functions.py)
+# psycopg 3 prepares statements itself (server-side, once per connection) when we pass prepare=True, so we keep our %(name)s SQL and only track prepares vs. executions in the shared registry
+async def _async_execute_prepared_statement(statement_name, sql_params, cursor, db_conn):
+
+    newly_prepared = not statement_is_prepared_on_connection(statement_name, db_conn)
+
+    await cursor.execute(prepared_statements[statement_name]["sql_statement"], sql_params, prepare=True)
+
+    if newly_prepared:
+        record_prepared_statement_prepare(statement_name, db_conn)
+    record_prepared_statement_execution(statement_name)
+
+# %% Excute a registered prepared statement, return dataframe
+async def async_execute_prepared_sql_return_df(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        async with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            await _async_execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            data = await cursor.fetchall()
+            await _async_finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, len(data), db_conn, logger)
+            col_names = [desc.name for desc in cursor.description]
+            return pd.DataFrame(data, columns=col_names)
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_prepared_sql_return_df()"
+        error_message = f"async_execute_prepared_sql_return_df() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+# %% Excute a registered prepared statement, return rows (named tuples)
+async def async_execute_prepared_sql_return_rows(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        async with db_conn.cursor(row_factory=namedtuple_row) as cursor:
+
+            start_time = time.perf_counter()
+
+            await _async_execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            rows = await cursor.fetchall()
+            await _async_finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, len(rows), db_conn, logger)
+
+            return rows
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_prepared_sql_return_rows()"
+        error_message = f"async_execute_prepared_sql_return_rows() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+async def async_execute_prepared_sql_return_one_row(statement_name, sql_params, db_conn, logger):
+
+    rows = await async_execute_prepared_sql_return_rows(statement_name=statement_name, sql_params=sql_params, db_conn=db_conn, logger=logger)
+    return get_one_row(rows, f"Prepared Statement: {statement_name}")
+
+# %% Excute a registered prepared statement, return status message (no data returned)
+async def async_execute_prepared_sql_return_status_message(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        async with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            await _async_execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            await _async_commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside async_transaction(), which commits once at the end)
+
+            await _async_finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, cursor.rowcount, db_conn, logger)
+
+            return {"status": "success", "status_message": cursor.statusmessage} # the message like 'INSERT 0 1' that is returned after running a postgresql command
+
+    except Exception as e:
+
+        await _async_rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside async_transaction(), the scope rolls back)    
+
+        error_class = f"API | async_execute_prepared_sql_return_status_message()"
+        error_message = f"async_execute_prepared_sql_return_status_message() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        
+        return {"status": "failure", "status_message": f"error: {e}"}
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import uuid
+import traceback
+import psycopg # pip install "psycopg[binary]"
+from honeybadger import honeybadger
+
+# Custom imports
+from postgresql_db_functions import execute_sql_return_status_message
+from async_postgresql_db_functions import async_execute_sql_return_status_message
+from read_replica_functions import record_write, record_write_to_every_key
+
+# %% Cross-Worker Cache Invalidation Overview
+
+# Each uvicorn worker / instance keeps its own in-memory caches (e.g., experimenter_log_cache_functions.py), so a write handled by one worker
+# has to evict the matching entries in every other worker. Write paths publish the keys they changed (e.g., public_user_id, user_id) with pg_notify() inside their transaction,
+# so the notification is only delivered if the write commits, and each worker runs a listener task (LISTEN on a dedicated connection) that evicts the matching entries
+# Notifications sent while a listener is disconnected are lost, so each listener clears every cache when it (re)connects
+# The listener also keeps each notified public_user_id's reads on the primary for the replica staleness window (see read_replica_functions.py), as the writing worker does;
+# otherwise this worker could read the old data from a lagging replica and cache it again
+
+# ## Sample Use
+
+# # Caches register what to evict for each key (at import, like register_prepared_statement())
+# register_cache_invalidation_handler(key_name = "public_user_id", invalidation_handler = invalidate_experimenter_log_cache, clear_handler = clear_experimenter_log_cache)
+
+# # Write paths publish inside their transaction (and invalidate their own worker's caches directly)
+# with transaction(db_conn = db_conn, logger = logger):
+#     ...
+#     publish_cache_invalidation(invalidation_keys = {"public_user_id": public_user_id, "user_id": user_id}, db_conn = db_conn, logger = logger)
+
+# # main.py starts the listener at startup and stops it at shutdown
+# cache_invalidation_listener_task = start_cache_invalidation_listener(db_connection_parameters = db_connection_parameters, logger = logger)
+# await stop_cache_invalidation_listener(cache_invalidation_listener_task)
+
+CACHE_INVALIDATION_CHANNEL = "api_cache_invalidation"
+CACHE_INVALIDATION_RECONNECT_MAX_SECONDS = 60
+
+WORKER_ID = uuid.uuid4().hex # lets a listener skip the notifications its own worker published (it already invalidated its caches directly)
+
+PUBLISH_CACHE_INVALIDATION_SQL_STATEMENT = "SELECT pg_notify(%(channel)s, %(payload)s);"
+
+_cache_invalidation_handlers = {} # key_name -> list of functions taking the key value
+_cache_clear_handlers = [] # functions that clear an entire cache
+_cache_invalidation_metrics = {"published": 0, "received": 0, "received_from_own_worker": 0, "listener_connects": 0, "listener_errors": 0}
+
+
+# %% Register what to evict for a key
+def register_cache_invalidation_handler(key_name, invalidation_handler, clear_handler=None):
+
+    _cache_invalidation_handlers.setdefault(key_name, []).append(invalidation_handler)
+
+    if clear_handler is not None and clear_handler not in _cache_clear_handlers:
+        _cache_clear_handlers.append(clear_handler)
+
+def apply_cache_invalidation(invalidation_keys):
+
+    for key_name, key_value in invalidation_keys.items():
+        for invalidation_handler in _cache_invalidation_handlers.get(key_name, []):
+            invalidation_handler(key_value)
+
+def clear_all_caches():
+
+    for clear_handler in _cache_clear_handlers:
+        clear_handler()
+
+
+# %% Publish the keys a write changed (call inside the write's transaction so it's only delivered on commit)
+def _format_cache_invalidation_params(invalidation_keys):
+
+    return {"channel": CACHE_INVALIDATION_CHANNEL, "payload": json.dumps({"origin_worker_id": WORKER_ID, "keys": invalidation_keys}, default=str)}
+
+def publish_cache_invalidation(invalidation_keys, db_conn, logger):
+
+    response = execute_sql_return_status_message(sql_statement=PUBLISH_CACHE_INVALIDATION_SQL_STATEMENT, sql_params=_format_cache_invalidation_params(invalidation_keys), db_conn=db_conn, logger=logger, statement_name="publish_cache_invalidation")
+
+    if response["status"] == "success":
+        _cache_invalidation_metrics["published"] += 1
+
+    return response
+
+async def async_publish_cache_invalidation(invalidation_keys, db_conn, logger):
+
+    response = await async_execute_sql_return_status_message(sql_statement=PUBLISH_CACHE_INVALIDATION_SQL_STATEMENT, sql_params=_format_cache_invalidation_params(invalidation_keys), db_conn=db_conn, logger=logger, statement_name="publish_cache_invalidation")
+
+    if response["status"] == "success":
+        _cache_invalidation_metrics["published"] += 1
+
+    return response
+
+# Write statements can also publish from inside the statement itself (e.g., a data-modifying CTE that only learns some keys as it runs), saving a round trip:
+# SELECT pg_notify(%(cache_invalidation_channel)s, json_build_object('origin_worker_id', %(cache_invalidation_origin_worker_id)s::text, 'keys', json_build_object('public_user_id', ..., 'user_id', ...))::text)
+# with get_cache_invalidation_sql_params() added to the statement's sql_params, then record_cache_invalidations_published() with the number of notifications it sent
+def get_cache_invalidation_sql_params():
+
+    return {"cache_invalidation_channel": CACHE_INVALIDATION_CHANNEL, "cache_invalidation_origin_worker_id": WORKER_ID}
+
+def record_cache_invalidations_published(count):
+
+    _cache_invalidation_metrics["published"] += count
+
+
+# %% Listen for invalidations from other workers
+async def listen_for_cache_invalidations(db_connection_parameters, logger):
+
+    reconnect_seconds = 1
+
+    while True:
+
+        try:
+
+            # LISTEN needs the primary (notifications aren't replicated) and its own connection (it's held for as long as the worker runs)
+            db_conn = await psycopg.AsyncConnection.connect(
+                dbname=db_connection_parameters['db'],
+                host=db_connection_parameters['host'],
+                user=db_connection_parameters['user'],
+                password=db_connection_parameters['password'],
+                port=db_connection_parameters['port'],
+                autocommit=True)
+
+            async with db_conn:
+
+                await db_conn.execute(f"LISTEN {CACHE_INVALIDATION_CHANNEL};")
+                _cache_invalidation_metrics["listener_connects"] += 1
+                logger.info(f"Listening for cache invalidations on channel: {CACHE_INVALIDATION_CHANNEL}")
+
+                # We may have missed notifications while we weren't listening
+                clear_all_caches()
+                record_write_to_every_key()
+                reconnect_seconds = 1
+
+                async for notification in db_conn.notifies():
+
+                    payload = json.loads(notification.payload)
+                    _cache_invalidation_metrics["received"] += 1
+
+                    if payload["origin_worker_id"] == WORKER_ID:
+                        _cache_invalidation_metrics["received_from_own_worker"] += 1
+                        continue
+
+                    # Another worker's write: read it back from the primary until the replicas have it, then evict what we cached
+                    record_write(routing_key=payload["keys"].get("public_user_id"))
+                    apply_cache_invalidation(payload["keys"])
+
+        except asyncio.CancelledError:
+
+            raise
+
+        except Exception as e:
+
+            _cache_invalidation_metrics["listener_errors"] += 1
+
+            error_class = f"API | listen_for_cache_invalidations()"
+            error_message = f"listen_for_cache_invalidations() failed, reconnecting in {reconnect_seconds} seconds; Error: {e}"
+            logger.error(error_message)
+            logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+            honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        # Back off before reconnecting (the server closed the connection, or we couldn't connect)
+        await asyncio.sleep(reconnect_seconds)
+        reconnect_seconds = min(reconnect_seconds * 2, CACHE_INVALIDATION_RECONNECT_MAX_SECONDS)
+
+def start_cache_invalidation_listener(db_connection_parameters, logger):
+
+    return asyncio.create_task(listen_for_cache_invalidations(db_connection_parameters=db_connection_parameters, logger=logger))
+
+async def stop_cache_invalidation_listener(cache_invalidation_listener_task):
+
+    cache_invalidation_listener_task.cancel()
+
+    try:
+        await cache_invalidation_listener_task
+    except asyncio.CancelledError:
+        pass
+
+
+# %% Report on invalidations
+def get_cache_invalidation_metrics():
+
+    return dict(_cache_invalidation_metrics)
@@ -0,0 +1,216 @@
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+from datetime import datetime
+import traceback
+from honeybadger import honeybadger
+
+# Custom imports
+from postgresql_db_functions import execute_sql_return_rows, execute_sql_return_one_row, transaction
+from text_rendering_functions import render_catalog_text
+
+# %% Catalog Overview
+
+# groups, sub_groups, sub_group_action_templates, experiment_prompts, and observation_prompts are authored content that changes rarely,
+# so rather than joining them into every experimenter log query (and re-selecting experiment prompts on every schedule_messages() run)
+# we keep them in an in-memory catalog and queries only fetch the user's own rows (sub_group_actions, observations), stitching in catalog content by id
+# The catalog is loaded at startup and a background thread checks a cheap change token (row count + max xmin of each table) and reloads the catalog when it changes
+# Each load builds a new Catalog that is swapped in whole and never modified (readers always see one consistent version)
+
+# ## Sample Use
+
+# # Load at startup and refresh in the background (main.py does this)
+# start_catalog_refresher(db_pool = db_pool, logger = logger, refresh_interval_seconds = 60)
+
+# # Read content by id
+# catalog = get_catalog()
+# sub_group_id = catalog.sub_group_id_by_template[sub_group_action_template_id]
+# catalog.sub_groups[sub_group_id].sub_group_name
+# [experiment_prompt.experiment_prompt for experiment_prompt in catalog.experiment_prompts_by_sub_group[sub_group_id]] # ordered by display_order
+
+# # Content we don't know about yet (e.g., authored since the last refresh): wake the refresher
+# request_catalog_refresh()
+
+Catalog = namedtuple("Catalog", [
+    "version", # change token the catalog was loaded at
+    "loaded_datetime",
+    "groups", # group_id -> row (group_id, group_name)
+    "sub_groups", # sub_group_id -> row (sub_group_id, sub_group_name, group_id)
+    "sub_group_id_by_template", # sub_group_action_template_id -> sub_group_id
+    "experiment_prompts_by_sub_group", # sub_group_id -> tuple of rows (experiment_prompt_id, experiment_prompt, display_order) ordered by display_order
+    "observation_prompts_by_experiment_prompt"]) # experiment_prompt_id -> tuple of rows (observation_prompt_id, observation_prompt, display_order) ordered by display_order
+
+# Change token: any insert / update / delete changes a table's row count or max xmin
+CATALOG_VERSION_SQL_STATEMENT = """
+SELECT
+	(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM groups) AS groups_version,
+	(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM sub_groups) AS sub_groups_version,
+	(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM sub_group_action_templates) AS sub_group_action_templates_version,
+	(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM experiment_prompts) AS experiment_prompts_version,
+	(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM observation_prompts) AS observation_prompts_version;"""
+
+CATALOG_SQL_STATEMENTS = {
+    "groups": "SELECT id AS group_id, group_name FROM groups;",
+    "sub_groups": "SELECT id AS sub_group_id, sub_group_name, group_id FROM sub_groups;",
+    "sub_group_action_templates": "SELECT id AS sub_group_action_template_id, sub_group_id FROM sub_group_action_templates;",
+    "experiment_prompts": "SELECT id AS experiment_prompt_id, sub_group_id, experiment_prompt, display_order FROM experiment_prompts ORDER BY display_order NULLS LAST, id;",
+    "observation_prompts": "SELECT id AS observation_prompt_id, experiment_prompt_id, observation_prompt, display_order FROM observation_prompts ORDER BY display_order NULLS LAST, id;"}
+
+_catalog = None
+_catalog_refresh_requested = threading.Event()
+_catalog_refresher_stopped = threading.Event()
+_catalog_load_lock = threading.Lock()
+_catalog_metrics = {"loads": 0, "version_checks": 0, "refreshes_requested": 0, "load_failures": 0}
+
+
+# %% Read the catalog (None until the first load succeeds)
+def get_catalog():
+
+    return _catalog
+
+
+# %% Load the catalog
+def get_catalog_version(db_conn, logger):
+
+    row = execute_sql_return_one_row(sql_statement=CATALOG_VERSION_SQL_STATEMENT, sql_params=None, db_conn=db_conn, logger=logger, statement_name="catalog_version")
+
+    return "|".join(row)
+
+def load_catalog(db_conn, logger):
+
+    global _catalog
+
+    with _catalog_load_lock:
+
+        with transaction(db_conn=db_conn, logger=logger, read_only=True):
+
+            version = get_catalog_version(db_conn=db_conn, logger=logger) # taken before the content, so a change while we load is picked up by the next check
+            dict_rows = {table_name: execute_sql_return_rows(sql_statement=sql_statement, sql_params=None, db_conn=db_conn, logger=logger, statement_name=f"catalog_{table_name}") for table_name, sql_statement in CATALOG_SQL_STATEMENTS.items()}
+
+        # Group prompts by their parent (rows are already ordered by display_order)
+        dict_experiment_prompts_by_sub_group = {}
+        for row in dict_rows["experiment_prompts"]:
+            dict_experiment_prompts_by_sub_group.setdefault(row.sub_group_id, []).append(row)
+
+        dict_observation_prompts_by_experiment_prompt = {}
+        for row in dict_rows["observation_prompts"]:
+            dict_observation_prompts_by_experiment_prompt.setdefault(row.experiment_prompt_id, []).append(row)
+
+        _catalog = Catalog(
+            version=version,
+            loaded_datetime=datetime.utcnow(),
+            groups=MappingProxyType({row.group_id: row for row in dict_rows["groups"]}),
+            sub_groups=MappingProxyType({row.sub_group_id: row for row in dict_rows["sub_groups"]}),
+            sub_group_id_by_template=MappingProxyType({row.sub_group_action_template_id: row.sub_group_id for row in dict_rows["sub_group_action_templates"]}),
+            experiment_prompts_by_sub_group=MappingProxyType({key: tuple(rows) for key, rows in dict_experiment_prompts_by_sub_group.items()}),
+            observation_prompts_by_experiment_prompt=MappingProxyType({key: tuple(rows) for key, rows in dict_observation_prompts_by_experiment_prompt.items()}))
+
+        # Render the text we display once now, rather than on every request (see text_rendering_functions.py); drop the previous catalog's renderings first
+        render_catalog_text.cache_clear()
+        for table_name, text_column in [("groups", "group_name"), ("sub_groups", "sub_group_name"), ("experiment_prompts", "experiment_prompt"), ("observation_prompts", "observation_prompt")]:
+            for row in dict_rows[table_name]:
+                render_catalog_text(getattr(row, text_column))
+
+        _catalog_metrics["loads"] += 1
+        logger.info(f"Loaded catalog version {version}: {', '.join(f'{len(rows)} {table_name}' for table_name, rows in dict_rows.items())}")
+
+        return _catalog
+
+# Reload the catalog only if its change token moved (one cheap query otherwise)
+def refresh_catalog_if_changed(db_conn, logger):
+
+    _catalog_metrics["version_checks"] += 1
+
+    if _catalog is not None:
+
+        with transaction(db_conn=db_conn, logger=logger, read_only=True):
+            version = get_catalog_version(db_conn=db_conn, logger=logger)
+
+        if version == _catalog.version:
+            return _catalog
+
+    return load_catalog(db_conn=db_conn, logger=logger)
+
+
+# %% Refresh the catalog in the background
+def request_catalog_refresh():
+
+    _catalog_metrics["refreshes_requested"] += 1
+    _catalog_refresh_requested.set()
+
+def _refresh_catalog_periodically(db_pool, logger, refresh_interval_seconds):
+
+    while not _catalog_refresher_stopped.is_set():
+
+        # Wake up every refresh_interval_seconds, or as soon as someone requests a refresh
+        _catalog_refresh_requested.wait(refresh_interval_seconds)
+        _catalog_refresh_requested.clear()
+
+        if _catalog_refresher_stopped.is_set():
+            break
+
+        db_conn = None
+
+        try:
+
+            db_conn = db_pool.getconn()
+            refresh_catalog_if_changed(db_conn=db_conn, logger=logger)
+
+        except Exception as e:
+
+            _catalog_metrics["load_failures"] += 1
+
+            error_class = f"API | _refresh_catalog_periodically()"
+            error_message = f"Catalog refresh failed (keeping catalog version {_catalog.version if _catalog is not None else None}); Error: {e}"
+            logger.error(error_message)
+            logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+            honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        finally:
+
+            if db_conn is not None:
+                db_pool.putconn(db_conn)
+
+# Load the catalog now (so it's ready for the first request) and keep it fresh on a daemon thread
+# If the first load fails, queries fall back to joining the content tables until a background refresh succeeds
+def start_catalog_refresher(db_pool, logger, refresh_interval_seconds=60):
+
+    db_conn = None
+
+    try:
+
+        db_conn = db_pool.getconn()
+        load_catalog(db_conn=db_conn, logger=logger)
+
+    except Exception as e:
+
+        _catalog_metrics["load_failures"] += 1
+
+        error_class = f"API | start_catalog_refresher()"
+        error_message = f"Initial catalog load failed; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+    finally:
+
+        if db_conn is not None:
+            db_pool.putconn(db_conn)
+
+    refresher_thread = threading.Thread(target=_refresh_catalog_periodically, args=(db_pool, logger, refresh_interval_seconds), name="catalog-refresher", daemon=True)
+    refresher_thread.start()
+
+def stop_catalog_refresher():
+
+    _catalog_refresher_stopped.set()
+    _catalog_refresh_requested.set() # wake the thread so it sees it's been stopped
+
+
+# %% Report on the catalog
+def get_catalog_metrics():
+
+    metrics = dict(_catalog_metrics)
+    metrics["version"] = _catalog.version if _catalog is not None else None
+    metrics["loaded_datetime"] = _catalog.loaded_datetime if _catalog is not None else None
+
+    return metrics
@@ -1,49 +1,49 @@
-import pandas as pd
-import numpy as np
-from time import sleep
 from datetime import datetime
 import pytz
 from honeybadger import honeybadger
 import traceback
-import smartypants
+import json
+import hashlib
+import base64
+import asyncio
+from collections import namedtuple
 
 # Custom imports
-from postgresql_db_functions import create_db_connection, execute_sql_return_df
+from catalog_functions import get_catalog, request_catalog_refresh
+from text_rendering_functions import render_catalog_text, render_stored_text
+from json_response_processing_functions import etag_matches
+from throttle_functions import throttle_failure, async_throttle_failure, record_throttle_success, async_record_throttle_success, THROTTLE_POLICIES
+from postgresql_db_functions import register_prepared_statement, execute_prepared_sql_return_rows, transaction
+from async_postgresql_db_functions import async_execute_prepared_sql_return_rows, async_transaction
+from read_replica_functions import getconn_for_read, async_read_connection
+from experimenter_log_cache_functions import get_cached_experimenter_log, get_cached_experimenter_log_etag, get_experimenter_log_cache_generation, cache_experimenter_log
+from user_lookup_cache_functions import cached_user_lookup_is_inactive
+from data_submission_functions import retrieve_user_id_from_public_user_id, async_retrieve_user_id_from_public_user_id
 
 
-def get_experimenter_log_data(public_user_id, db_connection_parameters, logger):
-
-    try:
-
-        # Get database connection
-        db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
-        db_conn = create_db_connection(db_connection_parameters, logger)
-
-        ## Retrieve experimenter log data from database
-        logger.info("Retrieve experimenter log data from database")
-
-        # Define sql query (use parameters rather than f-string to avoid SQL injection)
-        sql_params = {'public_user_id': public_user_id}
-        sql_statement = """
-/*
-Case 1: Public_user_id is not found / not active -- returns no rows
-Case 2: User has no experiments -- returns one row with just user's info
-Case 3: User has experiments -- returns rows for every experiment / observation prompt combination
-Case 4: User has experiments and has observations -- returns rows for every experiment / observation prompt combination with observation column filled out
-*/
-
+# %% Experimenter log SQL (shared by get_experimenter_log_data() and async_get_experimenter_log_data())
+# We use SQL parameters (rather than f-strings) to avoid SQL injection; sql_params = {'public_user_id': public_user_id}
+# Three query modes (see EXPERIMENTER_LOG_QUERY_MODES): "rows" returns one flat row per experiment x observation prompt that we nest in Python; "json" has Postgres return the nested document;
+# "catalog" only returns the user's own rows (sub_group_actions, observations) and stitches in groups / prompts from the in-memory catalog (see catalog_functions.py)
+# CTE shared by all modes
+EXPERIMENTER_LOG_IDENTIFIED_USER_CTE_SQL = """
 -- User info associated with the public_user_id
 WITH identified_user AS
 (SELECT
  	u.id AS user_id,
-	u.first_name
+	u.first_name,
+	(SELECT MIN(sga.action_datetime) FROM sub_group_actions sga WHERE sga.user_id = u.id AND sga.status = 'display_after_action_datetime' AND sga.action_datetime >= NOW() AT TIME ZONE 'UTC') AS next_display_datetime -- when the next experiments unlock (cached responses expire then; see experimenter_log_cache_functions.py)
 FROM 
 	user_lookups ul, 
 	users u
 WHERE
 	ul.public_user_id = %(public_user_id)s AND -- restrict to the public_user_id
     ul.status = 'active' AND -- ensure the public_user_id is active 
-    u.id = ul.user_id), -- restrict to the user associated with the public_user_id
+    u.id = ul.user_id -- restrict to the user associated with the public_user_id
+)"""
+
+# CTEs shared by the rows and json modes (and the batch query, which identifies several users)
+EXPERIMENTER_LOG_CONTENT_CTES_SQL = """,
 
 -- All of the experiments, etc. assigned to the user
 assigned_experiments AS (
@@ -81,9 +81,11 @@ WHERE
 -- All of the observations made by the user
 user_observations AS (
 SELECT 
+	o.user_id,
 	o.observation_prompt_id,
 	o.id AS observation_id,
-	o.observation
+	o.observation,
+	o.observation_formatted -- rendered when the observation was written (see text_rendering_functions.py)
 FROM
 	assigned_experiments ae,
 	observations o
@@ -91,12 +93,24 @@ WHERE
 	o.observation_prompt_id = ae.observation_prompt_id AND -- restrict to observations for relevant observation prompts
 	o.user_id = ae.user_id AND -- restrict to observations by the user
 	o.status = 'active' -- restrict to active observations
-)
+)"""
+
+EXPERIMENTER_LOG_CTES_SQL = EXPERIMENTER_LOG_IDENTIFIED_USER_CTE_SQL + EXPERIMENTER_LOG_CONTENT_CTES_SQL
+
+EXPERIMENTER_LOG_SQL_STATEMENT = """
+/*
+Case 1: Public_user_id is not found / not active -- returns no rows
+Case 2: User has no experiments -- returns one row with just user's info
+Case 3: User has experiments -- returns rows for every experiment / observation prompt combination
+Case 4: User has experiments and has observations -- returns rows for every experiment / observation prompt combination with observation column filled out
+*/
+""" + EXPERIMENTER_LOG_CTES_SQL + """
 
 --Combine user info, experiment info, and observations
 --Note: we do left joins so that we return data if there is an identified user but no experiments (experiments, but no observations)
 SELECT
 	iu.first_name, 
+	iu.next_display_datetime,
 	ae.display_datetime,
 	ae.group_id,
  	ae.group_name, 
@@ -107,7 +121,8 @@ SELECT
 	ae.observation_prompt_id,
  	ae.observation_prompt, 
 	uo.observation_id,
-	uo.observation
+	uo.observation,
+	uo.observation_formatted
 FROM identified_user iu
 LEFT JOIN assigned_experiments ae ON iu.user_id = ae.user_id
 LEFT JOIN user_observations uo ON ae.observation_prompt_id = uo.observation_prompt_id
@@ -116,130 +131,1387 @@ ORDER BY
 	ep_display_order,
 	op_display_order;"""
 
-        # Pull data from database
-        df = execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
-        logger.info("Finished retrieving experimenter log data from database")
+# Server-side JSON mode: Postgres returns one row per user with the finished, nested groups document (see format_experimenter_log_json_data())
+# Groups / sub_groups are listed in the order they first appear in the rows mode ordering (display_datetime DESC, ep_display_order, op_display_order), take their name / display date from that first row,
+# and experiments are listed by experiment_prompt_id, so the response matches the rows mode exactly (json, not jsonb, keeps the keys in order)
+EXPERIMENTER_LOG_JSON_SQL_STATEMENT = """
+/*
+Case 1: Public_user_id is not found / not active -- returns no rows
+Case 2: User has no experiments -- returns one row with groups = NULL
+Case 3: User has experiments (and potentially observations) -- returns one row with the nested groups document
+*/
+""" + EXPERIMENTER_LOG_CTES_SQL + """,
 
-        ## CASE 1: Public_user_id was not found / not active
-        # Test: No rows in df
-        # Outcome: Return error 
-        if len(df) == 0:
+-- The rows mode rows (see EXPERIMENTER_LOG_SQL_STATEMENT), numbered in the same order
+ordered_rows AS (
+SELECT
+	ae.group_id,
+	ae.group_name,
+	ae.sub_group_id,
+	ae.sub_group_name,
+	ae.experiment_prompt_id,
+	ae.experiment_prompt,
+	ae.observation_prompt_id,
+	ae.observation_prompt,
+	ae.display_datetime,
+	uo.observation,
+	uo.observation_formatted,
+	ROW_NUMBER() OVER (ORDER BY ae.display_datetime DESC, ae.ep_display_order, ae.op_display_order) AS row_order
+FROM assigned_experiments ae
+LEFT JOIN user_observations uo ON ae.observation_prompt_id = uo.observation_prompt_id
+),
 
-            info_message = f"user_lookups table did not contain active public_user_id of '{public_user_id}'"
-            logger.info(info_message)
+-- Flag the first row of each group / sub_group (which sets their order, name, and display date)
+first_rows AS (
+SELECT
+	r.*,
+	MIN(r.row_order) OVER (PARTITION BY r.group_id) AS group_first_row_order,
+	MIN(r.row_order) OVER (PARTITION BY r.group_id, r.sub_group_id) AS sub_group_first_row_order
+FROM ordered_rows r
+),
 
-            sleep(3) # Sleep to prevent brute force attacks
+-- One document per experiment in each sub_group (observations in row order)
+experiment_documents AS (
+SELECT
+	fr.sub_group_first_row_order,
+	fr.experiment_prompt_id,
+	fr.experiment_prompt,
+	json_build_object(
+		'experiment_prompt_id', fr.experiment_prompt_id,
+		'experiment_prompt', COALESCE(fr.experiment_prompt, ''),
+		'observations', json_agg(json_build_object(
+			'observation_prompt_id', fr.observation_prompt_id,
+			'observation_prompt', COALESCE(fr.observation_prompt, ''),
+			'observation', COALESCE(fr.observation, ''),
+			'observation_formatted', fr.observation_formatted) ORDER BY fr.row_order)) AS experiment_document
+FROM first_rows fr
+GROUP BY fr.sub_group_first_row_order, fr.experiment_prompt_id, fr.experiment_prompt
+),
 
-            return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+-- One document per sub_group (display date is formatted in Python, see format_experimenter_log_json_data())
+sub_group_documents AS (
+SELECT
+	fr.group_first_row_order,
+	fr.row_order AS sub_group_first_row_order,
+	json_build_object(
+		'sub_group_id', fr.sub_group_id,
+		'sub_group_name', COALESCE(fr.sub_group_name, ''),
+		'sub_group_display_date', to_char(fr.display_datetime, 'YYYY-MM-DD'),
+		'experiments', (SELECT json_agg(ed.experiment_document ORDER BY ed.experiment_prompt_id, ed.experiment_prompt) FROM experiment_documents ed WHERE ed.sub_group_first_row_order = fr.row_order)) AS sub_group_document
+FROM first_rows fr
+WHERE fr.row_order = fr.sub_group_first_row_order
+),
 
-        ## Initialize response dictionary
-        dict_response = {}
-        dict_response["public_user_id"] = public_user_id
-        dict_response["first_name"] = df.first_name.get(0)
-        dict_response['experiments_to_display'] = "True"
-        dict_response['status'] = "success"
+-- One document per group
+group_documents AS (
+SELECT
+	fr.row_order AS group_first_row_order,
+	json_build_object(
+		'group_id', fr.group_id,
+		'group_name', COALESCE(fr.group_name, ''),
+		'sub_groups', (SELECT json_agg(sgd.sub_group_document ORDER BY sgd.sub_group_first_row_order) FROM sub_group_documents sgd WHERE sgd.group_first_row_order = fr.row_order)) AS group_document
+FROM first_rows fr
+WHERE fr.row_order = fr.group_first_row_order
+)
 
-        ## CASE 2: User exists but has no assigned group
-        # Test:  df has just one row with just user's info (e.g., group = None)
-        # Outcome: Return early with experiments_to_display = False 
-        if len(df) == 1 and df.group_name.get(0) == None:
-            
-            dict_response['experiments_to_display'] = "False"
-            logger.info(f"No experiments to display for public_user_id: {public_user_id}")
+SELECT
+	iu.first_name,
+	iu.next_display_datetime,
+	(SELECT MIN(display_datetime) FROM ordered_rows) AS first_display_datetime,
+	(SELECT json_agg(gd.group_document ORDER BY gd.group_first_row_order) FROM group_documents gd) AS groups
+FROM identified_user iu;"""
 
-            return dict_response
+# Catalog mode: only the user's own rows, tagged by row_type; content_id is the sub_group_action_template_id / observation_prompt_id that we look up in the catalog (see stitch_experimenter_log_rows())
+EXPERIMENTER_LOG_USER_ROWS_SQL_STATEMENT = """
+/*
+Case 1: Public_user_id is not found / not active -- returns no rows
+Case 2: User has no experiments -- returns one 'sub_group_action' row with just user's info
+Case 3: User has experiments -- returns one 'sub_group_action' row per displayed sub_group_action, plus one 'observation' row per active observation
+*/
+""" + EXPERIMENTER_LOG_IDENTIFIED_USER_CTE_SQL + """
 
-        ## Format data
-        logger.info("Formatting data")
+SELECT
+	'sub_group_action' AS row_type,
+	iu.first_name,
+	iu.next_display_datetime,
+	sga.sub_group_action_template_id AS content_id,
+	sga.action_datetime AS display_datetime,
+	NULL AS observation_id,
+	NULL AS observation,
+	NULL AS observation_formatted
+FROM identified_user iu
+LEFT JOIN sub_group_actions sga ON
+	sga.user_id = iu.user_id AND sga.status = 'display_after_action_datetime' AND -- restrict to just the sub_group_actions for the user that are flagged to be displayed
+	sga.action_datetime < NOW() AT TIME ZONE 'UTC' -- restrict to just the sub_group_actions where the action_datetime has already passed (and thus they should be displayed)
 
-        # Convert datetime strings to datetime objects
-        date_vars = ["display_datetime"]
-        for date_var in date_vars:
-            exec(f"df['{date_var}'] = pd.to_datetime(df['{date_var}'], infer_datetime_format=True)")
+UNION ALL
 
-        # Replace missing values (NaN) with "" as NaN is not acceptable in final JSON output
-        df.replace({np.nan: ""}, inplace = True)
+SELECT
+	'observation' AS row_type,
+	NULL AS first_name,
+	NULL AS next_display_datetime,
+	o.observation_prompt_id AS content_id,
+	NULL AS display_datetime,
+	o.id AS observation_id,
+	o.observation,
+	o.observation_formatted
+FROM
+	identified_user iu,
+	observations o
+WHERE
+	o.user_id = iu.user_id AND -- restrict to observations by the user
+	o.status = 'active' -- restrict to active observations
 
-        # Convert "dumb" quotes to HTML "curly" quotes
-        text_vars = ["group_name", "sub_group_name", "experiment_prompt", "observation_prompt", "observation"]
-        for text_var in text_vars:
-            df[text_var] = df[text_var].apply(lambda x: smartypants.smartypants(x))
+ORDER BY row_type DESC; -- 'sub_group_action' rows (with the user's info) first"""
 
-        ## CASE 3: User exists with assigned experiments (and potentially observations)
-        # Outcome: Return dict_response with all of the experiments and observations for the user
+# Prepared once per pooled connection rather than parsed / planned on every page view
+register_prepared_statement(statement_name="experimenter_log", sql_statement=EXPERIMENTER_LOG_SQL_STATEMENT)
+register_prepared_statement(statement_name="experimenter_log_json", sql_statement=EXPERIMENTER_LOG_JSON_SQL_STATEMENT)
+register_prepared_statement(statement_name="experimenter_log_user_rows", sql_statement=EXPERIMENTER_LOG_USER_ROWS_SQL_STATEMENT)
 
-        ## Update response dictionary
-        dict_response["days_of_experimenting"] = (pytz.timezone('UTC').localize(datetime.utcnow()) - df['display_datetime'].min()).days + 1 # Add 1 to include today, take max in case there are no assigned dates
-        
-        ## Prepare dict_response with all of the experiments and observations for the user
-
-        # Initialize helper array
-        array_groups = []
-
-        # Collect data for each experiment group
-        for group_id in df.group_id.unique():
-
-            df_group = df.query("group_id == '" + group_id  + "'").reset_index()
-
-            array_sub_groups = []
-
-            # Assemble for each experiment in each experiment sub group
-            for sub_group_id in df_group.sub_group_id.unique():
-                
-                df_sub_group = df_group.query("sub_group_id == '" + sub_group_id  + "'").reset_index()
-
-                # Generate data for all associated experiments with this experiment sub group
-                # Methodology: https://stackoverflow.com/questions/55004985/convert-pandas-dataframe-to-json-with-columns-as-key
-                # Output Sample: [{'experiment_id': 'e1', 'experiment': 'Celebrate something.', 'data': [{'observation_prompt': 'What makes you happier at work?', 'observation': 'My observation for o1.'}, {'observation_prompt': 'What makes you successful at work?', 'observation': 'My observation for o7.'}]}, {'experiment_id': 'e2', 'experiment': 'Seek feedback from someone on your team.', 'data': [{'observation_prompt': 'What makes you happier at work?', 'observation': 'My observation for o2.'}, {'observation_prompt': 'What makes you successful at work?', 'observation': 'My observation for o8.'}]}, {'experiment_id': 'e3', 'experiment': 'Keep quiet for 10-15 minutes in a meeting (or until someone asks for your input).', 'data': [{'observation_prompt': 'What makes you happier at work?', 'observation': 'My observation for o3.'}, {'observation_prompt': 'What makes you successful at work?', 'observation': 'My observation for o9.'}]}]
-                primary_cols = ['experiment_prompt_id', 'experiment_prompt']
-                data_cols = ['observation_prompt_id', 'observation_prompt', 'observation']
-                dict_experiments = (df_sub_group.groupby(primary_cols)[data_cols]
-                    .apply(lambda x: x.to_dict('records'))
-                    .reset_index(name='observations')
-                    .to_dict(orient='records'))
-
-                # For each experiment, set observations to "None" if there are no observation prompts / observations 
-                for index in range(0, len(dict_experiments)):
-                    if dict_experiments[index]['observations'] == [{'observation_prompt_id': '', 'observation_prompt': '', 'observation': ''}]:
-                        dict_experiments[index]['observations'] = "None"
-                
-                # Add experiments / observations for this sub_group
-                array_sub_groups.append(
-                    {"sub_group_id": sub_group_id,
-                    "sub_group_name": df_sub_group.sub_group_name.get(0),
-                    "sub_group_display_date": df_sub_group.display_datetime.get(0).strftime("%B %#d, %Y"),
-                    "experiments": dict_experiments}
-                )
-
-            # Add data for particular experiment group
-            array_groups.append(
-                {"group_id": group_id,
-                "group_name": df_group.group_name.get(0),
-                "sub_groups": array_sub_groups}
-            )
-
-        # Add experiment groups, sub_groups, experiments, and observations to the response dictionary
-        dict_response['groups'] = array_groups
-
-        logger.info(f"Successfully ran get_experimenter_log_data() for public_user_id: {public_user_id}")
+# Version of a user's experimenter log (for ETags; see get_experimenter_log_etag()): changes whenever anything in their response could
+# users.xmin: first_name; observations: any insert / status change changes the count or max xmin; sub_group_actions: another week unlocking changes the count / latest action_datetime
+EXPERIMENTER_LOG_VERSION_SQL_STATEMENT = """
+SELECT
+	u.xmin::text AS user_version,
+	(SELECT count(*) || ':' || COALESCE(max(o.xmin::text::bigint), 0) FROM observations o WHERE o.user_id = u.id) AS observations_version,
+	(SELECT count(*) || ':' || COALESCE(max(sga.action_datetime)::text, '') FROM sub_group_actions sga WHERE sga.user_id = u.id AND sga.status = 'display_after_action_datetime' AND sga.action_datetime < NOW() AT TIME ZONE 'UTC') AS sub_group_actions_version
+FROM 
+	user_lookups ul, 
+	users u
+WHERE
+	ul.public_user_id = %(public_user_id)s AND -- restrict to the public_user_id
+	ul.status = 'active' AND -- ensure the public_user_id is active 
+	u.id = ul.user_id; -- restrict to the user associated with the public_user_id"""
 
-        return dict_response
-    
-    # Catch any exceptions as we tried to execute the function
-    except Exception as e:
+register_prepared_statement(statement_name="experimenter_log_version", sql_statement=EXPERIMENTER_LOG_VERSION_SQL_STATEMENT)
 
-        error_class = f"API | get_experimenter_log_data()"
-        error_message = f"Error with /v1/experimenter-log/?public_user_id={public_user_id}; Error: {e}"
-        logger.error(error_message)
-        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
-        honeybadger.notify(error_class=error_class, error_message=error_message)
+# Bump when the shape / formatting of the response changes, so clients don't keep a response from the previous code under the same ETag
+EXPERIMENTER_LOG_RESPONSE_VERSION = 1
 
-        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
-    
-    finally:
+# Paginated experimenter log (/v2/experimenter-log/): one page of sub_groups at a time, newest first
+# Pages are keyset paginated on (display_datetime, sub_group_id) of the user's displayed sub_group_actions, and the page's LIMIT is applied before we join in any prompts / observations,
+# so Postgres only touches the requested page however long the user's program runs. group_id (optional) restricts the log to one group
+# sql_params = {'public_user_id': public_user_id, 'group_id': None, 'cursor_display_datetime': None, 'cursor_sub_group_id': None, 'page_size': 10}
+EXPERIMENTER_LOG_PAGE_SQL_STATEMENT = """
+/*
+Case 1: Public_user_id is not found / not active -- returns no rows
+Case 2: User has no experiments on this page -- returns one row with just user's info
+Case 3: User has experiments on this page -- returns rows for every experiment / observation prompt combination (observation column filled out if they have observations)
+*/
+""" + EXPERIMENTER_LOG_IDENTIFIED_USER_CTE_SQL + """,
 
-        # Close database connection if it exists    
-        if db_conn is not None:
-            db_conn.close()   
-    
-    
+-- The user's displayed sub_group_actions after the cursor, newest first (one more than the page size, so we know whether there's another page)
+candidate_sub_group_actions AS (
+SELECT
+	sga.action_datetime AS display_datetime,
+	sgat.sub_group_id
+FROM
+	identified_user iu,
+	sub_group_actions sga,
+	sub_group_action_templates sgat,
+	sub_groups sg
+WHERE
+	sga.user_id = iu.user_id AND sga.status = 'display_after_action_datetime' AND -- restrict to just the sub_group_actions for the user that are flagged to be displayed
+	sga.action_datetime < NOW() AT TIME ZONE 'UTC' AND -- restrict to just the sub_group_actions where the action_datetime has already passed (and thus they should be displayed)
+	sgat.id = sga.sub_group_action_template_id AND -- identify the sub_group_action_template so that we can identify the sub_group
+	sg.id = sgat.sub_group_id AND
+	(%(group_id)s::text IS NULL OR sg.group_id = %(group_id)s::text) AND -- optionally restrict to one group
+	(%(cursor_display_datetime)s::timestamp IS NULL OR (sga.action_datetime, sgat.sub_group_id) < (%(cursor_display_datetime)s::timestamp, %(cursor_sub_group_id)s::text)) -- start after the previous page (naive UTC, like action_datetime and the changes cursor)
+ORDER BY sga.action_datetime DESC, sgat.sub_group_id DESC
+LIMIT %(page_size)s::int + 1
+),
+
+-- The page itself
+page_sub_group_actions AS (
+SELECT *
+FROM candidate_sub_group_actions
+ORDER BY display_datetime DESC, sub_group_id DESC
+LIMIT %(page_size)s::int
+),
+
+-- All of the experiments, etc. on the page
+assigned_experiments AS (
+SELECT
+	iu.user_id,
+	g.id AS group_id,
+ 	g.group_name, 
+	sg.id AS sub_group_id,
+ 	sg.sub_group_name, 
+	ep.id AS experiment_prompt_id,
+ 	ep.experiment_prompt, 
+	op.id AS observation_prompt_id,
+ 	op.observation_prompt, 
+	psga.display_datetime,
+	ep.display_order AS ep_display_order,
+	op.display_order AS op_display_order
+FROM
+	identified_user iu,
+	page_sub_group_actions psga,
+	sub_groups sg, 
+	groups g,
+	experiment_prompts ep,
+	observation_prompts op
+WHERE
+	sg.id = psga.sub_group_id AND --restrict to just the sub_groups on the page
+	g.id = sg.group_id AND -- restrict to just the relevant groups
+	ep.sub_group_id = sg.id AND -- restrict to just the relevant experiment_prompts
+	op.experiment_prompt_id = ep.id -- restrict to just the relevant observation prompts
+),
+
+-- All of the observations made by the user on the page
+user_observations AS (
+SELECT 
+	o.observation_prompt_id,
+	o.id AS observation_id,
+	o.observation,
+	o.observation_formatted
+FROM
+	assigned_experiments ae,
+	observations o
+WHERE
+	o.observation_prompt_id = ae.observation_prompt_id AND -- restrict to observations for relevant observation prompts
+	o.user_id = ae.user_id AND -- restrict to observations by the user
+	o.status = 'active' -- restrict to active observations
+),
+
+-- Where the next page starts (NULL if this is the last page)
+next_page AS (
+SELECT
+	psga.display_datetime AS next_cursor_display_datetime,
+	psga.sub_group_id AS next_cursor_sub_group_id
+FROM page_sub_group_actions psga
+WHERE (SELECT count(*) FROM candidate_sub_group_actions) > %(page_size)s::int
+ORDER BY psga.display_datetime, psga.sub_group_id
+LIMIT 1
+)
+
+SELECT
+	iu.first_name, 
+	(SELECT MIN(sga.action_datetime) FROM sub_group_actions sga WHERE sga.user_id = iu.user_id AND sga.status = 'display_after_action_datetime' AND sga.action_datetime < NOW() AT TIME ZONE 'UTC') AS first_display_datetime, -- days_of_experimenting counts from the user's first experiments, not the first on this page
+	np.next_cursor_display_datetime,
+	np.next_cursor_sub_group_id,
+	ae.display_datetime,
+	ae.group_id,
+ 	ae.group_name, 
+	ae.sub_group_id,
+ 	ae.sub_group_name, 
+	ae.experiment_prompt_id,
+ 	ae.experiment_prompt, 
+	ae.observation_prompt_id,
+ 	ae.observation_prompt, 
+	uo.observation_id,
+	uo.observation,
+	uo.observation_formatted
+FROM identified_user iu
+LEFT JOIN next_page np ON TRUE
+LEFT JOIN assigned_experiments ae ON iu.user_id = ae.user_id
+LEFT JOIN user_observations uo ON ae.observation_prompt_id = uo.observation_prompt_id
+ORDER BY
+	display_datetime DESC, -- the most recent exeperiments are shown first
+	ep_display_order,
+	op_display_order;"""
+
+register_prepared_statement(statement_name="experimenter_log_page", sql_statement=EXPERIMENTER_LOG_PAGE_SQL_STATEMENT)
+
+EXPERIMENTER_LOG_DEFAULT_PAGE_SIZE = 10 # sub_groups (i.e., weeks of experiments in a group) per page
+EXPERIMENTER_LOG_MAX_PAGE_SIZE = 50
+
+# Experimenter log delta sync (/v2/experimenter-log/changes/): what changed since the client's change cursor, as insert / update / remove operations
+# Observations and sub_group_actions take a change_seq from one sequence on every insert / relevant update (see "add_experimenter_log_change_seq" in database_migration_functions.py),
+# and sub_groups also unlock when their action_datetime passes (no write happens then), so the cursor is (the user's max change_seq, the time of the sync)
+# First we look up the user and take their change lock: it waits for any of the user's writes still in flight, so the change_seq we hand out never skips one that commits later
+# sql_params = {'public_user_id': public_user_id}
+EXPERIMENTER_LOG_CHANGE_LOCK_SQL_STATEMENT = """
+SELECT
+	u.id AS user_id,
+	u.first_name,
+	pg_advisory_xact_lock(hashtext('experimenter_log_changes:' || u.id::text))::text AS change_lock -- held until the transaction ends
+FROM 
+	user_lookups ul, 
+	users u
+WHERE
+	ul.public_user_id = %(public_user_id)s AND -- restrict to the public_user_id
+	ul.status = 'active' AND -- ensure the public_user_id is active 
+	u.id = ul.user_id; -- restrict to the user associated with the public_user_id"""
+
+# Then (in the same transaction, so with a snapshot taken after the lock) the changes themselves
+# sql_params = {'user_id': user_id, 'cursor_change_seq': 0, 'cursor_datetime': None} (no cursor: everything is an insert, i.e., a first sync)
+EXPERIMENTER_LOG_CHANGES_SQL_STATEMENT = """
+/*
+Returns one 'cursor' row (the next change cursor), then:
+'observation' rows: one per observation prompt whose observations changed since the cursor (with the active observation, if there is one)
+'removed_sub_group' rows: one per sub_group that changed since the cursor and is no longer displayed
+'sub_group' rows: one per experiment x observation prompt of the sub_groups displayed since the cursor (as in the full log)
+*/
+-- The user's displayed sub_group_actions (as in the full log)
+WITH displayed_sub_group_actions AS (
+SELECT
+	sgat.sub_group_id,
+	sga.action_datetime AS display_datetime,
+	sga.change_seq
+FROM
+	sub_group_actions sga,
+	sub_group_action_templates sgat
+WHERE
+	sga.user_id = %(user_id)s AND sga.status = 'display_after_action_datetime' AND -- restrict to just the sub_group_actions for the user that are flagged to be displayed
+	sga.action_datetime < NOW() AT TIME ZONE 'UTC' AND -- restrict to just the sub_group_actions where the action_datetime has already passed (and thus they should be displayed)
+	sgat.id = sga.sub_group_action_template_id -- identify the sub_group_action_template so that we can identify the sub_group
+),
+
+-- Sub_groups displayed since the cursor: their action_datetime passed since the last sync, or they were flagged to be displayed since then
+inserted_sub_group_actions AS (
+SELECT
+	dsga.sub_group_id,
+	dsga.display_datetime
+FROM displayed_sub_group_actions dsga
+WHERE
+	%(cursor_datetime)s::timestamp IS NULL OR -- first sync
+	dsga.display_datetime >= %(cursor_datetime)s::timestamp OR
+	dsga.change_seq > %(cursor_change_seq)s::bigint
+),
+
+-- Sub_groups whose sub_group_actions changed since the cursor and aren't displayed anymore (the client drops any it has)
+removed_sub_groups AS (
+SELECT DISTINCT sgat.sub_group_id
+FROM
+	sub_group_actions sga,
+	sub_group_action_templates sgat
+WHERE
+	%(cursor_datetime)s::timestamp IS NOT NULL AND -- nothing to remove on a first sync
+	sga.user_id = %(user_id)s AND sga.change_seq > %(cursor_change_seq)s::bigint AND
+	sgat.id = sga.sub_group_action_template_id AND
+	sgat.sub_group_id NOT IN (SELECT sub_group_id FROM displayed_sub_group_actions)
+),
+
+-- All of the experiments, etc. in the inserted sub_groups
+inserted_experiments AS (
+SELECT
+	g.id AS group_id,
+ 	g.group_name, 
+	sg.id AS sub_group_id,
+ 	sg.sub_group_name, 
+	ep.id AS experiment_prompt_id,
+ 	ep.experiment_prompt, 
+	op.id AS observation_prompt_id,
+ 	op.observation_prompt, 
+	isga.display_datetime,
+	ep.display_order AS ep_display_order,
+	op.display_order AS op_display_order
+FROM
+	inserted_sub_group_actions isga,
+	sub_groups sg, 
+	groups g,
+	experiment_prompts ep,
+	observation_prompts op
+WHERE
+	sg.id = isga.sub_group_id AND --restrict to just the inserted sub_groups
+	g.id = sg.group_id AND -- restrict to just the relevant groups
+	ep.sub_group_id = sg.id AND -- restrict to just the relevant experiment_prompts
+	op.experiment_prompt_id = ep.id -- restrict to just the relevant observation prompts
+),
+
+-- Observation prompts (in sub_groups the client already has) where the user's observations changed since the cursor (submit_observation() inactivates the prior observation and inserts the new one)
+changed_observation_prompts AS (
+SELECT
+	o.observation_prompt_id,
+	bool_or(o.status <> 'active') AS replaced -- an observation the client may have was inactivated
+FROM
+	observations o,
+	observation_prompts op,
+	experiment_prompts ep
+WHERE
+	o.user_id = %(user_id)s AND o.change_seq > %(cursor_change_seq)s::bigint AND
+	op.id = o.observation_prompt_id AND
+	ep.id = op.experiment_prompt_id AND
+	ep.sub_group_id IN (SELECT sub_group_id FROM displayed_sub_group_actions) AND
+	ep.sub_group_id NOT IN (SELECT sub_group_id FROM inserted_sub_group_actions) -- inserted sub_groups already come with their observations
+GROUP BY o.observation_prompt_id
+)
+
+SELECT
+	'cursor' AS row_type,
+	GREATEST(
+		(SELECT MAX(o.change_seq) FROM observations o WHERE o.user_id = %(user_id)s),
+		(SELECT MAX(sga.change_seq) FROM sub_group_actions sga WHERE sga.user_id = %(user_id)s),
+		%(cursor_change_seq)s::bigint) AS change_seq,
+	NOW() AT TIME ZONE 'UTC' AS cursor_datetime,
+	NULL AS group_id,
+	NULL AS group_name,
+	NULL AS sub_group_id,
+	NULL AS sub_group_name,
+	NULL AS experiment_prompt_id,
+	NULL AS experiment_prompt,
+	NULL AS observation_prompt_id,
+	NULL AS observation_prompt,
+	NULL AS display_datetime,
+	NULL::int AS ep_display_order,
+	NULL::int AS op_display_order,
+	NULL::boolean AS replaced,
+	NULL AS observation_id,
+	NULL AS observation,
+	NULL AS observation_formatted
+
+UNION ALL
+
+SELECT
+	'observation' AS row_type,
+	NULL AS change_seq,
+	NULL AS cursor_datetime,
+	NULL AS group_id,
+	NULL AS group_name,
+	NULL AS sub_group_id,
+	NULL AS sub_group_name,
+	NULL AS experiment_prompt_id,
+	NULL AS experiment_prompt,
+	cop.observation_prompt_id,
+	NULL AS observation_prompt,
+	NULL AS display_datetime,
+	NULL AS ep_display_order,
+	NULL AS op_display_order,
+	cop.replaced,
+	o.id AS observation_id,
+	o.observation,
+	o.observation_formatted
+FROM changed_observation_prompts cop
+LEFT JOIN observations o ON
+	o.observation_prompt_id = cop.observation_prompt_id AND 
+	o.user_id = %(user_id)s AND
+	o.status = 'active'
+
+UNION ALL
+
+SELECT
+	'removed_sub_group' AS row_type,
+	NULL AS change_seq,
+	NULL AS cursor_datetime,
+	NULL AS group_id,
+	NULL AS group_name,
+	rsg.sub_group_id,
+	NULL AS sub_group_name,
+	NULL AS experiment_prompt_id,
+	NULL AS experiment_prompt,
+	NULL AS observation_prompt_id,
+	NULL AS observation_prompt,
+	NULL AS display_datetime,
+	NULL AS ep_display_order,
+	NULL AS op_display_order,
+	NULL AS replaced,
+	NULL AS observation_id,
+	NULL AS observation,
+	NULL AS observation_formatted
+FROM removed_sub_groups rsg
+
+UNION ALL
+
+SELECT
+	'sub_group' AS row_type,
+	NULL AS change_seq,
+	NULL AS cursor_datetime,
+	ie.group_id,
+ 	ie.group_name, 
+	ie.sub_group_id,
+ 	ie.sub_group_name, 
+	ie.experiment_prompt_id,
+ 	ie.experiment_prompt, 
+	ie.observation_prompt_id,
+ 	ie.observation_prompt, 
+	ie.display_datetime,
+	ie.ep_display_order,
+	ie.op_display_order,
+	NULL AS replaced,
+	o.id AS observation_id,
+	o.observation,
+	o.observation_formatted
+FROM inserted_experiments ie
+LEFT JOIN observations o ON
+	o.observation_prompt_id = ie.observation_prompt_id AND 
+	o.user_id = %(user_id)s AND
+	o.status = 'active'
+
+ORDER BY
+	row_type, -- 'cursor' first
+	display_datetime DESC, -- the most recent exeperiments are shown first
+	ep_display_order,
+	op_display_order;"""
+
+register_prepared_statement(statement_name="experimenter_log_change_lock", sql_statement=EXPERIMENTER_LOG_CHANGE_LOCK_SQL_STATEMENT)
+register_prepared_statement(statement_name="experimenter_log_changes", sql_statement=EXPERIMENTER_LOG_CHANGES_SQL_STATEMENT)
+
+# Batch experimenter log (/v1/experimenter-logs/, e.g., for dashboards): the rows mode query for several users at once
+# identified_user has a row per active public_user_id in the batch, and each row says which public_user_id it's for, so we can split the rows by user in one pass
+# sql_params = {'public_user_ids': ['abc', 'def']}
+EXPERIMENTER_LOG_BATCH_SQL_STATEMENT = """
+/*
+For each public_user_id in the batch (none for those that aren't found / not active), rows as in EXPERIMENTER_LOG_SQL_STATEMENT
+*/
+-- User info associated with each public_user_id
+WITH identified_user AS
+(SELECT
+	ul.public_user_id,
+ 	u.id AS user_id,
+	u.first_name,
+	(SELECT MIN(sga.action_datetime) FROM sub_group_actions sga WHERE sga.user_id = u.id AND sga.status = 'display_after_action_datetime' AND sga.action_datetime >= NOW() AT TIME ZONE 'UTC') AS next_display_datetime -- when the next experiments unlock (cached responses expire then; see experimenter_log_cache_functions.py)
+FROM 
+	user_lookups ul, 
+	users u
+WHERE
+	ul.public_user_id = ANY(%(public_user_ids)s::text[]) AND -- restrict to the public_user_ids in the batch
+    ul.status = 'active' AND -- ensure the public_user_id is active 
+    u.id = ul.user_id -- restrict to the user associated with the public_user_id
+)""" + EXPERIMENTER_LOG_CONTENT_CTES_SQL + """
+
+--Combine user info, experiment info, and observations (per user)
+SELECT
+	iu.public_user_id,
+	iu.first_name, 
+	iu.next_display_datetime,
+	ae.display_datetime,
+	ae.group_id,
+ 	ae.group_name, 
+	ae.sub_group_id,
+ 	ae.sub_group_name, 
+	ae.experiment_prompt_id,
+ 	ae.experiment_prompt, 
+	ae.observation_prompt_id,
+ 	ae.observation_prompt, 
+	uo.observation_id,
+	uo.observation,
+	uo.observation_formatted
+FROM identified_user iu
+LEFT JOIN assigned_experiments ae ON iu.user_id = ae.user_id
+LEFT JOIN user_observations uo ON ae.observation_prompt_id = uo.observation_prompt_id AND ae.user_id = uo.user_id
+ORDER BY
+	iu.public_user_id,
+	display_datetime DESC, -- the most recent exeperiments are shown first
+	ep_display_order,
+	op_display_order;"""
+
+register_prepared_statement(statement_name="experimenter_log_batch", sql_statement=EXPERIMENTER_LOG_BATCH_SQL_STATEMENT)
+
+# Each public_user_id in a batch is a guess the client has to have a throttle token for (see /v1/experimenter-logs/), so a batch can't be bigger than the client's bucket
+EXPERIMENTER_LOG_MAX_BATCH_SIZE = THROTTLE_POLICIES["experimenter_log"]["client_capacity"]
+
+# query_mode -> prepared statement
+EXPERIMENTER_LOG_QUERY_MODES = {"rows": "experimenter_log", "json": "experimenter_log_json", "catalog": "experimenter_log_user_rows"}
+
+# The rows mode row (EXPERIMENTER_LOG_SQL_STATEMENT) that stitch_experimenter_log_rows() builds for the catalog mode
+ExperimenterLogRow = namedtuple("ExperimenterLogRow", [
+    "first_name", "next_display_datetime", "display_datetime",
+    "group_id", "group_name", "sub_group_id", "sub_group_name",
+    "experiment_prompt_id", "experiment_prompt", "observation_prompt_id", "observation_prompt",
+    "observation_id", "observation", "observation_formatted"])
+
+
+# %% Stitch catalog content into the catalog mode rows (EXPERIMENTER_LOG_USER_ROWS_SQL_STATEMENT)
+# Returns the rows the rows mode query would have returned (same joins and ordering), so they can go through format_experimenter_log_data()
+def stitch_experimenter_log_rows(user_rows, catalog, logger):
+
+    user_row = user_rows[0] # the query returns the 'sub_group_action' rows (with the user's info) first
+
+    # observation_prompt_id -> the user's active observations
+    dict_observations = {}
+    for row in user_rows:
+        if row.row_type == "observation":
+            dict_observations.setdefault(row.content_id, []).append(row)
+
+    rows = []
+    sort_keys = []
+    missing_template_ids = set()
+
+    for row in user_rows:
+
+        if row.row_type != "sub_group_action" or row.content_id is None:
+            continue
+
+        # Inner joins in the rows mode: skip anything whose template / sub_group / group isn't in the catalog
+        sub_group_id = catalog.sub_group_id_by_template.get(row.content_id)
+        sub_group = catalog.sub_groups.get(sub_group_id)
+        group = catalog.groups.get(sub_group.group_id) if sub_group is not None else None
+        if group is None:
+            missing_template_ids.add(row.content_id)
+            continue
+
+        for experiment_prompt in catalog.experiment_prompts_by_sub_group.get(sub_group_id, ()):
+            for observation_prompt in catalog.observation_prompts_by_experiment_prompt.get(experiment_prompt.experiment_prompt_id, ()):
+                for observation in dict_observations.get(observation_prompt.observation_prompt_id, [None]):
+
+                    rows.append(ExperimenterLogRow(
+                        first_name=user_row.first_name,
+                        next_display_datetime=user_row.next_display_datetime,
+                        display_datetime=row.display_datetime,
+                        group_id=group.group_id,
+                        group_name=group.group_name,
+                        sub_group_id=sub_group_id,
+                        sub_group_name=sub_group.sub_group_name,
+                        experiment_prompt_id=experiment_prompt.experiment_prompt_id,
+                        experiment_prompt=experiment_prompt.experiment_prompt,
+                        observation_prompt_id=observation_prompt.observation_prompt_id,
+                        observation_prompt=observation_prompt.observation_prompt,
+                        observation_id=observation.observation_id if observation is not None else None,
+                        observation=observation.observation if observation is not None else None,
+                        observation_formatted=observation.observation_formatted if observation is not None else None))
+
+                    # ORDER BY display_datetime DESC, ep_display_order, op_display_order (NULL display orders last, as in Postgres)
+                    sort_keys.append((
+                        row.display_datetime,
+                        (experiment_prompt.display_order is None, experiment_prompt.display_order or 0),
+                        (observation_prompt.display_order is None, observation_prompt.display_order or 0)))
+
+    # Content authored since the catalog was loaded; the next refresh will pick it up
+    if len(missing_template_ids) > 0:
+        logger.warning(f"sub_group_action_template_ids not in catalog version {catalog.version}: {sorted(missing_template_ids)}; requesting a catalog refresh")
+        request_catalog_refresh()
+
+    ## CASE 2: User exists but has no experiments -- one row with just the user's info
+    if len(rows) == 0:
+        return [ExperimenterLogRow(first_name=user_row.first_name, next_display_datetime=user_row.next_display_datetime, **{field: None for field in ExperimenterLogRow._fields[2:]})]
+
+    # Sort by display orders, then (stable) by display_datetime descending
+    order = sorted(range(len(rows)), key=lambda index: sort_keys[index][1:])
+    order.sort(key=lambda index: sort_keys[index][0], reverse=True)
+
+    return [rows[index] for index in order]
+
+
+# %% Format experimenter log data (shared by get_experimenter_log_data() and async_get_experimenter_log_data())
+# Turns the rows returned by EXPERIMENTER_LOG_SQL_STATEMENT (at least one row, see CASE 1 in the callers) into the response dictionary
+# Builds groups -> sub_groups -> experiments -> observations in one pass over the rows (which the query already orders by display_datetime), keyed by id,
+# rather than re-filtering a dataframe for every group / sub_group (quadratic in the number of weeks of experiments)
+def format_experimenter_log_data(rows, public_user_id, logger):
+
+    ## Initialize response dictionary
+    dict_response = {}
+    dict_response["public_user_id"] = public_user_id
+    dict_response["first_name"] = rows[0].first_name
+    dict_response['experiments_to_display'] = "True"
+    dict_response['status'] = "success"
+
+    ## CASE 2: User exists but has no assigned group
+    # Test:  there is just one row with just user's info (e.g., group = None)
+    # Outcome: Return early with experiments_to_display = False 
+    if len(rows) == 1 and rows[0].group_name == None:
+        
+        dict_response['experiments_to_display'] = "False"
+        logger.info(f"No experiments to display for public_user_id: {public_user_id}")
+
+        return dict_response
+
+    ## Format data
+    logger.info("Formatting data")
+
+    ## CASE 3: User exists with assigned experiments (and potentially observations)
+    # Outcome: Return dict_response with all of the experiments and observations for the user
+
+    ## Update response dictionary
+    dict_response["days_of_experimenting"] = (pytz.timezone('UTC').localize(datetime.utcnow()) - min(row.display_datetime for row in rows)).days + 1 # Add 1 to include today
+    
+    # Add experiment groups, sub_groups, experiments, and observations to the response dictionary
+    dict_response['groups'] = format_experimenter_log_groups(rows=rows)
+
+    logger.info(f"Successfully ran get_experimenter_log_data() for public_user_id: {public_user_id}")
+
+    return dict_response
+
+# Nest rows (one per experiment x observation prompt, in display order) into groups -> sub_groups -> experiments -> observations
+# (shared by format_experimenter_log_data() and format_experimenter_log_changes())
+def format_experimenter_log_groups(rows):
+
+    # Text is already rendered with HTML "curly" quotes: prompts / names by the catalog (memoized), observations when they were written (see text_rendering_functions.py)
+    # Missing values (None) become "" as they would otherwise show up as null in the final JSON output
+    format_text = render_catalog_text
+
+    # Groups and sub_groups keep the order in which they first appear in the rows; each sub_group takes its name / display date from its first row
+    dict_groups = {} # group_id -> group dictionary (with a "sub_groups" dictionary keyed by sub_group_id while we build it)
+
+    for row in rows:
+
+        dict_group = dict_groups.get(row.group_id)
+        if dict_group is None:
+            dict_group = {"group_id": row.group_id, "group_name": format_text(row.group_name), "sub_groups": {}}
+            dict_groups[row.group_id] = dict_group
+
+        dict_sub_group = dict_group["sub_groups"].get(row.sub_group_id)
+        if dict_sub_group is None:
+            dict_sub_group = {
+                "sub_group_id": row.sub_group_id,
+                "sub_group_name": format_text(row.sub_group_name),
+                "sub_group_display_date": row.display_datetime.strftime("%B %#d, %Y"),
+                "experiments": {}} # (experiment_prompt_id, experiment_prompt) -> experiment dictionary
+            dict_group["sub_groups"][row.sub_group_id] = dict_sub_group
+
+        experiment_prompt_id = "" if row.experiment_prompt_id is None else row.experiment_prompt_id
+        experiment_prompt = format_text(row.experiment_prompt)
+        dict_experiment = dict_sub_group["experiments"].get((experiment_prompt_id, experiment_prompt))
+        if dict_experiment is None:
+            dict_experiment = {"experiment_prompt_id": experiment_prompt_id, "experiment_prompt": experiment_prompt, "observations": []}
+            dict_sub_group["experiments"][(experiment_prompt_id, experiment_prompt)] = dict_experiment
+
+        dict_experiment["observations"].append({
+            "observation_prompt_id": "" if row.observation_prompt_id is None else row.observation_prompt_id,
+            "observation_prompt": format_text(row.observation_prompt),
+            "observation": render_stored_text(row.observation, row.observation_formatted)})
+
+    # Swap the dictionaries we built with for the lists in the response
+    # Experiments are listed by experiment_prompt_id (the order the response has always used); observations keep the order of the rows
+    for dict_group in dict_groups.values():
+
+        for dict_sub_group in dict_group["sub_groups"].values():
+
+            dict_sub_group["experiments"] = [dict_sub_group["experiments"][key] for key in sorted(dict_sub_group["experiments"])]
+
+            # For each experiment, set observations to "None" if there are no observation prompts / observations 
+            for dict_experiment in dict_sub_group["experiments"]:
+                if dict_experiment["observations"] == [{'observation_prompt_id': '', 'observation_prompt': '', 'observation': ''}]:
+                    dict_experiment["observations"] = "None"
+
+        dict_group["sub_groups"] = list(dict_group["sub_groups"].values())
+
+    return list(dict_groups.values())
+
+
+# %% Format experimenter log data from the JSON mode query (EXPERIMENTER_LOG_JSON_SQL_STATEMENT)
+# Postgres has already nested the groups document; we only add the curly quotes and display dates so the response matches format_experimenter_log_data()
+def format_experimenter_log_json_data(row, public_user_id, logger):
+
+    ## Initialize response dictionary
+    dict_response = {}
+    dict_response["public_user_id"] = public_user_id
+    dict_response["first_name"] = row.first_name
+    dict_response['experiments_to_display'] = "True"
+    dict_response['status'] = "success"
+
+    ## CASE 2: User exists but has no assigned group
+    # Test: groups is NULL
+    # Outcome: Return early with experiments_to_display = False 
+    if row.groups is None:
+        
+        dict_response['experiments_to_display'] = "False"
+        logger.info(f"No experiments to display for public_user_id: {public_user_id}")
+
+        return dict_response
+
+    ## Format data
+    logger.info("Formatting data")
+
+    # Text is already rendered with HTML "curly" quotes: prompts / names by the catalog (memoized), observations when they were written (see text_rendering_functions.py)
+    format_text = render_catalog_text
+
+    ## CASE 3: User exists with assigned experiments (and potentially observations)
+    dict_response["days_of_experimenting"] = (pytz.timezone('UTC').localize(datetime.utcnow()) - row.first_display_datetime).days + 1 # Add 1 to include today
+
+    for dict_group in row.groups:
+
+        dict_group["group_name"] = format_text(dict_group["group_name"])
+
+        for dict_sub_group in dict_group["sub_groups"]:
+
+            dict_sub_group["sub_group_name"] = format_text(dict_sub_group["sub_group_name"])
+            dict_sub_group["sub_group_display_date"] = datetime.strptime(dict_sub_group["sub_group_display_date"], "%Y-%m-%d").strftime("%B %#d, %Y")
+
+            for dict_experiment in dict_sub_group["experiments"]:
+
+                if dict_experiment["experiment_prompt_id"] is None:
+                    dict_experiment["experiment_prompt_id"] = ""
+                dict_experiment["experiment_prompt"] = format_text(dict_experiment["experiment_prompt"])
+
+                for dict_observation in dict_experiment["observations"]:
+
+                    if dict_observation["observation_prompt_id"] is None:
+                        dict_observation["observation_prompt_id"] = ""
+                    dict_observation["observation_prompt"] = format_text(dict_observation["observation_prompt"])
+                    dict_observation["observation"] = render_stored_text(dict_observation["observation"], dict_observation.pop("observation_formatted"))
+
+                # Set observations to "None" if there are no observation prompts / observations 
+                if dict_experiment["observations"] == [{'observation_prompt_id': '', 'observation_prompt': '', 'observation': ''}]:
+                    dict_experiment["observations"] = "None"
+
+    # Add experiment groups, sub_groups, experiments, and observations to the response dictionary
+    dict_response['groups'] = row.groups
+
+    logger.info(f"Successfully ran get_experimenter_log_data() for public_user_id: {public_user_id}")
+
+    return dict_response
+
+# Format the rows from any query mode
+def _format_experimenter_log_rows(rows, query_mode, catalog, public_user_id, logger):
+
+    if query_mode == "json":
+        return format_experimenter_log_json_data(row=rows[0], public_user_id=public_user_id, logger=logger)
+
+    if query_mode == "catalog":
+        rows = stitch_experimenter_log_rows(user_rows=rows, catalog=catalog, logger=logger)
+
+    return format_experimenter_log_data(rows=rows, public_user_id=public_user_id, logger=logger)
+
+# The catalog mode needs a loaded catalog; until the first load succeeds we join the content tables instead (rows mode)
+def _resolve_experimenter_log_query_mode(query_mode, logger):
+
+    if query_mode not in EXPERIMENTER_LOG_QUERY_MODES:
+        raise ValueError(f"query_mode must be one of {list(EXPERIMENTER_LOG_QUERY_MODES)}, not: {query_mode}")
+
+    catalog = get_catalog() # one version for the whole request, even if a refresh swaps in a new one while we query
+
+    if query_mode == "catalog" and catalog is None:
+        logger.warning("Catalog not loaded; using the rows query mode")
+        return "rows", None
+
+    return query_mode, catalog
+
+
+# %% Get experimenter log data
+# client_id identifies the caller for the brute force throttle (see throttle_functions.py)
+def get_experimenter_log_data(public_user_id, db_pool, logger, query_mode="rows", use_cache=True, client_id=None):
+
+    db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
+
+    try:
+
+        # Return the cached response if we have one (see experimenter_log_cache_functions.py)
+        if use_cache:
+
+            dict_response = get_cached_experimenter_log(public_user_id)
+            if dict_response is not None:
+                logger.info(f"Returning cached experimenter log data for public_user_id: {public_user_id}")
+                record_throttle_success(policy_name="experimenter_log", client_id=client_id)
+                return dict_response
+
+            cache_generation = get_experimenter_log_cache_generation(public_user_id) # before the query, so an invalidation while we query isn't overwritten with stale data
+
+        # Public_user_ids we recently found without an active user_lookup go straight to CASE 1, without a query (see user_lookup_cache_functions.py)
+        if cached_user_lookup_is_inactive(public_user_id):
+
+            rows = []
+
+        else:
+
+            # Get database connection from the pool (a read replica if configured, unless this user just wrote; see read_replica_functions.py)
+            db_conn, read_db_pool = getconn_for_read(db_pool=db_pool, routing_key=public_user_id, logger=logger) # check out a connection from the shared pool (created once in main.py)
+
+            ## Retrieve experimenter log data from database
+            logger.info("Retrieve experimenter log data from database")
+
+            # Define sql query (use parameters rather than f-string to avoid SQL injection)
+            query_mode, catalog = _resolve_experimenter_log_query_mode(query_mode=query_mode, logger=logger)
+            sql_params = {'public_user_id': public_user_id}
+
+            # Pull data from database (read-only, so no BEGIN / COMMIT round trips)
+            with transaction(db_conn = db_conn, logger = logger, read_only = True):
+                rows = execute_prepared_sql_return_rows(statement_name = EXPERIMENTER_LOG_QUERY_MODES[query_mode], sql_params = sql_params, db_conn = db_conn, logger = logger)
+            logger.info("Finished retrieving experimenter log data from database")
+
+        ## CASE 1: Public_user_id was not found / not active
+        # Test: No rows returned
+        # Outcome: Return error 
+        if len(rows) == 0:
+
+            info_message = f"user_lookups table did not contain active public_user_id of '{public_user_id}'"
+            logger.info(info_message)
+
+            # Cache the lookup (one cheap query, on a path that's about to back off anyway) so repeated guesses of this public_user_id skip the database
+            if db_conn is not None:
+                retrieve_user_id_from_public_user_id(public_user_id=public_user_id, db_conn=db_conn, logger=logger)
+
+            throttle_failure(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) # Delay (backing off with repeated misses) to prevent brute force attacks
+
+            return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+        ## CASE 2 / CASE 3: User exists (with or without assigned experiments)
+        dict_response = _format_experimenter_log_rows(rows=rows, query_mode=query_mode, catalog=catalog, public_user_id=public_user_id, logger=logger)
+        record_throttle_success(policy_name="experimenter_log", client_id=client_id)
+
+        # Cache the response until the user's next experiments unlock (CASE 1 isn't cached so the brute force throttle always applies)
+        if use_cache:
+            cache_experimenter_log(public_user_id=public_user_id, dict_response=dict_response, next_display_datetime=rows[0].next_display_datetime, cache_generation=cache_generation)
+
+        return dict_response
+    
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | get_experimenter_log_data()"
+        error_message = f"Error with /v1/experimenter-log/?public_user_id={public_user_id}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+    
+    finally:
+
+        # Return database connection to the pool if we checked one out
+        if db_conn is not None:
+            read_db_pool.putconn(db_conn)
+
+
+# %% Cache the lookup of a public_user_id that had no active user_lookup (CASE 1) so repeated guesses of it skip the database (see user_lookup_cache_functions.py)
+# One cheap query, on a path that's about to back off anyway
+async def _async_cache_user_lookup(public_user_id, async_db_pool, logger):
+
+    async with async_db_pool.connection() as db_conn:
+        await async_retrieve_user_id_from_public_user_id(public_user_id=public_user_id, db_conn=db_conn, logger=logger)
+
+
+# %% Get experimenter log data (async)
+# Awaitable counterpart of get_experimenter_log_data() for our async endpoints (doesn't block the event loop while waiting on the database)
+# etag: the response's version from async_get_experimenter_log_etag(), stored with the cached response
+# cache_generation: get_experimenter_log_cache_generation() from before the etag was read (so a write after it isn't cached under the old etag); None reads it now
+async def async_get_experimenter_log_data(public_user_id, async_db_pool, logger, query_mode="rows", use_cache=True, client_id=None, etag=None, cache_generation=None):
+
+    try:
+
+        # Return the cached response if we have one (see experimenter_log_cache_functions.py)
+        if use_cache:
+
+            dict_response = get_cached_experimenter_log(public_user_id)
+            if dict_response is not None:
+                logger.info(f"Returning cached experimenter log data for public_user_id: {public_user_id}")
+                await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+                return dict_response
+
+            if cache_generation is None:
+                cache_generation = get_experimenter_log_cache_generation(public_user_id) # before the query, so an invalidation while we query isn't overwritten with stale data
+
+        # Public_user_ids we recently found without an active user_lookup go straight to CASE 1, without a query (see user_lookup_cache_functions.py)
+        known_inactive = cached_user_lookup_is_inactive(public_user_id)
+
+        if known_inactive:
+
+            rows = []
+
+        else:
+
+            ## Retrieve experimenter log data from database
+            logger.info("Retrieve experimenter log data from database")
+
+            # Define sql query (use parameters rather than f-string to avoid SQL injection)
+            query_mode, catalog = _resolve_experimenter_log_query_mode(query_mode=query_mode, logger=logger)
+            sql_params = {'public_user_id': public_user_id}
+
+            # Pull data from database (connection goes back to the pool before we format the data)
+            # Read from a replica if configured, unless this user just wrote (see read_replica_functions.py)
+            # Read-only, so no BEGIN / COMMIT round trips
+            async with async_read_connection(async_db_pool=async_db_pool, routing_key=public_user_id, logger=logger) as db_conn, async_transaction(db_conn = db_conn, logger = logger, read_only = True):
+                rows = await async_execute_prepared_sql_return_rows(statement_name = EXPERIMENTER_LOG_QUERY_MODES[query_mode], sql_params = sql_params, db_conn = db_conn, logger = logger)
+            logger.info("Finished retrieving experimenter log data from database")
+
+        ## CASE 1: Public_user_id was not found / not active
+        # Test: No rows returned
+        # Outcome: Return error 
+        if len(rows) == 0:
+
+            info_message = f"user_lookups table did not contain active public_user_id of '{public_user_id}'"
+            logger.info(info_message)
+
+            if not known_inactive:
+                await _async_cache_user_lookup(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger)
+
+            await async_throttle_failure(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) # Delay (backing off with repeated misses) to prevent brute force attacks, without blocking other requests on this worker
+
+            return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+        ## CASE 2 / CASE 3: User exists (with or without assigned experiments)
+        dict_response = _format_experimenter_log_rows(rows=rows, query_mode=query_mode, catalog=catalog, public_user_id=public_user_id, logger=logger)
+        await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+
+        # Cache the response until the user's next experiments unlock (CASE 1 isn't cached so the brute force throttle always applies)
+        if use_cache:
+            cache_experimenter_log(public_user_id=public_user_id, dict_response=dict_response, next_display_datetime=rows[0].next_display_datetime, cache_generation=cache_generation, etag=etag)
+
+        return dict_response
+    
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | async_get_experimenter_log_data()"
+        error_message = f"Error with /v1/experimenter-log/?public_user_id={public_user_id}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+
+# %% Get experimenter log data for several users in one query (async)
+# Returns {public_user_id: response}, where each response is what /v1/experimenter-log/ returns for that user (including the failure response for unknown / inactive public_user_ids)
+# Cached users are answered from the cache; the rest share one query and one connection
+async def async_get_experimenter_log_batch(public_user_ids, async_db_pool, logger, use_cache=True, client_id=None):
+
+    public_user_ids = list(dict.fromkeys(public_user_ids)) # drop duplicates, keep the order
+    dict_responses = {}
+
+    try:
+
+        if not 1 <= len(public_user_ids) <= EXPERIMENTER_LOG_MAX_BATCH_SIZE:
+            raise ValueError(f"Batches must have between 1 and {EXPERIMENTER_LOG_MAX_BATCH_SIZE} public_user_ids, not: {len(public_user_ids)}")
+
+        # Return the cached responses we have (see experimenter_log_cache_functions.py)
+        cache_generations = {}
+        missing_public_user_ids = []
+
+        for public_user_id in public_user_ids:
+
+            dict_response = get_cached_experimenter_log(public_user_id) if use_cache else None
+
+            if dict_response is not None:
+                dict_responses[public_user_id] = dict_response
+            elif cached_user_lookup_is_inactive(public_user_id): # recently found without an active user_lookup (see user_lookup_cache_functions.py); CASE 1 without a query
+                missing_public_user_ids.append(public_user_id)
+            else:
+                cache_generations[public_user_id] = get_experimenter_log_cache_generation(public_user_id) # before the query, so an invalidation while we query isn't overwritten with stale data
+
+        logger.info(f"{len(dict_responses)} of {len(public_user_ids)} experimenter logs from the cache")
+
+        if len(cache_generations) > 0:
+
+            ## Retrieve experimenter log data from database (one query for every user we didn't have cached)
+            logger.info("Retrieve experimenter log batch data from database")
+
+            # Read from a replica if configured, unless any of these users just wrote (see read_replica_functions.py)
+            async with async_read_connection(async_db_pool=async_db_pool, routing_key=list(cache_generations), logger=logger) as db_conn, async_transaction(db_conn = db_conn, logger = logger, read_only = True):
+                rows = await async_execute_prepared_sql_return_rows(statement_name = "experimenter_log_batch", sql_params = {'public_user_ids': list(cache_generations)}, db_conn = db_conn, logger = logger)
+            logger.info("Finished retrieving experimenter log batch data from database")
+
+            # Split the rows by user (they're ordered by public_user_id)
+            rows_by_public_user_id = {}
+            for row in rows:
+                rows_by_public_user_id.setdefault(row.public_user_id, []).append(row)
+
+            ## CASE 2 / CASE 3: User exists (with or without assigned experiments)
+            for public_user_id, user_rows in rows_by_public_user_id.items():
+
+                dict_responses[public_user_id] = format_experimenter_log_data(rows=user_rows, public_user_id=public_user_id, logger=logger)
+
+                if use_cache:
+                    cache_experimenter_log(public_user_id=public_user_id, dict_response=dict_responses[public_user_id], next_display_datetime=user_rows[0].next_display_datetime, cache_generation=cache_generations[public_user_id])
+
+            missing_public_user_ids += [public_user_id for public_user_id in cache_generations if public_user_id not in rows_by_public_user_id]
+
+        ## CASE 1: Public_user_id was not found / not active
+        for public_user_id in missing_public_user_ids:
+            logger.info(f"user_lookups table did not contain active public_user_id of '{public_user_id}'")
+            dict_responses[public_user_id] = {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+        # Each miss keeps the token it took from the client (and that public_user_id), as it would have as its own request; the delays run concurrently
+        if len(missing_public_user_ids) > 0:
+            await asyncio.gather(*[async_throttle_failure(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) for public_user_id in missing_public_user_ids])
+
+        # The users we found give their tokens back
+        found_public_user_ids = [public_user_id for public_user_id, dict_response in dict_responses.items() if dict_response["status"] == "success"]
+        if len(found_public_user_ids) > 0:
+            await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=found_public_user_ids, logger=logger)
+
+        return {public_user_id: dict_responses[public_user_id] for public_user_id in public_user_ids}
+
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | async_get_experimenter_log_batch()"
+        error_message = f"Error with /v1/experimenter-logs/ for public_user_ids: {public_user_ids}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {public_user_id: {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"} for public_user_id in public_user_ids}
+
+
+# %% Get the ETag of a user's experimenter log (async)
+# A cheap query (see EXPERIMENTER_LOG_VERSION_SQL_STATEMENT) so the endpoint can answer If-None-Match with 304 without building the response
+# Also covers the catalog version (prompt / group text), the date (days_of_experimenting), and EXPERIMENTER_LOG_RESPONSE_VERSION
+# Returns None if the public_user_id isn't found / active (the endpoint then takes the normal path, which handles CASE 1)
+_experimenter_log_etag_metrics = {"etags_from_cache": 0, "etags_from_database": 0, "not_modified": 0}
+
+def format_experimenter_log_etag(row):
+
+    catalog = get_catalog()
+    version = "|".join([
+        str(EXPERIMENTER_LOG_RESPONSE_VERSION),
+        row.user_version,
+        row.observations_version,
+        row.sub_group_actions_version,
+        catalog.version if catalog is not None else "",
+        datetime.utcnow().strftime("%Y-%m-%d")])
+
+    # Weak ETag: the same response is sent with different Content-Encodings (see create_json_bytes_response())
+    return f'W/"{hashlib.md5(version.encode()).hexdigest()}"'
+
+async def async_get_experimenter_log_etag(public_user_id, async_db_pool, logger):
+
+    try:
+
+        # The cached response already has one (the cache entry is invalidated whenever the version would change)
+        etag = get_cached_experimenter_log_etag(public_user_id)
+        if etag is not None:
+            _experimenter_log_etag_metrics["etags_from_cache"] += 1
+            return etag
+
+        async with async_read_connection(async_db_pool=async_db_pool, routing_key=public_user_id, logger=logger) as db_conn, async_transaction(db_conn = db_conn, logger = logger, read_only = True):
+            rows = await async_execute_prepared_sql_return_rows(statement_name = "experimenter_log_version", sql_params = {'public_user_id': public_user_id}, db_conn = db_conn, logger = logger)
+
+        _experimenter_log_etag_metrics["etags_from_database"] += 1
+
+        if len(rows) == 0:
+            return None
+
+        return format_experimenter_log_etag(rows[0])
+
+    # Without an ETag we just send the full response
+    except Exception as e:
+
+        error_class = f"API | async_get_experimenter_log_etag()"
+        error_message = f"Error getting the experimenter log ETag for public_user_id: {public_user_id}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return None
+
+# %% Get experimenter log data, or nothing if the client already has it (async)
+# if_none_match: the request's If-None-Match header
+# Returns (dict_response, etag); dict_response is None if the client's copy is current (respond 304), etag is None if we couldn't version the response
+async def async_get_experimenter_log_response(public_user_id, async_db_pool, logger, query_mode="rows", client_id=None, if_none_match=None):
+
+    cache_generation = get_experimenter_log_cache_generation(public_user_id) # before we read the version, so a write after it isn't cached under this etag
+    etag = await async_get_experimenter_log_etag(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger)
+
+    if etag is not None and etag_matches(if_none_match=if_none_match, etag=etag):
+        _experimenter_log_etag_metrics["not_modified"] += 1
+        logger.info(f"Experimenter log not modified for public_user_id: {public_user_id}")
+        await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) # the user exists (only they have a version)
+        return None, etag
+
+    dict_response = await async_get_experimenter_log_data(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger, query_mode=query_mode, client_id=client_id, etag=etag, cache_generation=cache_generation)
+
+    # Don't let the client cache failures
+    if dict_response.get("status") != "success":
+        return dict_response, None
+
+    return dict_response, etag
+
+def get_experimenter_log_etag_metrics():
+
+    return dict(_experimenter_log_etag_metrics)
+
+
+# %% Get one page of experimenter log data (async)
+# Pages are returned newest first; pass the previous page's next_cursor to get the next one (next_cursor is None on the last page)
+# The cursor is opaque to clients: base64 of the (display_datetime, sub_group_id) the next page starts after
+# The display_datetime is kept as naive UTC, so the session time zone never shifts a page boundary
+def _to_naive_utc(display_datetime):
+
+    if display_datetime.tzinfo is None:
+        return display_datetime
+
+    return display_datetime.astimezone(pytz.timezone('UTC')).replace(tzinfo=None)
+
+def encode_experimenter_log_cursor(display_datetime, sub_group_id):
+
+    return base64.urlsafe_b64encode(json.dumps([_to_naive_utc(display_datetime).isoformat(), sub_group_id]).encode()).decode()
+
+def decode_experimenter_log_cursor(cursor):
+
+    try:
+        display_datetime, sub_group_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return _to_naive_utc(datetime.fromisoformat(display_datetime)), str(sub_group_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+async def async_get_experimenter_log_page(public_user_id, async_db_pool, logger, page_size=EXPERIMENTER_LOG_DEFAULT_PAGE_SIZE, cursor=None, group_id=None, client_id=None):
+
+    try:
+
+        ## Retrieve the page from the database
+        logger.info("Retrieve experimenter log page from database")
+
+        if not 1 <= page_size <= EXPERIMENTER_LOG_MAX_PAGE_SIZE:
+            raise ValueError(f"page_size must be between 1 and {EXPERIMENTER_LOG_MAX_PAGE_SIZE}, not: {page_size}")
+
+        cursor_display_datetime, cursor_sub_group_id = decode_experimenter_log_cursor(cursor) if cursor is not None else (None, None)
+
+        # Define sql query (use parameters rather than f-string to avoid SQL injection)
+        sql_params = {
+            'public_user_id': public_user_id,
+            'group_id': group_id,
+            'cursor_display_datetime': cursor_display_datetime,
+            'cursor_sub_group_id': cursor_sub_group_id,
+            'page_size': page_size}
+
+        # Public_user_ids we recently found without an active user_lookup go straight to CASE 1, without a query (see user_lookup_cache_functions.py)
+        known_inactive = cached_user_lookup_is_inactive(public_user_id)
+
+        if known_inactive:
+
+            rows = []
+
+        else:
+
+            # Pull data from database (read replica if configured, unless this user just wrote; read-only, so no BEGIN / COMMIT round trips)
+            async with async_read_connection(async_db_pool=async_db_pool, routing_key=public_user_id, logger=logger) as db_conn, async_transaction(db_conn = db_conn, logger = logger, read_only = True):
+                rows = await async_execute_prepared_sql_return_rows(statement_name = "experimenter_log_page", sql_params = sql_params, db_conn = db_conn, logger = logger)
+            logger.info("Finished retrieving experimenter log page from database")
+
+        ## CASE 1: Public_user_id was not found / not active
+        if len(rows) == 0:
+
+            logger.info(f"user_lookups table did not contain active public_user_id of '{public_user_id}'")
+
+            if not known_inactive:
+                await _async_cache_user_lookup(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger)
+
+            await async_throttle_failure(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) # Delay (backing off with repeated misses) to prevent brute force attacks, without blocking other requests on this worker
+
+            return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+        ## CASE 2 / CASE 3: User exists (with or without experiments on this page)
+        dict_response = format_experimenter_log_data(rows=rows, public_user_id=public_user_id, logger=logger)
+        await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+
+        # Count days from the user's first experiments (not the first on this page)
+        if rows[0].first_display_datetime is not None and dict_response["experiments_to_display"] == "True":
+            dict_response["days_of_experimenting"] = (pytz.timezone('UTC').localize(datetime.utcnow()) - rows[0].first_display_datetime).days + 1 # Add 1 to include today
+
+        dict_response["next_cursor"] = encode_experimenter_log_cursor(rows[0].next_cursor_display_datetime, rows[0].next_cursor_sub_group_id) if rows[0].next_cursor_display_datetime is not None else None
+
+        return dict_response
+
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | async_get_experimenter_log_page()"
+        error_message = f"Error with /v2/experimenter-log/?public_user_id={public_user_id}&page_size={page_size}&cursor={cursor}&group_id={group_id}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+
+# %% Get the changes to a user's experimenter log since a change cursor (async)
+# The cursor is opaque to clients: base64 of (the user's max change_seq, the time of the sync); pass the previous response's next_cursor to get the next changes
+# Without a cursor, every displayed sub_group is an insert (i.e., a first sync)
+def encode_experimenter_log_change_cursor(change_seq, cursor_datetime):
+
+    return base64.urlsafe_b64encode(json.dumps([change_seq, cursor_datetime.isoformat()]).encode()).decode()
+
+def decode_experimenter_log_change_cursor(cursor):
+
+    try:
+        change_seq, cursor_datetime = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(change_seq), datetime.fromisoformat(cursor_datetime)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+# Turns the rows returned by EXPERIMENTER_LOG_CHANGES_SQL_STATEMENT into operations for the client to apply to its copy of the log (in order):
+# - {"op": "remove", "type": "sub_group", "sub_group_id"}: drop the sub_group (ignore it if you don't have it)
+# - {"op": "insert", "type": "sub_group", "group_id", "group_name", "sub_group"}: add the sub_group (as it appears in the full log, with its experiments and observations), replacing any copy you have
+# - {"op": "insert" / "update", "type": "observation", "observation_prompt_id", "observation"}: set the observation for the observation prompt (update: it replaces the prior observation)
+# - {"op": "remove", "type": "observation", "observation_prompt_id"}: clear the observation for the observation prompt
+def format_experimenter_log_changes(rows, first_name, public_user_id, logger):
+
+    cursor_row = rows[0] # the 'cursor' row sorts first
+
+    operations = []
+
+    for row in rows:
+        if row.row_type == "removed_sub_group":
+            operations.append({"op": "remove", "type": "sub_group", "sub_group_id": row.sub_group_id})
+
+    for dict_group in format_experimenter_log_groups(rows=[row for row in rows if row.row_type == "sub_group"]):
+        for dict_sub_group in dict_group["sub_groups"]:
+            operations.append({"op": "insert", "type": "sub_group", "group_id": dict_group["group_id"], "group_name": dict_group["group_name"], "sub_group": dict_sub_group})
+
+    for row in rows:
+        if row.row_type == "observation":
+
+            if row.observation_id is None:
+                operations.append({"op": "remove", "type": "observation", "observation_prompt_id": row.observation_prompt_id})
+            else:
+                operations.append({
+                    "op": "update" if row.replaced else "insert",
+                    "type": "observation",
+                    "observation_prompt_id": row.observation_prompt_id,
+                    "observation": render_stored_text(row.observation, row.observation_formatted)})
+
+    logger.info(f"{len(operations)} experimenter log changes for public_user_id: {public_user_id}")
+
+    return {
+        "public_user_id": public_user_id,
+        "first_name": first_name,
+        "status": "success",
+        "operations": operations,
+        "next_cursor": encode_experimenter_log_change_cursor(cursor_row.change_seq, cursor_row.cursor_datetime)}
+
+async def async_get_experimenter_log_changes(public_user_id, async_db_pool, logger, cursor=None, client_id=None):
+
+    try:
+
+        cursor_change_seq, cursor_datetime = decode_experimenter_log_change_cursor(cursor) if cursor is not None else (0, None)
+
+        ## Retrieve the changes from the database
+        # Primary, not a read replica: the change lock has to be taken where the writes take theirs
+        # A real transaction (not read_only, which runs in autocommit): the change lock has to be held until the changes are read
+        logger.info("Retrieve experimenter log changes from database")
+
+        # Public_user_ids we recently found without an active user_lookup go straight to CASE 1, without a query (see user_lookup_cache_functions.py)
+        known_inactive = cached_user_lookup_is_inactive(public_user_id)
+
+        if known_inactive:
+
+            user_rows = []
+
+        else:
+
+            async with async_db_pool.connection() as db_conn, async_transaction(db_conn = db_conn, logger = logger):
+
+                user_rows = await async_execute_prepared_sql_return_rows(statement_name = "experimenter_log_change_lock", sql_params = {'public_user_id': public_user_id}, db_conn = db_conn, logger = logger)
+
+                if len(user_rows) > 0:
+                    sql_params = {'user_id': user_rows[0].user_id, 'cursor_change_seq': cursor_change_seq, 'cursor_datetime': cursor_datetime}
+                    rows = await async_execute_prepared_sql_return_rows(statement_name = "experimenter_log_changes", sql_params = sql_params, db_conn = db_conn, logger = logger)
+
+            logger.info("Finished retrieving experimenter log changes from database")
+
+        ## CASE 1: Public_user_id was not found / not active
+        if len(user_rows) == 0:
+
+            logger.info(f"user_lookups table did not contain active public_user_id of '{public_user_id}'")
+
+            if not known_inactive:
+                await _async_cache_user_lookup(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger)
+
+            await async_throttle_failure(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger) # Delay (backing off with repeated misses) to prevent brute force attacks, without blocking other requests on this worker
+
+            return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+        await async_record_throttle_success(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+
+        return format_experimenter_log_changes(rows=rows, first_name=user_rows[0].first_name, public_user_id=public_user_id, logger=logger)
+
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | async_get_experimenter_log_changes()"
+        error_message = f"Error with /v2/experimenter-log/changes/?public_user_id={public_user_id}&cursor={cursor}; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+
+# %% Check that every query mode returns the same response as the rows mode (run before switching EXPERIMENTER_LOG_QUERY_MODE, e.g., for a handful of real public_user_ids)
+# Returns True if the serialized responses match (days_of_experimenting included, as they all come from the same display_datetime)
+def check_experimenter_log_query_modes_match(public_user_id, db_pool, logger):
+
+    dict_responses = {query_mode: get_experimenter_log_data(public_user_id=public_user_id, db_pool=db_pool, logger=logger, query_mode=query_mode, use_cache=False) for query_mode in EXPERIMENTER_LOG_QUERY_MODES}
+    json_responses = {query_mode: json.dumps(dict_response, default=str) for query_mode, dict_response in dict_responses.items()}
+
+    mismatched_query_modes = [query_mode for query_mode, json_response in json_responses.items() if json_response != json_responses["rows"]]
+
+    if len(mismatched_query_modes) == 0:
+        logger.info(f"Experimenter log query modes match for public_user_id: {public_user_id}")
+        return True
+
+    for query_mode in mismatched_query_modes:
+        logger.error(f"Experimenter log query mode {query_mode} does not match the rows mode for public_user_id: {public_user_id}; rows: {json_responses['rows']}; {query_mode}: {json_responses[query_mode]}")
+    return False
@@ -1,16 +1,174 @@
-import pandas as pd
-import numpy as np
 from time import sleep
 from datetime import datetime
 import pytz
 from honeybadger import honeybadger
 import traceback
-import smartypants
 
 # Custom imports
-from postgresql_db_functions import create_db_connection, execute_sql_return_df, execute_sql_return_status_message
+from postgresql_db_functions import register_prepared_statement, execute_prepared_sql_return_rows
+from async_postgresql_db_functions import async_execute_prepared_sql_return_rows
+from read_replica_functions import record_write
+from experimenter_log_cache_functions import invalidate_experimenter_log_cache
+from cache_invalidation_functions import get_cache_invalidation_sql_params, record_cache_invalidations_published
+from text_rendering_functions import render_text
+from user_lookup_cache_functions import get_cached_user_lookup, get_user_lookup_cache_generation, cache_user_lookup
+
+# %% SQL statements (shared by the sync and async functions below; use parameters rather than f-string to avoid SQL injection)
+
+RETRIEVE_USER_ID_SQL_STATEMENT = """
+SELECT id AS user_lookup_id, user_id, status
+FROM user_lookups
+WHERE public_user_id = %(public_user_id)s;"""
+
+# Resolve the user, inactivate their prior active observation for the prompt (if there is one), add the new observation, and tell the other workers to evict the user's cached data,
+# all in one statement (one round trip, and atomic: if any part fails, none of it happens). Returns one row, with observation_id NULL (nothing written) unless user_lookup_count is 1
+# sql_params = {'public_user_id': ..., 'observation_prompt_id': ..., 'observation': ..., 'observation_formatted': ..., 'visibility': ...} plus get_cache_invalidation_sql_params()
+SUBMIT_OBSERVATION_SQL_STATEMENT = """
+-- How many users the public_user_id maps to (returned, so a duplicated public_user_id gets its own error, as in retrieve_user_id_from_public_user_id())
+WITH user_lookup_count AS (
+SELECT count(*) AS user_lookup_count
+FROM user_lookups
+WHERE public_user_id = %(public_user_id)s
+),
+
+-- The user associated with the public_user_id (only if exactly one)
+identified_user AS (
+SELECT ul.user_id
+FROM user_lookups ul, user_lookup_count ulc
+WHERE 
+	ul.public_user_id = %(public_user_id)s AND
+	ulc.user_lookup_count = 1
+),
+
+-- Set the prior observation (if it exists) to status = 'inactive'
+prior_observation AS (
+UPDATE observations o
+SET status = 'inactive'
+FROM identified_user iu
+WHERE 
+	o.user_id = iu.user_id AND
+	o.observation_prompt_id = %(observation_prompt_id)s AND
+	o.status = 'active' -- we only want to set any active observation to inactive
+RETURNING o.id
+),
+
+-- Add the new observation
+new_observation AS (
+INSERT INTO observations(user_id, observation_prompt_id, observation, observation_formatted, visibility)
+SELECT iu.user_id, %(observation_prompt_id)s, %(observation)s, %(observation_formatted)s, %(visibility)s
+FROM identified_user iu
+RETURNING id, user_id
+),
+
+-- Tell the other workers to evict this user's cached data (delivered only if the statement commits; see cache_invalidation_functions.py)
+cache_invalidation AS (
+SELECT pg_notify(%(cache_invalidation_channel)s, json_build_object('origin_worker_id', %(cache_invalidation_origin_worker_id)s::text, 'keys', json_build_object('public_user_id', %(public_user_id)s::text, 'user_id', no.user_id))::text)
+FROM new_observation no
+)
+
+SELECT
+	ulc.user_lookup_count,
+	no.id AS observation_id,
+	no.user_id,
+	ARRAY(SELECT po.id FROM prior_observation po) AS prior_observation_ids,
+	(SELECT count(*) FROM cache_invalidation) AS cache_invalidations_published -- referencing the CTE is what runs it
+FROM user_lookup_count ulc
+LEFT JOIN new_observation no ON true;"""
+
+# Several observations for one (already resolved) user in one statement: the same inactivate / insert as SUBMIT_OBSERVATION_SQL_STATEMENT, set-based over the unnested arrays
+# Items whose observation_prompt_id doesn't exist are skipped (no row returned for them); each observation_prompt_id appears at most once (see async_submit_observations())
+# Ids are text (e.g., '66cb527749c57fb78d6f'), as are the arrays; returns one row per observation added, with the item's position in the arrays (item_index, from 1)
+# sql_params = {'user_id': ..., 'public_user_id': ..., 'observation_prompt_ids': [...], 'observations': [...], 'observations_formatted': [...], 'visibilities': [...]} plus get_cache_invalidation_sql_params()
+SUBMIT_OBSERVATIONS_SQL_STATEMENT = """
+-- The submitted observations, for observation prompts that exist
+WITH submitted_observations AS (
+SELECT
+	so.item_index,
+	op.id AS observation_prompt_id,
+	so.observation,
+	so.observation_formatted,
+	so.visibility
+FROM 
+	unnest(%(observation_prompt_ids)s::text[], %(observations)s::text[], %(observations_formatted)s::text[], %(visibilities)s::text[]) WITH ORDINALITY AS so(observation_prompt_id, observation, observation_formatted, visibility, item_index),
+	observation_prompts op
+WHERE 
+	op.id = so.observation_prompt_id
+),
+
+-- Set the prior observations (if they exist) to status = 'inactive'
+prior_observations AS (
+UPDATE observations o
+SET status = 'inactive'
+WHERE 
+	o.user_id = %(user_id)s AND
+	o.observation_prompt_id IN (SELECT observation_prompt_id FROM submitted_observations) AND
+	o.status = 'active' -- we only want to set any active observation to inactive
+RETURNING o.id, o.observation_prompt_id
+),
+
+-- Add the new observations
+new_observations AS (
+INSERT INTO observations(user_id, observation_prompt_id, observation, observation_formatted, visibility)
+SELECT %(user_id)s, so.observation_prompt_id, so.observation, so.observation_formatted, so.visibility
+FROM submitted_observations so
+ORDER BY so.item_index
+RETURNING id, observation_prompt_id
+),
+
+-- Tell the other workers to evict this user's cached data, once (delivered only if the statement commits; see cache_invalidation_functions.py)
+cache_invalidation AS (
+SELECT pg_notify(%(cache_invalidation_channel)s, json_build_object('origin_worker_id', %(cache_invalidation_origin_worker_id)s::text, 'keys', json_build_object('public_user_id', %(public_user_id)s::text, 'user_id', %(user_id)s::text))::text)
+WHERE EXISTS (SELECT 1 FROM new_observations)
+)
+
+SELECT
+	so.item_index,
+	no.id AS observation_id,
+	ARRAY(SELECT po.id FROM prior_observations po WHERE po.observation_prompt_id = so.observation_prompt_id) AS prior_observation_ids,
+	(SELECT count(*) FROM cache_invalidation) AS cache_invalidations_published -- referencing the CTE is what runs it
+FROM 
+	submitted_observations so,
+	new_observations no
+WHERE
+	no.observation_prompt_id = so.observation_prompt_id
+ORDER BY so.item_index;"""
+
+MAX_OBSERVATIONS_PER_SUBMISSION = 50
+
+# Prepared once per pooled connection rather than parsed / planned on every submission
+register_prepared_statement(statement_name="retrieve_user_id", sql_statement=RETRIEVE_USER_ID_SQL_STATEMENT)
+register_prepared_statement(statement_name="submit_observation", sql_statement=SUBMIT_OBSERVATION_SQL_STATEMENT)
+register_prepared_statement(statement_name="submit_observations", sql_statement=SUBMIT_OBSERVATIONS_SQL_STATEMENT)
+
+# %% Format user_id dictionary (shared by retrieve_user_id_from_public_user_id() and async_retrieve_user_id_from_public_user_id())
+
+def format_user_id_dict(rows, public_user_id, logger):
+
+    # Raise error if multiple user_ids found
+    if len(rows) > 1:
+        raise ValueError(f"Multiple user_ids found for public_user_id: {public_user_id}")
+    
+    # Format return dictionary
+    if len(rows) == 0:
+
+        logger.info(f"retrieve_user_id_from_public_user_id(): no user_id found")
+
+        dict_return = {
+            "user_lookup_id": None,
+            "user_id": None,
+            "status": None}
+        
+    elif len(rows) == 1:
+        logger.info(f"retrieve_user_id_from_public_user_id(): user_id found")
+        dict_return = {
+            "user_lookup_id": rows[0].user_lookup_id,
+            "user_id": rows[0].user_id,
+            "status": rows[0].status}
+    
+    return dict_return
 
 # %% Retrieve user_id
+# Served from the user lookup cache when we can (including recent misses; see user_lookup_cache_functions.py)
 
 def retrieve_user_id_from_public_user_id(
         public_user_id,
@@ -19,38 +177,23 @@ def retrieve_user_id_from_public_user_id(
     
     try:
 
+        dict_user_id = get_cached_user_lookup(public_user_id)
+        if dict_user_id is not None:
+            logger.info(f"retrieve_user_id_from_public_user_id(): cached lookup")
+            return dict_user_id
+
+        cache_generation = get_user_lookup_cache_generation(public_user_id) # before the query, so an invalidation while we query isn't overwritten with stale data
+
         # Define sql query (use parameters rather than f-string to avoid SQL injection)
         sql_params = {'public_user_id': public_user_id}
-        sql_statement = """
-SELECT id AS user_lookup_id, user_id, status
-FROM user_lookups
-WHERE public_user_id = %(public_user_id)s;"""
 
         # Execute sql query
-        df = execute_sql_return_df(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger)
+        rows = execute_prepared_sql_return_rows(statement_name="retrieve_user_id", sql_params=sql_params, db_conn=db_conn, logger=logger)
 
-        # Raise error if multiple user_ids found
-        if len(df) > 1:
-            raise ValueError(f"Multiple user_ids found for public_user_id: {public_user_id}")
-        
-        # Format return dictionary
-        if len(df) == 0:
-
-            logger.info(f"retrieve_user_id_from_public_user_id(): no user_id found")
-
-            dict_return = {
-                "user_lookup_id": None,
-                "user_id": None,
-                "status": None}
-            
-        elif len(df) == 1:
-            logger.info(f"retrieve_user_id_from_public_user_id(): user_id found")
-            dict_return = {
-                "user_lookup_id": df['user_lookup_id'].iloc[0],
-                "user_id": df['user_id'].iloc[0],
-                "status": df['status'].iloc[0]}
-        
-        return dict_return
+        dict_user_id = format_user_id_dict(rows=rows, public_user_id=public_user_id, logger=logger)
+        cache_user_lookup(public_user_id=public_user_id, dict_user_id=dict_user_id, cache_generation=cache_generation)
+
+        return dict_user_id
     
     # Catch any exceptions as we tried to execute the function
     except Exception as e:
@@ -63,14 +206,47 @@ WHERE public_user_id = %(public_user_id)s;"""
         honeybadger.notify(error_class=error_class, error_message=error_message)
     
 
-# %% Submit observation
+# %% Submit observation (shared by submit_observation() and async_submit_observation())
+
+def format_submit_observation_params(public_user_id, observation_prompt_id, visibility, observation):
+
+    return {
+        'public_user_id': public_user_id,
+        'observation_prompt_id': observation_prompt_id,
+        'visibility': visibility,
+        'observation': observation,
+        'observation_formatted': render_text(observation), # render the curly quotes once, here, rather than on every experimenter log read
+        **get_cache_invalidation_sql_params()}
+
+# Turns the row returned by SUBMIT_OBSERVATION_SQL_STATEMENT into the response (raises if the public_user_id wasn't found / isn't unique, i.e., nothing was written)
+def format_submit_observation_response(rows, public_user_id, observation_prompt_id, logger):
+
+    # Raise error if multiple user_ids found
+    if rows[0].user_lookup_count > 1:
+        raise ValueError(f"Multiple user_ids found for public_user_id: {public_user_id}")
+
+    if rows[0].observation_id is None:
+        raise ValueError(f"user_id not found for public_user_id: {public_user_id}")
+
+    if len(rows[0].prior_observation_ids) > 0:
+        logger.info(f"Updated prior observation to status = 'inactive' for observation_id: {rows[0].prior_observation_ids[0]}")
+    else:
+        logger.info("No prior observation to update to status = 'inactive'")
+
+    logger.info(f"Success: created new observation for public_user_id: {public_user_id} and observation_prompt_id: {observation_prompt_id}")
+
+    record_cache_invalidations_published(rows[0].cache_invalidations_published)
+    record_write(routing_key=public_user_id) # keep this user's experimenter log reads on the primary until the replicas have the new observation
+    invalidate_experimenter_log_cache(public_user_id) # the cached experimenter log doesn't have the new observation
+
+    return {"status": "success", "observation_id": rows[0].observation_id, "prior_observation_ids": list(rows[0].prior_observation_ids)}
 
 def submit_observation(
         public_user_id, 
         observation_prompt_id, 
         visibility, 
         observation, 
-        db_connection_parameters,
+        db_pool,
         logger):
     
     try:
@@ -78,141 +254,207 @@ def submit_observation(
         # %%% Setup database connection
 
         db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
-        db_conn = create_db_connection(db_connection_parameters, logger)
+        db_conn = db_pool.getconn() # check out a connection from the shared pool (created once in main.py)
 
-        # %%% Retrive user_id from public_user_id
+        # %%% Retrive user_id, inactivate the prior observation, and add the new observation in one statement (see SUBMIT_OBSERVATION_SQL_STATEMENT)
+        # If anything fails (including the insert), nothing is written, so the prior observation stays active
 
-        logger.info(f"Calling retrieve_user_id_from_public_user_id() for public_user_id: {public_user_id}")
+        logger.info(f"Submit observation for public_user_id: {public_user_id} and observation_prompt_id: {observation_prompt_id}")
 
-        dict_user_id = retrieve_user_id_from_public_user_id(
-            public_user_id=public_user_id,
-            db_conn=db_conn,
-            logger=logger)
-        
-        user_id = dict_user_id['user_id']
-        
-        # If user_id not found, return error message
-        if user_id is None:
+        sql_params = format_submit_observation_params(public_user_id=public_user_id, observation_prompt_id=observation_prompt_id, visibility=visibility, observation=observation)
 
-            raise ValueError(f"user_id not found for public_user_id: {public_user_id}")
+        rows = execute_prepared_sql_return_rows(statement_name="submit_observation", sql_params=sql_params, db_conn=db_conn, logger=logger)
 
-        # %%% Update prior observation (if it exists) to status = 'inactive' and save observation_id
+        return format_submit_observation_response(rows=rows, public_user_id=public_user_id, observation_prompt_id=observation_prompt_id, logger=logger)
+    
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
 
-        logger.info(f"Update prior observation (if it exists) to status = 'inactive' and save observation_id")
+        error_class = f"API | submit_observation()"
+        error_message = f"public_user_id: {public_user_id}, observation_prompt_id: {observation_prompt_id}, visibility: {visibility}, observation: {observation}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
 
-        # Define sql query
-        sql_params = {
-            'user_id': user_id,
-            'observation_prompt_id': observation_prompt_id}
-        sql_statement = """
-UPDATE observations
-SET status = 'inactive'
-WHERE 
-	user_id = %(user_id)s AND
-	observation_prompt_id = %(observation_prompt_id)s AND
-	status = 'active' -- we only want to set any active observation to inactive
-RETURNING id AS observation_id;"""
+        return {"status": "failure"}
+    
+    finally:
+
+        # Return database connection to the pool if we checked one out
+        if db_conn is not None:
+            db_pool.putconn(db_conn)   
+    
+    
+
+
+# %% Retrieve user_id (async)
+# Awaitable counterpart of retrieve_user_id_from_public_user_id() (db_conn is a connection from the async pool)
+
+async def async_retrieve_user_id_from_public_user_id(
+        public_user_id,
+        db_conn,
+        logger):
+    
+    try:
+
+        dict_user_id = get_cached_user_lookup(public_user_id)
+        if dict_user_id is not None:
+            logger.info(f"retrieve_user_id_from_public_user_id(): cached lookup")
+            return dict_user_id
+
+        cache_generation = get_user_lookup_cache_generation(public_user_id) # before the query, so an invalidation while we query isn't overwritten with stale data
+
+        # Define sql query (use parameters rather than f-string to avoid SQL injection)
+        sql_params = {'public_user_id': public_user_id}
 
         # Execute sql query
-        df = execute_sql_return_df(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger)
+        rows = await async_execute_prepared_sql_return_rows(statement_name="retrieve_user_id", sql_params=sql_params, db_conn=db_conn, logger=logger)
 
-        # Store observation_id if an update was made
-        if len(df) > 0:
-            
-            observation_id = df['observation_id'].iloc[0]
+        dict_user_id = format_user_id_dict(rows=rows, public_user_id=public_user_id, logger=logger)
+        cache_user_lookup(public_user_id=public_user_id, dict_user_id=dict_user_id, cache_generation=cache_generation)
 
-            logger.info(f"Updated prior observation to status = 'inactive' for observation_id: {observation_id}")
+        return dict_user_id
+    
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
 
-        else:
+        error_class = f"API | async_retrieve_user_id_from_public_user_id()"
+        error_message = f"Error for public_user_id ={public_user_id}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+    
 
-            logger.info("No prior observation to update to status = 'inactive'")
 
-            observation_id = None
+# %% Submit observation (async)
+# Awaitable counterpart of submit_observation() for our async endpoints (doesn't block the event loop while waiting on the database)
 
-        # %%% Add new observation to database
+async def async_submit_observation(
+        public_user_id, 
+        observation_prompt_id, 
+        visibility, 
+        observation, 
+        async_db_pool,
+        logger):
+    
+    try:
 
-        logger.info(f"Add new observation to database")
+        # %%% Check out a database connection from the async pool (returned to the pool at the end of the with block)
 
-        # Define sql query
-        sql_params = {
-            'user_id': user_id,
-            'observation_prompt_id': observation_prompt_id,
-            'visibility': visibility,
-            'observation': observation}
-        sql_statement = """
-INSERT INTO observations(user_id, observation_prompt_id, observation, visibility)
-VALUES (%(user_id)s, %(observation_prompt_id)s, %(observation)s, %(visibility)s);"""
+        async with async_db_pool.connection() as db_conn:
 
-        # Execute sql query
-        response = execute_sql_return_status_message(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger)
+            # %%% Retrive user_id, inactivate the prior observation, and add the new observation in one statement (see SUBMIT_OBSERVATION_SQL_STATEMENT)
+            # If anything fails (including the insert), nothing is written, so the prior observation stays active
+
+            logger.info(f"Submit observation for public_user_id: {public_user_id} and observation_prompt_id: {observation_prompt_id}")
+
+            sql_params = format_submit_observation_params(public_user_id=public_user_id, observation_prompt_id=observation_prompt_id, visibility=visibility, observation=observation)
+
+            rows = await async_execute_prepared_sql_return_rows(statement_name="submit_observation", sql_params=sql_params, db_conn=db_conn, logger=logger)
+
+        return format_submit_observation_response(rows=rows, public_user_id=public_user_id, observation_prompt_id=observation_prompt_id, logger=logger)
+    
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | async_submit_observation()"
+        error_message = f"public_user_id: {public_user_id}, observation_prompt_id: {observation_prompt_id}, visibility: {visibility}, observation: {observation}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure"}
+
+
+# %% Submit several observations for one user (async)
+# observations: list of {"observation_prompt_id", "visibility", "observation"}; the user is resolved once (from the user lookup cache if we can) and every observation is written in one statement
+# Returns {"status": "success", "observations": [one {"status": ...} per item, in order]} (items can fail on their own, e.g., an unknown observation_prompt_id),
+# or {"status": "failure"} if nothing could be written (e.g., unknown public_user_id)
+# If an observation_prompt_id appears more than once, the last item wins (as if they'd been submitted one at a time) and the earlier ones fail as superseded
+
+async def async_submit_observations(
+        public_user_id,
+        observations,
+        async_db_pool,
+        logger):
 
-        # %%% Success creating new observation
-        if (response["status"] == "success" and 
-            response["status_message"] == "INSERT 0 1"):
+    try:
 
-            logger.info(f"Success: created new observation for public_user_id: {public_user_id} and observation_prompt_id: {observation_prompt_id}")
+        if not 1 <= len(observations) <= MAX_OBSERVATIONS_PER_SUBMISSION:
+            raise ValueError(f"Submissions must have between 1 and {MAX_OBSERVATIONS_PER_SUBMISSION} observations, not: {len(observations)}")
 
-            return {"status": "success"}
+        # Items for observation prompts that appear again later in the submission are superseded
+        last_item_indexes = {dict_observation["observation_prompt_id"]: item_index for item_index, dict_observation in enumerate(observations)}
+        item_indexes = [item_index for item_index, dict_observation in enumerate(observations) if last_item_indexes[dict_observation["observation_prompt_id"]] == item_index]
 
-        # %%% Failure creating new observation
-        else:
+        async with async_db_pool.connection() as db_conn:
 
-            logger.info(f"Failure: did not create new observation for public_user_id: {public_user_id} and observation_prompt_id: {observation_prompt_id}")
+            # %%% Retrive user_id from public_user_id (once for the whole submission)
 
-            # If we set original observation to inactive, set it back to active since we did not create a new observation
-            try:
+            logger.info(f"Calling retrieve_user_id_from_public_user_id() for public_user_id: {public_user_id}")
 
-                if observation_id is not None:
+            dict_user_id = await async_retrieve_user_id_from_public_user_id(
+                public_user_id=public_user_id,
+                db_conn=db_conn,
+                logger=logger)
 
-                    # Define sql query
-                    sql_params = {
-                        'observation_id': observation_id}
-                    sql_statement = """
-UPDATE observations
-SET status = 'active'
-WHERE id = %(observation_id)s;"""
+            user_id = dict_user_id['user_id']
 
-                    # Execute sql query
-                    response = execute_sql_return_status_message(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger)
+            # If user_id not found, return error message
+            if user_id is None:
 
-                    # Success
-                    if (response["status"] == "success" and 
-                        response["status_message"] == "UPDATE 1"):
+                raise ValueError(f"user_id not found for public_user_id: {public_user_id}")
 
-                        logger.info(f"Success: updated original observation back to status = 'active' for observation_id: {observation_id}")
+            # %%% Inactivate the prior observations and add the new ones in one statement (see SUBMIT_OBSERVATIONS_SQL_STATEMENT)
+            # If anything fails, nothing is written, so the prior observations stay active
 
-                    # Failure
-                    if (response["status"] == "failure"):
+            logger.info(f"Submit {len(item_indexes)} observations for public_user_id: {public_user_id}")
 
-                        raise ValueError(f"Failure: did not update original observation back to status = 'active' for observation_id: {observation_id}")
+            sql_params = {
+                'user_id': user_id,
+                'public_user_id': public_user_id,
+                'observation_prompt_ids': [observations[item_index]["observation_prompt_id"] for item_index in item_indexes],
+                'observations': [observations[item_index]["observation"] for item_index in item_indexes],
+                'observations_formatted': [render_text(observations[item_index]["observation"]) for item_index in item_indexes], # render the curly quotes once, here, rather than on every experimenter log read
+                'visibilities': [observations[item_index]["visibility"] for item_index in item_indexes],
+                **get_cache_invalidation_sql_params()}
 
-            except Exception as e:
+            rows = await async_execute_prepared_sql_return_rows(statement_name="submit_observations", sql_params=sql_params, db_conn=db_conn, logger=logger)
 
-                error_class = f"API | submit_observation()"
-                error_message = f"Error: {e}"
-                logger.error(error_message)
-                logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
-                honeybadger.notify(error_class=error_class, error_message=error_message)
+        # %%% Success (statement committed): match the rows back to the items (item_index counts from 1 over the items we sent)
+
+        logger.info(f"Success: created {len(rows)} new observations for public_user_id: {public_user_id}")
+
+        if len(rows) > 0:
+            record_cache_invalidations_published(rows[0].cache_invalidations_published)
+            record_write(routing_key=public_user_id) # keep this user's experimenter log reads on the primary until the replicas have the new observations
+            invalidate_experimenter_log_cache(public_user_id) # the cached experimenter log doesn't have the new observations
+
+        dict_results = {item_indexes[row.item_index - 1]: {"status": "success", "observation_id": row.observation_id, "prior_observation_ids": list(row.prior_observation_ids)} for row in rows}
+
+        list_results = []
+        for item_index, dict_observation in enumerate(observations):
+
+            if item_index in dict_results:
+                list_results.append(dict_results[item_index])
+            elif last_item_indexes[dict_observation["observation_prompt_id"]] != item_index:
+                list_results.append({"status": "failure", "error_message": f"superseded by a later observation for observation_prompt_id: {dict_observation['observation_prompt_id']}"})
+            else:
+                list_results.append({"status": "failure", "error_message": f"observation_prompt_id not found: {dict_observation['observation_prompt_id']}"})
+
+        return {"status": "success", "observations": list_results}
 
-            return {"status": "failure"}
-    
     # Catch any exceptions as we tried to execute the function
     except Exception as e:
 
-        error_class = f"API | submit_observation()"
-        error_message = f"public_user_id: {public_user_id}, observation_prompt_id: {observation_prompt_id}, visibility: {visibility}, observation: {observation}; Error: {e}"
+        error_class = f"API | async_submit_observations()"
+        error_message = f"public_user_id: {public_user_id}, observations: {observations}; Error: {e}"
         logger.error(error_class)
         logger.error(error_message)
         logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
         honeybadger.notify(error_class=error_class, error_message=error_message)
 
         return {"status": "failure"}
-    
-    finally:
-
-        # Close database connection if it exists    
-        if db_conn is not None:
-            db_conn.close()   
-    
-    
-
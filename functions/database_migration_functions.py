@@ -0,0 +1,149 @@
+from honeybadger import honeybadger
+import traceback
+
+# Custom imports
+from postgresql_db_functions import execute_sql_return_status_message, execute_sql_return_rows, executemany_sql_return_status_message, transaction
+from text_rendering_functions import render_text
+
+# %% Database Migrations Overview
+
+# Schema changes the functions in functions/ depend on, with any backfills they need
+# Each migration is idempotent (safe to run again) and backward compatible (code written before it keeps working), so run it before deploying the code that uses it
+
+# ## Sample Use
+
+# db_pool = create_db_connection_pool(db_connection_parameters = db_connection_parameters, logger = logger)
+# db_conn = db_pool.getconn()
+# apply_database_migration(migration_name = "add_observation_formatted", db_conn = db_conn, logger = logger)
+# backfill_observation_formatted(db_conn = db_conn, logger = logger)
+# db_pool.putconn(db_conn)
+
+DATABASE_MIGRATIONS = {
+
+    # Observations rendered with HTML "curly" quotes when they're written (see text_rendering_functions.py); NULL until backfilled
+    "add_observation_formatted": """
+ALTER TABLE observations ADD COLUMN IF NOT EXISTS observation_formatted text;""",
+
+    # Token buckets shared by every worker when THROTTLE_BACKEND=postgres (see throttle_functions.py); unlogged, as losing them on a crash only resets the throttle
+    "create_throttle_buckets": """
+CREATE UNLOGGED TABLE IF NOT EXISTS throttle_buckets (
+	bucket_key text PRIMARY KEY,
+	tokens double precision NOT NULL,
+	updated_at timestamptz NOT NULL);""",
+
+    # Change cursor for experimenter log delta sync (see async_get_experimenter_log_changes()): every insert / relevant update of an observation or sub_group_action
+    # takes the next value of one sequence, so "what changed since change_seq N" is an indexed range scan. Rows written before this migration keep change_seq NULL (they predate every cursor)
+    # The trigger holds a per-user advisory lock (shared) until the write commits; the delta read takes it exclusively, so it never hands out a cursor past a change that hasn't committed yet
+    # sub_group_actions only take a change_seq (and the lock) when they start / stop being displayed or a displayed one moves, so the scheduler's bulk status updates
+    # (message_to_be_scheduled -> message_scheduled, etc.; see schedule_messages()) don't take a lock per user or hold up delta reads
+    # (re-running this migration replaces the triggers of an earlier version)
+    # Several statements (and a $$ function body), so run it without sql_params
+    "add_experimenter_log_change_seq": """
+CREATE SEQUENCE IF NOT EXISTS experimenter_log_change_seq;
+
+ALTER TABLE observations ADD COLUMN IF NOT EXISTS change_seq bigint;
+ALTER TABLE sub_group_actions ADD COLUMN IF NOT EXISTS change_seq bigint;
+
+CREATE OR REPLACE FUNCTION set_experimenter_log_change_seq() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_advisory_xact_lock_shared(hashtext('experimenter_log_changes:' || NEW.user_id::text));
+	NEW.change_seq := nextval('experimenter_log_change_seq');
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS observations_change_seq ON observations;
+CREATE TRIGGER observations_change_seq BEFORE INSERT OR UPDATE OF status, observation ON observations
+FOR EACH ROW EXECUTE FUNCTION set_experimenter_log_change_seq();
+
+DROP TRIGGER IF EXISTS sub_group_actions_change_seq ON sub_group_actions;
+DROP TRIGGER IF EXISTS sub_group_actions_insert_change_seq ON sub_group_actions;
+CREATE TRIGGER sub_group_actions_insert_change_seq BEFORE INSERT ON sub_group_actions
+FOR EACH ROW WHEN (NEW.status = 'display_after_action_datetime')
+EXECUTE FUNCTION set_experimenter_log_change_seq();
+
+DROP TRIGGER IF EXISTS sub_group_actions_update_change_seq ON sub_group_actions;
+CREATE TRIGGER sub_group_actions_update_change_seq BEFORE UPDATE OF status, action_datetime ON sub_group_actions
+FOR EACH ROW WHEN (
+	(OLD.status IS DISTINCT FROM NEW.status AND 'display_after_action_datetime' IN (OLD.status, NEW.status)) OR
+	(NEW.status = 'display_after_action_datetime' AND OLD.action_datetime IS DISTINCT FROM NEW.action_datetime))
+EXECUTE FUNCTION set_experimenter_log_change_seq();
+
+CREATE INDEX IF NOT EXISTS observations_user_id_change_seq_idx ON observations (user_id, change_seq);
+CREATE INDEX IF NOT EXISTS sub_group_actions_user_id_change_seq_idx ON sub_group_actions (user_id, change_seq);""",
+
+    # Idempotency-Key results shared by every worker when IDEMPOTENCY_BACKEND=postgres (see idempotency_functions.py); response is NULL while the first request is still running
+    # Several statements, so run it without sql_params
+    "create_idempotency_keys": """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+	scope text NOT NULL,
+	idempotency_key text NOT NULL,
+	request_fingerprint text NOT NULL,
+	response jsonb,
+	created_at timestamptz NOT NULL,
+	expires_at timestamptz NOT NULL,
+	PRIMARY KEY (scope, idempotency_key));
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);""",
+}
+
+
+# %% Apply a migration
+def apply_database_migration(migration_name, db_conn, logger):
+
+    logger.info(f"Applying database migration: {migration_name}")
+
+    with transaction(db_conn=db_conn, logger=logger):
+        response = execute_sql_return_status_message(sql_statement=DATABASE_MIGRATIONS[migration_name], sql_params=None, db_conn=db_conn, logger=logger, statement_name=f"migration_{migration_name}")
+
+    logger.info(f"Applied database migration: {migration_name}; response: {response}")
+
+    return response
+
+
+# %% Backfill observations.observation_formatted for observations written before it existed
+# Works in batches (one short transaction each) so it doesn't hold locks on observations for long; the read path renders any rows it hasn't reached yet
+def backfill_observation_formatted(db_conn, logger, batch_size=1000):
+
+    observations_backfilled = 0
+
+    try:
+
+        while True:
+
+            with transaction(db_conn=db_conn, logger=logger):
+
+                rows = execute_sql_return_rows(
+                    sql_statement="SELECT id AS observation_id, observation FROM observations WHERE observation_formatted IS NULL LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED;",
+                    sql_params={"batch_size": batch_size},
+                    db_conn=db_conn,
+                    logger=logger,
+                    statement_name="backfill_observation_formatted_select")
+
+                if len(rows) == 0:
+                    break
+
+                executemany_sql_return_status_message(
+                    sql_statement="UPDATE observations SET observation_formatted = %s WHERE id = %s;",
+                    tuples=[(render_text(row.observation), row.observation_id) for row in rows],
+                    db_conn=db_conn,
+                    logger=logger,
+                    statement_name="backfill_observation_formatted_update")
+
+            observations_backfilled += len(rows)
+            logger.info(f"Backfilled observation_formatted for {observations_backfilled} observations")
+
+        logger.info(f"Finished backfilling observation_formatted ({observations_backfilled} observations)")
+
+        return {"status": "success", "observations_backfilled": observations_backfilled}
+
+    # Catch any exceptions as we tried to execute the function
+    except Exception as e:
+
+        error_class = f"API | backfill_observation_formatted()"
+        error_message = f"Error backfilling observation_formatted; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "observations_backfilled": observations_backfilled}
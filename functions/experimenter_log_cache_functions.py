@@ -0,0 +1,112 @@
+from datetime import datetime
+import pytz
+
+# Custom imports
+from cache_invalidation_functions import register_cache_invalidation_handler
+from lru_cache_functions import InvalidatableLRUCache
+
+# %% Experimenter Log Cache Overview
+
+# Most /v1/experimenter-log/ traffic is repeat visits after the weekly email, and a user's log only changes when:
+# (a) they submit an observation (submit_observation() invalidates their entry), or
+# (b) one of their sub_group_actions' action_datetime passes and a new week of experiments unlocks (entries expire at the user's next action_datetime)
+# so we keep the shaped dict_response per public_user_id in memory (per worker process) rather than rebuilding it from Postgres on every page load
+# Entries also expire after max_ttl_seconds (catches changes made outside the API, e.g., in the database directly) and the least recently used entries are evicted past max_entries
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_experimenter_log_cache(max_entries = 10000, max_ttl_seconds = 300)
+
+# # Look up / store a response (get_experimenter_log_data() does this); capture the generation before querying so an invalidation during the query isn't overwritten
+# cache_generation = get_experimenter_log_cache_generation(public_user_id)
+# dict_response = get_cached_experimenter_log(public_user_id)
+# cache_experimenter_log(public_user_id, dict_response, next_display_datetime, cache_generation, etag)
+
+# # ETag of the cached response (lets the endpoint answer If-None-Match without a query)
+# get_cached_experimenter_log_etag(public_user_id)
+
+# # After a write (other workers evict the entry when they receive the write's invalidation; see cache_invalidation_functions.py)
+# invalidate_experimenter_log_cache(public_user_id)
+
+# # Hit / miss / eviction counters
+# get_experimenter_log_cache_metrics()
+
+experimenter_log_cache_settings = {
+    "enabled": True,
+    "max_entries": 10000,
+    "max_ttl_seconds": 300}
+
+# A response that took longer than this to build (from get_experimenter_log_cache_generation() to cache_experimenter_log()) isn't cached,
+# so we only have to remember invalidations for this long to tell whether one happened while the response was being built
+EXPERIMENTER_LOG_CACHE_MAX_BUILD_SECONDS = 60
+
+# public_user_id -> (dict_response, etag); LRU eviction, expiry, and invalidation tracking are in lru_cache_functions.py
+_experimenter_log_cache = InvalidatableLRUCache(max_entries=experimenter_log_cache_settings["max_entries"], max_build_seconds=EXPERIMENTER_LOG_CACHE_MAX_BUILD_SECONDS)
+
+
+# %% Configure the cache
+def configure_experimenter_log_cache(enabled=True, max_entries=10000, max_ttl_seconds=300):
+
+    experimenter_log_cache_settings["enabled"] = enabled
+    experimenter_log_cache_settings["max_entries"] = max_entries
+    experimenter_log_cache_settings["max_ttl_seconds"] = max_ttl_seconds
+
+    _experimenter_log_cache.configure(enabled=enabled, max_entries=max_entries)
+
+
+# %% Look up a cached response (None on a miss)
+# The cached dict_response is shared between requests, so callers must not modify it
+def get_cached_experimenter_log(public_user_id):
+
+    cache_entry = _experimenter_log_cache.get(public_user_id)
+
+    return cache_entry[0] if cache_entry is not None else None
+
+# The ETag stored with a user's cached response (None if there's no unexpired entry); doesn't count as a hit / miss or refresh the entry's recency
+def get_cached_experimenter_log_etag(public_user_id):
+
+    cache_entry = _experimenter_log_cache.peek(public_user_id)
+
+    return cache_entry[1] if cache_entry is not None else None
+
+
+# %% Store a response
+# next_display_datetime: the user's next (not yet passed) action_datetime (None if nothing else is scheduled to unlock)
+# cache_generation: get_experimenter_log_cache_generation() from before the query; if the user was invalidated since, the response may be stale so we don't store it
+# etag: the version of the response (see get_experimenter_log_etag()); None if the caller doesn't use ETags
+def get_experimenter_log_cache_generation(public_user_id):
+
+    return _experimenter_log_cache.get_generation()
+
+def cache_experimenter_log(public_user_id, dict_response, next_display_datetime, cache_generation, etag=None):
+
+    # Expire when the next week of experiments unlocks (or after max_ttl_seconds, whichever comes first)
+    ttl_seconds = experimenter_log_cache_settings["max_ttl_seconds"]
+    if next_display_datetime is not None:
+        ttl_seconds = min(ttl_seconds, (next_display_datetime - pytz.timezone('UTC').localize(datetime.utcnow())).total_seconds())
+
+    _experimenter_log_cache.put(public_user_id, (dict_response, etag), ttl_seconds=ttl_seconds, cache_generation=cache_generation)
+
+
+# %% Invalidate a user's cached response (e.g., after they submit an observation)
+def invalidate_experimenter_log_cache(public_user_id):
+
+    _experimenter_log_cache.invalidate(public_user_id)
+
+# Clear every cached response (e.g., when the invalidation listener reconnects and may have missed invalidations)
+def clear_experimenter_log_cache():
+
+    _experimenter_log_cache.clear()
+
+# Evict a user's entry when another worker handles their write
+register_cache_invalidation_handler(key_name="public_user_id", invalidation_handler=invalidate_experimenter_log_cache, clear_handler=clear_experimenter_log_cache)
+
+
+# %% Report on the cache
+def get_experimenter_log_cache_metrics():
+
+    metrics = _experimenter_log_cache.get_metrics()
+    metrics["hit_rate"] = metrics["hits"] / (metrics["hits"] + metrics["misses"]) if metrics["hits"] + metrics["misses"] > 0 else 0.0
+
+    return metrics
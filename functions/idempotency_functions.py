@@ -0,0 +1,362 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from honeybadger import honeybadger
+
+# Custom imports
+from async_postgresql_db_functions import async_execute_sql_return_rows, async_execute_sql_return_status_message
+
+# %% Idempotency Overview
+
+# Flaky mobile clients retry observation submissions, and every retry used to inactivate the observation it had just written and insert a duplicate.
+# A client can send an Idempotency-Key header (e.g., a UUID per submission, reused on its retries); the first request with a key runs and its result is stored,
+# and later requests with the same key get the stored result back without touching observations again
+# - a key is tied to the request it was first sent with (request_fingerprint); reusing it for a different request is rejected rather than replayed
+# - while the first request is still running, a retry is turned away (409) rather than run twice; if the first request fails, its key is released so a retry runs again
+# - only successful results are stored, for ttl_seconds; an abandoned claim (e.g., the worker died mid-request) can be taken over after lease_seconds
+# Keys live in memory per worker by default (so only retries that reach the same worker are deduplicated); PostgresIdempotencyBackend shares them across workers / instances
+# (idempotency_keys table, see database_migration_functions.py)
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_idempotency(enabled = True, ttl_seconds = 86400, backend = PostgresIdempotencyBackend(async_db_pool = async_db_pool))
+
+# # In an endpoint (idempotency_key is the Idempotency-Key header, None if the client didn't send one)
+# idempotent_request = await async_begin_idempotent_request(scope = "submit_observation", idempotency_key = idempotency_key, request_payload = payload, logger = logger)
+# if idempotent_request["status"] == "replay": return the stored idempotent_request["response"]
+# if idempotent_request["status"] in ["in_progress", "mismatch", "invalid"]: turn the request away
+# response = await async_submit_observation(...)
+# await async_finish_idempotent_request(idempotent_request = idempotent_request, response = response, logger = logger)
+
+# # Deduplicated requests, conflicts, etc.
+# get_idempotency_metrics()
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+IDEMPOTENCY_BACKEND_ATTEMPTS = 3 # storing / releasing a claim is retried on the backend that holds it (a claim made in the database can't be finished in memory)
+
+idempotency_settings = {
+    "enabled": True,
+    "ttl_seconds": 86400, # how long a result is replayed (mobile clients can queue retries for hours)
+    "lease_seconds": 60, # how long a claim blocks retries before we assume the request that made it is gone
+    "backend": None} # None keeps keys in memory (per worker); PostgresIdempotencyBackend shares them
+
+_idempotency_metrics = {"requests_with_key": 0, "executed": 0, "deduplicated": 0, "in_progress_conflicts": 0, "fingerprint_mismatches": 0, "invalid_keys": 0, "released": 0, "backend_errors": 0}
+_idempotency_lock = threading.Lock()
+
+
+# %% Key backends
+# claim() returns {"status": "claimed"} if this request should run (and holds the key for lease_seconds),
+# {"status": "completed", "response": ...} if the key already has a result, {"status": "in_progress"} if another request holds it, or {"status": "mismatch"} if it was used for a different request
+# complete() stores the response for ttl_seconds; release() drops a claim that didn't produce a result
+class InMemoryIdempotencyBackend:
+
+    def __init__(self, max_entries=100000):
+
+        self.entries = OrderedDict() # (scope, idempotency_key) -> {"request_fingerprint", "response", "expires_at"}; oldest first
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def claim_now(self, scope, idempotency_key, request_fingerprint, lease_seconds):
+
+        with self.lock:
+
+            now = time.monotonic()
+            entry = self.entries.get((scope, idempotency_key))
+
+            if entry is not None and now < entry["expires_at"]:
+
+                if entry["request_fingerprint"] != request_fingerprint:
+                    return {"status": "mismatch"}
+
+                if entry["response"] is None:
+                    return {"status": "in_progress"}
+
+                return {"status": "completed", "response": entry["response"]}
+
+            self.entries[(scope, idempotency_key)] = {"request_fingerprint": request_fingerprint, "response": None, "expires_at": now + lease_seconds}
+            self.entries.move_to_end((scope, idempotency_key))
+
+            # Drop the oldest keys if we're tracking too many (they're the least likely to be retried)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+            return {"status": "claimed"}
+
+    async def claim(self, scope, idempotency_key, request_fingerprint, lease_seconds, logger):
+
+        return self.claim_now(scope, idempotency_key, request_fingerprint, lease_seconds)
+
+    async def complete(self, scope, idempotency_key, request_fingerprint, response, ttl_seconds, logger):
+
+        with self.lock:
+
+            entry = self.entries.get((scope, idempotency_key))
+
+            if entry is not None and entry["request_fingerprint"] == request_fingerprint:
+                entry["response"] = response # shared with every replay, so callers must not modify it
+                entry["expires_at"] = time.monotonic() + ttl_seconds
+
+    async def release(self, scope, idempotency_key, request_fingerprint, logger):
+
+        with self.lock:
+
+            entry = self.entries.get((scope, idempotency_key))
+
+            if entry is not None and entry["request_fingerprint"] == request_fingerprint and entry["response"] is None:
+                del self.entries[(scope, idempotency_key)]
+
+# Shared across workers / instances (the claim is one statement, so concurrent retries can't both claim a key)
+class PostgresIdempotencyBackend:
+
+    # Insert the claim, or take over an expired key / abandoned claim; if the key is live, return what it holds instead
+    # (the SELECT sees the table as it was before the INSERT, so a claim made by a concurrent request that hasn't committed yet shows up as no row, i.e., in progress)
+    CLAIM_SQL_STATEMENT = """
+WITH claimed_key AS (
+INSERT INTO idempotency_keys (scope, idempotency_key, request_fingerprint, response, created_at, expires_at)
+VALUES (%(scope)s, %(idempotency_key)s, %(request_fingerprint)s, NULL, clock_timestamp(), clock_timestamp() + make_interval(secs => %(lease_seconds)s::double precision))
+ON CONFLICT (scope, idempotency_key) DO UPDATE SET
+	request_fingerprint = EXCLUDED.request_fingerprint,
+	response = NULL,
+	created_at = EXCLUDED.created_at,
+	expires_at = EXCLUDED.expires_at
+WHERE idempotency_keys.expires_at <= clock_timestamp()
+RETURNING 1
+)
+
+SELECT
+	EXISTS (SELECT 1 FROM claimed_key) AS claimed,
+	ik.request_fingerprint,
+	ik.response
+FROM (SELECT 1) AS one
+LEFT JOIN idempotency_keys ik ON
+	ik.scope = %(scope)s AND
+	ik.idempotency_key = %(idempotency_key)s;"""
+
+    COMPLETE_SQL_STATEMENT = """
+UPDATE idempotency_keys
+SET
+	response = %(response)s::jsonb,
+	expires_at = clock_timestamp() + make_interval(secs => %(ttl_seconds)s::double precision)
+WHERE
+	scope = %(scope)s AND
+	idempotency_key = %(idempotency_key)s AND
+	request_fingerprint = %(request_fingerprint)s;"""
+
+    RELEASE_SQL_STATEMENT = """
+DELETE FROM idempotency_keys
+WHERE
+	scope = %(scope)s AND
+	idempotency_key = %(idempotency_key)s AND
+	request_fingerprint = %(request_fingerprint)s AND
+	response IS NULL;"""
+
+    PRUNE_SQL_STATEMENT = """
+DELETE FROM idempotency_keys
+WHERE expires_at <= clock_timestamp();"""
+
+    def __init__(self, async_db_pool, prune_interval_seconds=600):
+
+        self.async_db_pool = async_db_pool
+        self.prune_interval_seconds = prune_interval_seconds # expired keys are ignored (and taken over) anyway; pruning just keeps the table small
+        self.last_pruned_at = time.monotonic()
+
+    async def claim(self, scope, idempotency_key, request_fingerprint, lease_seconds, logger):
+
+        sql_params = {"scope": scope, "idempotency_key": idempotency_key, "request_fingerprint": request_fingerprint, "lease_seconds": lease_seconds}
+
+        async with self.async_db_pool.connection() as db_conn:
+
+            rows = await async_execute_sql_return_rows(sql_statement=self.CLAIM_SQL_STATEMENT, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="idempotency_claim")
+
+            if time.monotonic() - self.last_pruned_at >= self.prune_interval_seconds:
+                self.last_pruned_at = time.monotonic()
+                await async_execute_sql_return_status_message(sql_statement=self.PRUNE_SQL_STATEMENT, sql_params=None, db_conn=db_conn, logger=logger, statement_name="idempotency_prune")
+
+        row = rows[0]
+
+        if row.claimed:
+            return {"status": "claimed"}
+
+        if row.request_fingerprint is None or (row.request_fingerprint == request_fingerprint and row.response is None):
+            return {"status": "in_progress"}
+
+        if row.request_fingerprint != request_fingerprint:
+            return {"status": "mismatch"}
+
+        return {"status": "completed", "response": row.response}
+
+    async def complete(self, scope, idempotency_key, request_fingerprint, response, ttl_seconds, logger):
+
+        sql_params = {"scope": scope, "idempotency_key": idempotency_key, "request_fingerprint": request_fingerprint, "response": json.dumps(response, default=str), "ttl_seconds": ttl_seconds}
+
+        async with self.async_db_pool.connection() as db_conn:
+            response = await async_execute_sql_return_status_message(sql_statement=self.COMPLETE_SQL_STATEMENT, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="idempotency_complete")
+
+        if response["status"] != "success":
+            raise Exception(f"Storing the response failed: {response['status_message']}")
+
+    async def release(self, scope, idempotency_key, request_fingerprint, logger):
+
+        sql_params = {"scope": scope, "idempotency_key": idempotency_key, "request_fingerprint": request_fingerprint}
+
+        async with self.async_db_pool.connection() as db_conn:
+            response = await async_execute_sql_return_status_message(sql_statement=self.RELEASE_SQL_STATEMENT, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="idempotency_release")
+
+        if response["status"] != "success":
+            raise Exception(f"Releasing the key failed: {response['status_message']}")
+
+_in_memory_backend = InMemoryIdempotencyBackend()
+
+
+# %% Configure idempotency
+def configure_idempotency(enabled=True, ttl_seconds=86400, lease_seconds=60, backend=None):
+
+    idempotency_settings["enabled"] = enabled
+    idempotency_settings["ttl_seconds"] = ttl_seconds
+    idempotency_settings["lease_seconds"] = lease_seconds
+    idempotency_settings["backend"] = backend
+
+# The same request sent again has the same fingerprint (request_payload: a JSON-serializable dictionary / list of what the request asks for)
+def get_request_fingerprint(request_payload):
+
+    return hashlib.sha256(json.dumps(request_payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+# Claim with the configured backend, falling back to memory if it errors (e.g., the database is unreachable) so idempotency never takes an endpoint down
+# Returns (claim, the backend that holds the key)
+async def _claim(logger, **kwargs):
+
+    backend = idempotency_settings["backend"]
+
+    if backend is not None:
+
+        try:
+
+            return await backend.claim(logger=logger, **kwargs), backend
+
+        except Exception as e:
+
+            with _idempotency_lock:
+                _idempotency_metrics["backend_errors"] += 1
+
+            error_class = f"API | _claim()"
+            error_message = f"Idempotency backend claim() failed, using in-memory keys; Error: {e}"
+            logger.error(error_message)
+            logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+            honeybadger.notify(error_class=error_class, error_message=error_message)
+
+    return await _in_memory_backend.claim(logger=logger, **kwargs), _in_memory_backend
+
+# Store / release a claim on the backend that holds it, retrying if it errors
+# If it still fails, the key stays claimed until its lease runs out (retries get 409 until then); the request's own result is unaffected, so we report the error rather than raise it
+async def _finish_claim(backend, method_name, logger, **kwargs):
+
+    for attempt in range(1, IDEMPOTENCY_BACKEND_ATTEMPTS + 1):
+
+        try:
+
+            return await getattr(backend, method_name)(logger=logger, **kwargs)
+
+        except Exception as e:
+
+            with _idempotency_lock:
+                _idempotency_metrics["backend_errors"] += 1
+
+            if attempt < IDEMPOTENCY_BACKEND_ATTEMPTS:
+                logger.warning(f"Idempotency backend {method_name}() failed (attempt {attempt} of {IDEMPOTENCY_BACKEND_ATTEMPTS}); Error: {e}")
+                await asyncio.sleep(0.1 * attempt)
+                continue
+
+            error_class = f"API | _finish_claim()"
+            error_message = f"Idempotency backend {method_name}() failed for scope: {kwargs['scope']}, idempotency_key: {kwargs['idempotency_key']}; the key stays claimed until its lease expires; Error: {e}"
+            logger.error(error_message)
+            logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+            honeybadger.notify(error_class=error_class, error_message=error_message)
+
+
+# %% Start an idempotent request (before doing any work)
+# Returns {"status": "proceed"} if the request should run (always, if there's no idempotency_key), {"status": "replay", "response": ...} if it already ran,
+# or {"status": "in_progress" / "mismatch" / "invalid"} if it should be turned away; pass the result to async_finish_idempotent_request() once the request has run
+async def async_begin_idempotent_request(scope, idempotency_key, request_payload, logger):
+
+    idempotent_request = {"status": "proceed", "scope": scope, "idempotency_key": None, "request_fingerprint": None}
+
+    if idempotency_key is None or not idempotency_settings["enabled"]:
+        return idempotent_request
+
+    with _idempotency_lock:
+        _idempotency_metrics["requests_with_key"] += 1
+
+    if not 1 <= len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+
+        logger.info(f"Invalid Idempotency-Key (must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters) for scope: {scope}")
+
+        with _idempotency_lock:
+            _idempotency_metrics["invalid_keys"] += 1
+
+        return {**idempotent_request, "status": "invalid"}
+
+    request_fingerprint = get_request_fingerprint(request_payload)
+
+    claim, backend = await _claim(logger, scope=scope, idempotency_key=idempotency_key, request_fingerprint=request_fingerprint, lease_seconds=idempotency_settings["lease_seconds"])
+
+    if claim["status"] == "claimed":
+        return {**idempotent_request, "idempotency_key": idempotency_key, "request_fingerprint": request_fingerprint, "backend": backend}
+
+    logger.info(f"Idempotency-Key {idempotency_key} for scope {scope}: {claim['status']}")
+
+    metric_names = {"completed": "deduplicated", "in_progress": "in_progress_conflicts", "mismatch": "fingerprint_mismatches"}
+    with _idempotency_lock:
+        _idempotency_metrics[metric_names[claim["status"]]] += 1
+
+    if claim["status"] == "completed":
+        return {**idempotent_request, "status": "replay", "response": claim["response"]}
+
+    return {**idempotent_request, "status": claim["status"]}
+
+# Store a successful response for replay, or release the key so a retry runs again (a no-op for requests without a key)
+# succeeded: whether the request wrote anything worth replaying (defaults to response["status"] == "success"; e.g., a bulk submission where every item failed should run again)
+async def async_finish_idempotent_request(idempotent_request, response, logger, succeeded=None):
+
+    if idempotent_request["idempotency_key"] is None:
+        return
+
+    if succeeded is None:
+        succeeded = response.get("status") == "success"
+
+    key_arguments = {"scope": idempotent_request["scope"], "idempotency_key": idempotent_request["idempotency_key"], "request_fingerprint": idempotent_request["request_fingerprint"]}
+
+    if succeeded:
+
+        await _finish_claim(idempotent_request["backend"], "complete", logger, response=response, ttl_seconds=idempotency_settings["ttl_seconds"], **key_arguments)
+
+        with _idempotency_lock:
+            _idempotency_metrics["executed"] += 1
+
+    else:
+
+        await _finish_claim(idempotent_request["backend"], "release", logger, **key_arguments)
+
+        with _idempotency_lock:
+            _idempotency_metrics["released"] += 1
+
+
+# %% Report on idempotency
+def get_idempotency_metrics():
+
+    with _idempotency_lock:
+        metrics = dict(_idempotency_metrics)
+
+    with _in_memory_backend.lock:
+        metrics["in_memory_entries"] = len(_in_memory_backend.entries)
+        metrics["in_memory_evictions"] = _in_memory_backend.evictions
+
+    metrics["deduplicated_rate"] = metrics["deduplicated"] / metrics["requests_with_key"] if metrics["requests_with_key"] > 0 else 0.0
+
+    return metrics
@@ -1,21 +1,173 @@
 import json
+import gzip
+import time
+import threading
+import brotli # pip install brotli
+from fastapi import Response
 from honeybadger import honeybadger
 import traceback
 
-def create_json_response(dict_response: dict, logger) -> dict:
-    
+# %% JSON Response Overview
+
+# create_json_bytes_response() serializes a response dictionary exactly once (rather than json.dumps() -> json.loads() to catch NaNs, then FastAPI serializing it again)
+# and returns the bytes in a Response, compressed with brotli / gzip if the client accepts it and the body is big enough to be worth it (e.g., users with long experimenter logs)
+# Serialization uses the standard library's C encoder with allow_nan=False: orjson is faster but silently writes NaN as null, and NaN should fail loudly
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_response_compression(min_bytes = 1024, gzip_level = 6, brotli_quality = 5)
+
+# # In an endpoint
+# return create_json_bytes_response(dict_response = dict_response, accept_encoding = request.headers.get("accept-encoding"), logger = logger)
+
+# # CPU time and bytes on the wire
+# get_json_response_metrics()
+
+response_compression_settings = {
+    "enabled": True,
+    "min_bytes": 1024, # smaller bodies fit in a packet or two, so compressing them just costs CPU
+    "gzip_level": 6,
+    "brotli_quality": 5} # brotli's higher qualities are meant for static assets, not per-request compression
+
+_json_response_metrics = {"responses": 0, "serialize_seconds": 0.0, "compress_seconds": 0.0, "bytes_uncompressed": 0, "bytes_sent": 0, "responses_by_encoding": {"identity": 0, "gzip": 0, "br": 0}}
+_json_response_metrics_lock = threading.Lock()
+
+
+# %% Configure response compression
+def configure_response_compression(enabled=True, min_bytes=1024, gzip_level=6, brotli_quality=5):
+
+    response_compression_settings["enabled"] = enabled
+    response_compression_settings["min_bytes"] = min_bytes
+    response_compression_settings["gzip_level"] = gzip_level
+    response_compression_settings["brotli_quality"] = brotli_quality
+
+
+# %% Serialize a response dictionary to JSON bytes (once; raises on NaN / Infinity)
+def serialize_json_response(dict_response: dict, logger) -> bytes:
+
     try:
 
-        #json.dumps() turns Python single quotes into JSON formatted double quotes and returns a string. json.loads() turns it into an actual json object
-        # FastAPI does a json.dumps(, allow_nan=False) and will throw an error if there are an NaN values, so we catch them earlier
-        return json.loads(json.dumps(dict_response, allow_nan=False)) 
-    
+        # Compact separators and raw UTF-8 (no \u escapes) keep the body small
+        return json.dumps(dict_response, allow_nan=False, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
     except Exception as e:
 
-        error_class = f"API | create_json_response()"
-        error_message = f"Error with create_json_response(); Error: {e}"
+        error_class = f"API | serialize_json_response()"
+        error_message = f"Error with serialize_json_response(); Error: {e}"
         logger.error(error_message)
         logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
         logger.error(f"JSON: {str(dict_response)}")
         honeybadger.notify(error_class=error_class, error_message=error_message)
-        raise Exception(error_message)
\ No newline at end of file
+        raise Exception(error_message)
+
+
+# %% Choose a content encoding the client accepts (brotli, then gzip); None sends the body uncompressed
+# accept_encoding: the request's Accept-Encoding header, e.g., "gzip, deflate, br" or "br;q=1.0, gzip;q=0.8, *;q=0.1"
+def choose_content_encoding(accept_encoding):
+
+    if accept_encoding is None:
+        return None
+
+    accepted_encodings = {}
+    for accepted_encoding in accept_encoding.lower().split(","):
+
+        encoding, _, parameters = accepted_encoding.strip().partition(";")
+
+        quality = 1.0
+        parameter_name, _, parameter_value = parameters.strip().partition("=")
+        if parameter_name.strip() == "q":
+            try:
+                quality = float(parameter_value)
+            except ValueError:
+                quality = 0.0
+
+        accepted_encodings[encoding.strip()] = quality
+
+    for encoding in ["br", "gzip"]:
+        if accepted_encodings.get(encoding, accepted_encodings.get("*", 0)) > 0:
+            return encoding
+
+    return None
+
+def _compress(body, content_encoding):
+
+    if content_encoding == "br":
+        return brotli.compress(body, quality=response_compression_settings["brotli_quality"])
+
+    return gzip.compress(body, compresslevel=response_compression_settings["gzip_level"], mtime=0)
+
+
+# %% Create a JSON Response (serialized once, compressed if worthwhile)
+def create_json_bytes_response(dict_response: dict, accept_encoding, logger, status_code=200, headers=None) -> Response:
+
+    start_time = time.perf_counter()
+    body = serialize_json_response(dict_response=dict_response, logger=logger)
+    serialize_seconds = time.perf_counter() - start_time
+
+    response_headers = dict(headers or {})
+    bytes_uncompressed = len(body)
+    content_encoding = None
+    compress_seconds = 0.0
+
+    if response_compression_settings["enabled"]:
+
+        response_headers["Vary"] = "Accept-Encoding" # caches must not serve a compressed body to a client that didn't ask for one
+
+        if bytes_uncompressed >= response_compression_settings["min_bytes"]:
+
+            content_encoding = choose_content_encoding(accept_encoding)
+
+            if content_encoding is not None:
+                start_time = time.perf_counter()
+                body = _compress(body, content_encoding)
+                compress_seconds = time.perf_counter() - start_time
+                response_headers["Content-Encoding"] = content_encoding
+
+    with _json_response_metrics_lock:
+        _json_response_metrics["responses"] += 1
+        _json_response_metrics["serialize_seconds"] += serialize_seconds
+        _json_response_metrics["compress_seconds"] += compress_seconds
+        _json_response_metrics["bytes_uncompressed"] += bytes_uncompressed
+        _json_response_metrics["bytes_sent"] += len(body)
+        _json_response_metrics["responses_by_encoding"][content_encoding or "identity"] += 1
+
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=response_headers)
+
+
+# %% Conditional GET (ETag / If-None-Match)
+# Weak comparison (RFC 9110): W/"abc" matches "abc"; if_none_match can list several ETags or be *
+def etag_matches(if_none_match, etag):
+
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    def strip_weak(value):
+        value = value.strip()
+        return value[2:] if value.startswith("W/") else value
+
+    return strip_weak(etag) in [strip_weak(value) for value in if_none_match.split(",")]
+
+# 304 Not Modified: no body, just the ETag (and Vary, as the 200 would have had)
+def create_not_modified_response(etag):
+
+    headers = {"ETag": etag}
+    if response_compression_settings["enabled"]:
+        headers["Vary"] = "Accept-Encoding"
+
+    return Response(status_code=304, headers=headers)
+
+
+# %% Report on response serialization / compression
+def get_json_response_metrics():
+
+    with _json_response_metrics_lock:
+
+        metrics = dict(_json_response_metrics)
+        metrics["responses_by_encoding"] = dict(_json_response_metrics["responses_by_encoding"])
+        metrics["compression_ratio"] = metrics["bytes_sent"] / metrics["bytes_uncompressed"] if metrics["bytes_uncompressed"] > 0 else 1.0
+
+    return metrics
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import OrderedDict
+
+# %% LRU Cache Overview
+
+# The in-memory caches (experimenter_log_cache_functions.py, user_lookup_cache_functions.py) share this class for the parts that have to be right in both:
+# - least recently used eviction past max_entries, and per entry expiry
+# - write-through invalidation that can't be undone by a slow read: callers capture a generation before they query, and put() skips the value
+#   if the key was invalidated (or the whole cache cleared) since, as the value may have been read before the write
+# Invalidations are only remembered for max_build_seconds, so put() also skips values that took longer than that to build
+# Each cache module keeps its own settings / public functions and wraps one instance
+
+# ## Sample Use
+
+# # One instance per cache module
+# lru_cache = InvalidatableLRUCache(max_entries = 10000, max_build_seconds = 60)
+# (metric_names = ["negative_hits"], hit_metric_name = lambda value: ... to count some hits separately)
+
+# # Look up / store (capture the generation before querying)
+# cache_generation = lru_cache.get_generation()
+# value = lru_cache.get(key) # None on a miss; counts a hit / miss
+# lru_cache.put(key, value, ttl_seconds, cache_generation)
+
+# # Look without counting or refreshing the entry's recency
+# lru_cache.peek(key)
+
+# # After a write / when invalidations may have been missed
+# lru_cache.invalidate(key)
+# lru_cache.clear()
+
+# # Counters (hits, misses, evictions, expirations, invalidations, clears, stale_writes_skipped, + metric_names) and entries
+# lru_cache.get_metrics()
+
+class InvalidatableLRUCache:
+
+    def __init__(self, max_entries, max_build_seconds, metric_names=(), hit_metric_name=None):
+
+        self.enabled = True
+        self.max_entries = max_entries
+        self.max_build_seconds = max_build_seconds # a value that took longer than this to build (from get_generation() to put()) isn't cached
+
+        self.entries = OrderedDict() # key -> (value, expires_at); least recently used first
+        self.invalidations = 0 # number of invalidations so far (generations record it, so later invalidations can be told apart)
+        self.recent_invalidations = OrderedDict() # key -> (invalidation number, time.monotonic()) of its last invalidation; oldest first, only the last max_build_seconds
+        self.clears = 0 # number of times the whole cache was cleared (also part of each generation)
+        self.hit_metric_name = hit_metric_name # function of a cached value giving the counter a hit on it goes to (None: "hits")
+        self.metrics = {metric_name: 0 for metric_name in ["hits", "misses", "evictions", "expirations", "invalidations", "clears", "stale_writes_skipped", *metric_names]}
+        self.lock = threading.Lock()
+
+    def configure(self, enabled, max_entries):
+
+        with self.lock:
+
+            self.enabled = enabled
+            self.max_entries = max_entries
+
+            if not enabled:
+                self.entries.clear()
+
+    # The cached value (None on a miss)
+    # Cached values are shared between requests, so callers must not modify them
+    def get(self, key):
+
+        if not self.enabled:
+            return None
+
+        with self.lock:
+
+            cache_entry = self.entries.get(key)
+
+            if cache_entry is None:
+                self.metrics["misses"] += 1
+                return None
+
+            value, expires_at = cache_entry
+
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                self.metrics["expirations"] += 1
+                self.metrics["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.metrics["hits" if self.hit_metric_name is None else self.hit_metric_name(value)] += 1
+
+            return value
+
+    # The cached value (None if there's no unexpired entry) without counting a hit / miss or refreshing its recency
+    def peek(self, key):
+
+        if not self.enabled:
+            return None
+
+        with self.lock:
+
+            cache_entry = self.entries.get(key)
+
+            if cache_entry is None or time.monotonic() >= cache_entry[1]:
+                return None
+
+            return cache_entry[0]
+
+    def get_generation(self):
+
+        with self.lock:
+            return (self.clears, self.invalidations, time.monotonic())
+
+    # Whether nothing has invalidated the key since cache_generation was captured (call with self.lock held)
+    def _generation_is_current(self, key, cache_generation):
+
+        clears, invalidations, captured_at = cache_generation
+
+        if clears != self.clears or time.monotonic() - captured_at > self.max_build_seconds:
+            return False
+
+        recent_invalidation = self.recent_invalidations.get(key)
+
+        return recent_invalidation is None or recent_invalidation[0] <= invalidations
+
+    # Store a value for ttl_seconds; cache_generation: get_generation() from before the value was read
+    def put(self, key, value, ttl_seconds, cache_generation):
+
+        if not self.enabled or ttl_seconds <= 0:
+            return
+
+        with self.lock:
+
+            if not self._generation_is_current(key, cache_generation):
+                self.metrics["stale_writes_skipped"] += 1
+                return
+
+            self.entries[key] = (value, time.monotonic() + ttl_seconds)
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def invalidate(self, key):
+
+        with self.lock:
+
+            now = time.monotonic()
+            self.invalidations += 1
+            self.recent_invalidations[key] = (self.invalidations, now)
+            self.recent_invalidations.move_to_end(key)
+
+            # Forget invalidations older than any value we'd still cache
+            while now - next(iter(self.recent_invalidations.values()))[1] > self.max_build_seconds:
+                self.recent_invalidations.popitem(last=False)
+
+            if self.entries.pop(key, None) is not None:
+                self.metrics["invalidations"] += 1
+
+    def clear(self):
+
+        with self.lock:
+
+            self.clears += 1
+            self.entries.clear()
+            self.recent_invalidations.clear() # every earlier generation is out of date anyway
+            self.metrics["clears"] += 1
+
+    def count(self, metric_name):
+
+        with self.lock:
+            self.metrics[metric_name] += 1
+
+    def get_metrics(self):
+
+        with self.lock:
+
+            metrics = dict(self.metrics)
+            metrics["entries"] = len(self.entries)
+
+        return metrics
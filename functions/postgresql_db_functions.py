@@ -1,7 +1,22 @@
 import psycopg2 # pip install psycopg2-binary
+import psycopg2.extensions
+from psycopg2.extras import NamedTupleCursor
 import pandas as pd
 from honeybadger import honeybadger
 import traceback
+import threading
+import time
+import re
+import weakref
+import uuid
+import io
+import math
+from contextlib import contextmanager
+from datetime import date, datetime
+
+# Custom imports
+from query_instrumentation_functions import query_instrumentation_settings, get_statement_identity, statement_is_read_only, record_query_timing, log_slow_query
+from read_replica_functions import get_replica_connection_parameters, get_replica_staleness_window_seconds, attach_replica_db_pools
 
 # %%Example Usage and Postgresql / Python Overview and 
 
@@ -52,11 +67,14 @@ import traceback
 
 # # Use functions
 
+# # Create the connection pool once (main.py does this at app startup and shares it with every function)
+# db_pool = create_db_connection_pool(db_connection_parameters = db_connection_parameters, logger = logger)
+
 # db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
 
 # try:
 
-#     db_conn = create_db_connection(db_connection_parameters = db_connection_parameters, logger = logger)
+#     db_conn = db_pool.getconn()
 
 #     df = execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
 
@@ -66,9 +84,15 @@ import traceback
 #     logger.error(e)
 
 # finally:   
-#     # Close database connection if it exists    
+#     # Return database connection to the pool if we checked one out
 #     if db_conn is not None:
-#         db_conn.close()
+#         db_pool.putconn(db_conn)
+
+# # Check on the pool (e.g., how long requests are waiting for a connection)
+# db_pool.get_metrics()
+
+# # Read-only queries can be routed to read replicas (if db_connection_parameters lists any; see read_replica_functions.py)
+# db_conn, read_db_pool = getconn_for_read(db_pool = db_pool, routing_key = public_user_id, logger = logger)
 
 
 # ## Sample Use of Postgresql Functions
@@ -133,14 +157,457 @@ def create_db_connection(db_connection_parameters, logger):
         raise Exception(error_message)
 
 
+# %% Database Connection Pool
+# Opening a connection to our hosted Postgres (TCP + TLS + auth) dominates the latency of our small queries and every open connection counts against the provider's connection cap
+# so main.py creates one pool at app startup and every function checks connections out of it (db_pool.getconn()) and returns them (db_pool.putconn(db_conn)) rather than opening / closing their own
+class DBConnectionPool:
+
+    def __init__(
+            self,
+            db_connection_parameters,
+            logger,
+            min_connections=1, # connections opened at startup and never reaped
+            max_connections=10, # hard cap on open connections (keep below the provider's connection limit, accounting for other workers)
+            checkout_timeout_seconds=30, # how long getconn() waits for a free connection before raising an error
+            health_check_after_idle_seconds=30, # connections idle longer than this are checked with SELECT 1 before being handed out
+            max_idle_seconds=300, # connections (above min_connections) idle longer than this are closed
+            reap_interval_seconds=60): # how often the background thread looks for idle connections to close (None to disable the thread)
+
+        if min_connections < 0 or max_connections < 1 or min_connections > max_connections:
+            raise ValueError(f"Invalid pool size: min_connections = {min_connections}, max_connections = {max_connections}")
+
+        self.db_connection_parameters = db_connection_parameters
+        self.logger = logger
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+        self.health_check_after_idle_seconds = health_check_after_idle_seconds
+        self.max_idle_seconds = max_idle_seconds
+
+        self._condition = threading.Condition()
+        self._idle_connections = [] # (db_conn, returned_at) tuples; oldest first so we reuse the most recently used connection and reap from the front
+        self._in_use_count = 0 # connections checked out (or being opened for a checkout)
+        self._closed = False
+        self._closed_event = threading.Event()
+
+        self._metrics = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "connections_reaped": 0,
+            "failed_health_checks": 0,
+            "checkouts": 0,
+            "checkouts_waited": 0, # checkouts that had to wait for another request to return a connection
+            "checkout_timeouts": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0}
+
+        # Open the minimum number of connections up front so the first requests don't pay for the connection setup
+        for _ in range(min_connections):
+            self._idle_connections.append((self._open_connection(), time.monotonic()))
+
+        # Close idle connections in the background (so we give connections back to the provider even if traffic stops entirely)
+        if max_idle_seconds is not None and reap_interval_seconds is not None:
+            reaper_thread = threading.Thread(target=self._reap_idle_connections_periodically, args=(reap_interval_seconds,), name="db-pool-reaper", daemon=True)
+            reaper_thread.start()
+
+    def _open_connection(self):
+
+        db_conn = create_db_connection(self.db_connection_parameters, self.logger)
+
+        with self._condition:
+            self._metrics["connections_opened"] += 1
+
+        return db_conn
+
+    def _close_connection(self, db_conn):
+
+        try:
+            db_conn.close()
+        except Exception as e:
+            self.logger.error(f"DBConnectionPool: error closing connection; Error: {e}")
+
+        with self._condition:
+            self._metrics["connections_closed"] += 1
+
+    def _connection_is_healthy(self, db_conn, returned_at):
+
+        if db_conn.closed:
+            return False
+
+        # Only run a round trip health check on connections that have been sitting idle (the server / a proxy may have dropped them)
+        if time.monotonic() - returned_at < self.health_check_after_idle_seconds:
+            return True
+
+        try:
+            with db_conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            db_conn.rollback() # end the transaction the SELECT opened
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+
+        wait_start = time.monotonic()
+        deadline = wait_start + self.checkout_timeout_seconds
+        waited = False
+        db_conn, returned_at = None, None
+
+        with self._condition:
+
+            while True:
+
+                if self._closed:
+                    raise Exception("DBConnectionPool: pool is closed")
+
+                # (a) Reuse the most recently returned idle connection
+                if len(self._idle_connections) > 0:
+                    db_conn, returned_at = self._idle_connections.pop()
+                    break
+
+                # (b) Open a new connection if we're below the cap
+                if self._in_use_count < self.max_connections:
+                    break
+
+                # (c) Wait for another request to return a connection
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    self._metrics["checkout_timeouts"] += 1
+                    raise Exception(f"DBConnectionPool: timed out after {self.checkout_timeout_seconds} seconds waiting for a connection (max_connections = {self.max_connections})")
+
+                waited = True
+                self._condition.wait(remaining_seconds)
+
+            self._in_use_count += 1
+
+            wait_seconds = time.monotonic() - wait_start
+            self._metrics["checkouts"] += 1
+            self._metrics["checkouts_waited"] += 1 if waited else 0
+            self._metrics["total_wait_seconds"] += wait_seconds
+            self._metrics["max_wait_seconds"] = max(self._metrics["max_wait_seconds"], wait_seconds)
+
+        # Open / health check outside of the lock so other requests aren't blocked on our round trips
+        try:
+
+            if db_conn is not None and not self._connection_is_healthy(db_conn, returned_at):
+
+                self.logger.info("DBConnectionPool: replacing connection that failed its health check")
+                with self._condition:
+                    self._metrics["failed_health_checks"] += 1
+                self._close_connection(db_conn)
+                db_conn = None
+
+            if db_conn is None:
+                db_conn = self._open_connection()
+
+            return db_conn
+
+        except Exception:
+
+            with self._condition:
+                self._in_use_count -= 1
+                self._condition.notify()
+            raise
+
+    def putconn(self, db_conn, close=False):
+
+        # Don't hand a connection with an open (or failed) transaction to the next request
+        if not close and not db_conn.closed and db_conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                db_conn.rollback()
+            except Exception:
+                close = True
+
+        with self._condition:
+
+            self._in_use_count -= 1
+
+            if close or db_conn.closed or self._closed:
+                connection_to_close = db_conn
+            else:
+                connection_to_close = None
+                self._idle_connections.append((db_conn, time.monotonic()))
+
+            self._condition.notify()
+
+        if connection_to_close is not None:
+            self._close_connection(connection_to_close)
+
+    def reap_idle_connections(self):
+
+        now = time.monotonic()
+        connections_to_close = []
+
+        with self._condition:
+
+            # Idle connections are stored oldest first, so stop at the first one that hasn't been idle too long
+            while (len(self._idle_connections) > 0 and
+                   len(self._idle_connections) + self._in_use_count > self.min_connections and
+                   now - self._idle_connections[0][1] > self.max_idle_seconds):
+
+                connections_to_close.append(self._idle_connections.pop(0)[0])
+
+            self._metrics["connections_reaped"] += len(connections_to_close)
+
+        for db_conn in connections_to_close:
+            self._close_connection(db_conn)
+
+        return len(connections_to_close)
+
+    def _reap_idle_connections_periodically(self, reap_interval_seconds):
+
+        # Event.wait() returns True once the pool is closed, which ends the thread
+        while not self._closed_event.wait(reap_interval_seconds):
+
+            try:
+                self.reap_idle_connections()
+            except Exception as e:
+                self.logger.error(f"DBConnectionPool: error reaping idle connections; Error: {e}")
+
+    def get_metrics(self):
+
+        with self._condition:
+
+            metrics = dict(self._metrics)
+            metrics["min_connections"] = self.min_connections
+            metrics["max_connections"] = self.max_connections
+            metrics["idle_connections"] = len(self._idle_connections)
+            metrics["in_use_connections"] = self._in_use_count
+            metrics["avg_wait_seconds"] = metrics["total_wait_seconds"] / metrics["checkouts"] if metrics["checkouts"] > 0 else 0.0
+
+        return metrics
+
+    def closeall(self):
+
+        with self._condition:
+            self._closed = True
+            connections_to_close = [db_conn for db_conn, _ in self._idle_connections]
+            self._idle_connections = []
+            self._condition.notify_all()
+
+        self._closed_event.set()
+
+        # Connections that are still checked out are closed when they are returned (see putconn())
+        for db_conn in connections_to_close:
+            self._close_connection(db_conn)
+
+
+# %% Create Database Connection Pool
+def create_db_connection_pool(
+        db_connection_parameters, 
+        logger,
+        min_connections=1,
+        max_connections=10,
+        checkout_timeout_seconds=30,
+        health_check_after_idle_seconds=30,
+        max_idle_seconds=300):
+
+    try:
+
+        logger.info(f"Creating database connection pool: min_connections = {min_connections}, max_connections = {max_connections}")
+
+        db_pool = DBConnectionPool(
+            db_connection_parameters=db_connection_parameters,
+            logger=logger,
+            min_connections=min_connections,
+            max_connections=max_connections,
+            checkout_timeout_seconds=checkout_timeout_seconds,
+            health_check_after_idle_seconds=health_check_after_idle_seconds,
+            max_idle_seconds=max_idle_seconds)
+
+        # Open a pool per read replica (if any are configured; see read_replica_functions.py)
+        # A replica we can't reach at startup is skipped so its reads go to the primary
+        replica_db_pools = []
+        for replica_connection_parameters in get_replica_connection_parameters(db_connection_parameters):
+
+            try:
+
+                logger.info(f"Creating read replica connection pool: host = {replica_connection_parameters['host']}")
+                replica_db_pools.append(DBConnectionPool(
+                    db_connection_parameters=replica_connection_parameters,
+                    logger=logger,
+                    min_connections=min_connections,
+                    max_connections=max_connections,
+                    checkout_timeout_seconds=checkout_timeout_seconds,
+                    health_check_after_idle_seconds=health_check_after_idle_seconds,
+                    max_idle_seconds=max_idle_seconds))
+
+            except Exception as e:
+
+                logger.error(f"create_db_connection_pool() skipping read replica {replica_connection_parameters['host']}; Error: {e}")
+
+        attach_replica_db_pools(db_pool, replica_db_pools, get_replica_staleness_window_seconds(db_connection_parameters))
+
+        return db_pool
+
+    except Exception as e:
+
+        error_class = f"API | create_db_connection_pool()"
+        error_message = f"create_db_connection_pool() failed; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+
+# %% Query timing (see query_instrumentation_functions.py)
+# Every execute_* helper below records its statement's wall time and rows; slow statements go to the slow query log (with an EXPLAIN (ANALYZE, BUFFERS) plan if enabled)
+def _finish_query_timing(statement_identity, sql_statement, sql_params, start_time, row_count, db_conn, logger):
+
+    # Instrumentation should never break the query it's measuring
+    try:
+
+        elapsed_seconds = time.perf_counter() - start_time
+
+        if record_query_timing(statement_identity, elapsed_seconds, row_count):
+
+            explain_plan = None
+            if query_instrumentation_settings["capture_explain_plans"] and sql_statement is not None and statement_is_read_only(sql_statement):
+                explain_plan = _capture_explain_plan(sql_statement, sql_params, db_conn)
+
+            log_slow_query(statement_identity, sql_statement, sql_params, elapsed_seconds, row_count, explain_plan, logger)
+
+    except Exception as e:
+
+        logger.error(f"_finish_query_timing() failed for {statement_identity}; Error: {e}")
+
+# Re-run a (read-only) statement under EXPLAIN (ANALYZE, BUFFERS) inside a savepoint so a failure can't affect the caller's transaction
+def _capture_explain_plan(sql_statement, sql_params, db_conn):
+
+    # Autocommit (read-only transaction() scopes) can't use savepoints; the statement is read-only, so just re-run it
+    if db_conn.autocommit:
+
+        with db_conn.cursor() as cursor:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql_statement, sql_params)
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+    # Most helpers have already committed; if so, don't leave the plan's transaction open afterwards
+    opened_transaction = db_conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    try:
+
+        return _explain_in_savepoint(sql_statement, sql_params, db_conn)
+
+    finally:
+
+        if opened_transaction:
+            db_conn.rollback()
+
+def _explain_in_savepoint(sql_statement, sql_params, db_conn):
+
+    with db_conn.cursor() as cursor:
+
+        cursor.execute("SAVEPOINT capture_explain_plan;")
+
+        try:
+
+            if sql_params is None:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql_statement)
+            else:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql_statement, sql_params)
+
+            explain_plan = "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute("RELEASE SAVEPOINT capture_explain_plan;")
+
+            return explain_plan
+
+        except Exception:
+
+            cursor.execute("ROLLBACK TO SAVEPOINT capture_explain_plan;")
+            raise
+
+
+# %% Transaction scopes
+# By default every execute_* helper commits after its statement (one transaction per statement)
+# transaction() groups several statements into one transaction instead: the helpers inside skip their commit / rollback, and the scope commits once at the end (or rolls back if anything fails)
+# read_only=True runs the statements in autocommit mode instead (no BEGIN / COMMIT round trips; each statement sees its own snapshot); don't write or stream (execute_sql_yield_chunks) inside it
+
+# Sample Use:
+# with transaction(db_conn = db_conn, logger = logger):
+#     rows = execute_prepared_sql_return_rows(statement_name = "inactivate_prior_observation", sql_params = sql_params, db_conn = db_conn, logger = logger)
+#     response = execute_prepared_sql_return_status_message(statement_name = "insert_observation", sql_params = sql_params, db_conn = db_conn, logger = logger)
+#     if response["status"] == "failure":
+#         raise ValueError("Insert failed") # rolls back the inactivation as well
+
+_transaction_scopes = weakref.WeakKeyDictionary() # db_conn -> {"read_only": bool} for connections inside transaction()
+
+def in_transaction(db_conn):
+
+    return db_conn in _transaction_scopes
+
+def _commit_unless_in_transaction(db_conn):
+
+    if db_conn not in _transaction_scopes:
+        db_conn.commit()
+
+def _rollback_unless_in_transaction(db_conn):
+
+    if db_conn not in _transaction_scopes:
+        db_conn.rollback()
+
+@contextmanager
+def transaction(db_conn, logger, read_only=False):
+
+    # Nested scopes join the enclosing one (its commit / rollback covers our statements)
+    if db_conn in _transaction_scopes:
+
+        if not read_only and _transaction_scopes[db_conn]["read_only"]:
+            raise ValueError("transaction() can't open a read-write transaction inside a read-only transaction")
+
+        yield db_conn
+        return
+
+    if db_conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        raise ValueError("transaction() requires a connection without an open transaction")
+
+    _transaction_scopes[db_conn] = {"read_only": read_only}
+
+    try:
+
+        if read_only:
+
+            db_conn.autocommit = True # client side only; psycopg2 simply stops sending BEGIN / COMMIT
+
+            try:
+                yield db_conn
+            finally:
+                db_conn.autocommit = False
+
+        else:
+
+            try:
+
+                yield db_conn
+
+            except BaseException:
+
+                db_conn.rollback()
+                raise
+
+            # A statement failed but the caller carried on (e.g., a status message helper returned {"status": "failure"}); the transaction can only be rolled back
+            if db_conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                db_conn.rollback()
+                error_message = "transaction() rolled back: a statement inside the transaction failed"
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            db_conn.commit()
+
+    finally:
+
+        del _transaction_scopes[db_conn]
+
+
 # %% Excute a SQL statement, return dataframe
 # We use SQL parameters (rather than inserting user generated info into a SQL statement with f-strings) to prevent SQL injection attacks (https://www.psycopg.org/psycopg3/docs/basic/params.html)
-def execute_sql_return_df(sql_statement, sql_params, db_conn, logger):
+def execute_sql_return_df(sql_statement, sql_params, db_conn, logger, statement_name=None):
 
     try:
 
         with db_conn.cursor() as cursor:
 
+            start_time = time.perf_counter()
+
             if sql_params is None:
 
                 cursor.execute(sql_statement)
@@ -149,15 +616,16 @@ def execute_sql_return_df(sql_statement, sql_params, db_conn, logger):
 
                 cursor.execute(sql_statement, sql_params)
 
-            db_conn.commit() # note that any other transactions using this db_conn will be committed as well
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
 
             data = cursor.fetchall()
+            _finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, len(data), db_conn, logger)
             col_names = [desc[0] for desc in cursor.description]
             return pd.DataFrame(data, columns=col_names)
 
     except Exception as e:
 
-        db_conn.rollback() # rollback any changes made to the database during this failed transaction    
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
 
         error_class = f"API | execute_sql_return_df()"
         error_message = f"execute_sql_return_df() failed; Error: {e}, SQL Statement: {sql_statement}"
@@ -166,14 +634,149 @@ def execute_sql_return_df(sql_statement, sql_params, db_conn, logger):
         honeybadger.notify(error_class=error_class, error_message=error_message)        
         raise Exception(error_message)
 
+# %% Excute a SQL statement, return rows (lightweight alternative to execute_sql_return_df())
+# Returns a list of named tuples (e.g., row.user_id or row[1]); named tuples have no per-row __dict__ and skip building a pandas dataframe, which matters for our small, hot queries
+# Use execute_sql_return_one_row() / execute_sql_return_scalar() for lookups that return at most one row
+
+# Example:
+# row = execute_sql_return_one_row(sql_statement = "SELECT id, user_id FROM user_lookups WHERE public_user_id = %(public_user_id)s;", sql_params = sql_params, db_conn = db_conn, logger = logger)
+# if row is not None: user_id = row.user_id
+def execute_sql_return_rows(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    try:
+
+        with db_conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+
+            start_time = time.perf_counter()
+
+            if sql_params is None:
+
+                cursor.execute(sql_statement)
+
+            else:
+
+                cursor.execute(sql_statement, sql_params)
+
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            rows = cursor.fetchall()
+            _finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, len(rows), db_conn, logger)
+
+            return rows
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | execute_sql_return_rows()"
+        error_message = f"execute_sql_return_rows() failed; Error: {e}, SQL Statement: {sql_statement}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+# Return the single row (named tuple) a statement returns, or None if it returns no rows (raises an error if it returns multiple rows)
+def get_one_row(rows, description):
+
+    if len(rows) > 1:
+        raise ValueError(f"Expected at most one row, but {len(rows)} rows were returned; {description}")
+
+    return rows[0] if len(rows) == 1 else None
+
+def execute_sql_return_one_row(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    rows = execute_sql_return_rows(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name=statement_name)
+    return get_one_row(rows, f"SQL Statement: {sql_statement}")
+
+# Return the first column of the single row a statement returns (None if it returns no rows)
+def execute_sql_return_scalar(sql_statement, sql_params, db_conn, logger, statement_name=None):
+
+    row = execute_sql_return_one_row(sql_statement=sql_statement, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name=statement_name)
+    return row[0] if row is not None else None
+
+# %% Excute a SQL statement, yield results in chunks (server-side cursor)
+# Use instead of execute_sql_return_df() when a query can return a lot of rows (e.g., every message due in the next 72 hours)
+# The rows stay on the server (named cursor) and we pull chunk_size rows at a time, so peak memory depends on chunk_size rather than on the number of rows
+# return_type = "df" yields pandas dataframes; return_type = "rows" yields lists of tuples (cheaper if you don't need pandas)
+# Note: the cursor lives in a transaction on db_conn until the generator is exhausted, so do any writes for the chunks on a different connection
+
+# Example:
+# for df_chunk in execute_sql_yield_chunks(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger, chunk_size = 500):
+#     process(df_chunk)
+def execute_sql_yield_chunks(sql_statement, sql_params, db_conn, logger, chunk_size=500, return_type="df", statement_name=None):
+
+    if return_type not in ("df", "rows"):
+        raise ValueError(f"return_type must be 'df' or 'rows', not: {return_type}")
+
+    try:
+
+        # Named cursors are created on the server (cursor names must be unique within the transaction)
+        with db_conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+
+            cursor.itersize = chunk_size
+
+            start_time = time.perf_counter()
+
+            if sql_params is None:
+
+                cursor.execute(sql_statement)
+
+            else:
+
+                cursor.execute(sql_statement, sql_params)
+
+            # Time spent on the database (executing / fetching), excluding the time the caller spends processing each chunk
+            elapsed_seconds = time.perf_counter() - start_time
+            row_count = 0
+
+            while True:
+
+                fetch_start_time = time.perf_counter()
+                data = cursor.fetchmany(chunk_size)
+                elapsed_seconds += time.perf_counter() - fetch_start_time
+
+                if len(data) == 0:
+                    break
+
+                row_count += len(data)
+
+                if return_type == "df":
+                    col_names = [desc[0] for desc in cursor.description] # description is only available after the first fetch for named cursors
+                    yield pd.DataFrame(data, columns=col_names)
+                else:
+                    yield data
+
+        _commit_unless_in_transaction(db_conn) # end the transaction that held the server-side cursor
+
+        _finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, time.perf_counter() - elapsed_seconds, row_count, db_conn, logger)
+
+    except GeneratorExit:
+
+        # The caller stopped iterating early; end the transaction that held the server-side cursor
+        _rollback_unless_in_transaction(db_conn)
+        raise
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | execute_sql_yield_chunks()"
+        error_message = f"execute_sql_yield_chunks() failed; Error: {e}, SQL Statement: {sql_statement}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
 # %% Excute a SQL statement, return status message (no data returned)
 # We use SQL parameters (rather than inserting user generated info into a SQL statement with f-strings) to prevent SQL injection attacks (https://www.psycopg.org/psycopg3/docs/basic/params.html)
-def execute_sql_return_status_message(sql_statement, sql_params, db_conn, logger):
+def execute_sql_return_status_message(sql_statement, sql_params, db_conn, logger, statement_name=None):
 
     try:
 
         with db_conn.cursor() as cursor:
 
+            start_time = time.perf_counter()
+
             if sql_params is None:
 
                 cursor.execute(sql_statement)
@@ -182,13 +785,15 @@ def execute_sql_return_status_message(sql_statement, sql_params, db_conn, logger
 
                 cursor.execute(sql_statement, sql_params)
             
-            db_conn.commit() # note that any other transactions using this db_conn will be committed as well
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            _finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, sql_params, start_time, cursor.rowcount, db_conn, logger)
 
             return {"status": "success", "status_message": cursor.statusmessage} # the message like 'INSERT 0 1' that is returned after running a postgresql command
 
     except Exception as e:
 
-        db_conn.rollback() # rollback any changes made to the database during this failed transaction    
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
 
         error_class = f"API | execute_sql_return_status_message()"
         error_message = f"execute_sql_return_status_message() failed; Error: {e}, SQL Statement: {sql_statement}"
@@ -199,9 +804,93 @@ def execute_sql_return_status_message(sql_statement, sql_params, db_conn, logger
         return {"status": "failure", "status_message": f"error: {e}"}
 
 
+# %% Bulk write rows with COPY, then apply set-based SQL (all in one transaction)
+# executemany_sql_return_status_message() makes one round trip per row; this stages all of the rows in temp tables with COPY (one round trip per table)
+# and then runs one set-based statement per operation (e.g., UPDATE ... FROM staging_table, INSERT ... SELECT FROM staging_table)
+# Everything commits (or rolls back) together and the temp tables are dropped on commit
+
+# Example:
+# staging_tables = [{
+#     "staging_table_name": "staging_statuses",
+#     "staging_table_query": "SELECT id AS sub_group_action_id, status FROM sub_group_actions", # defines the staging table's columns / types (no rows are copied from it)
+#     "columns": ["sub_group_action_id", "status"],
+#     "rows": [('a1b2', 'message_scheduled'), ('c3d4', 'message_failed_to_schedule')]}]
+# sql_statements = {
+#     "update_statuses": "UPDATE sub_group_actions sga SET status = s.status FROM staging_statuses s WHERE sga.id = s.sub_group_action_id;"}
+# response = bulk_write_with_copy(staging_tables = staging_tables, sql_statements = sql_statements, db_conn = db_conn, logger = logger)
+# response -> {"status": "success", "rows_staged": {"staging_statuses": 2}, "rows_affected": {"update_statuses": 2}}
+
+# Format a value for COPY's text format (tab separated, \N for NULL, backslash escapes)
+def _format_copy_value(value):
+
+    if value is None or value is pd.NaT or (isinstance(value, float) and math.isnan(value)):
+        return "\\N"
+
+    if isinstance(value, (datetime, date)):
+        text = value.isoformat()
+    else:
+        text = str(value)
+
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def bulk_write_with_copy(staging_tables, sql_statements, db_conn, logger):
+
+    try:
+
+        rows_staged = {}
+        rows_affected = {}
+
+        with db_conn.cursor() as cursor:
+
+            # Create every staging table in one round trip (ON COMMIT DROP cleans them up)
+            cursor.execute(" ".join(
+                f"CREATE TEMP TABLE {staging_table['staging_table_name']} ON COMMIT DROP AS {staging_table['staging_table_query'].strip().rstrip(';')} WITH NO DATA;"
+                for staging_table in staging_tables))
+
+            # Stream each table's rows to the server with COPY (one round trip per table regardless of the number of rows)
+            for staging_table in staging_tables:
+
+                buffer = io.StringIO()
+                row_count = 0
+                for row in staging_table["rows"]:
+                    buffer.write("\t".join(_format_copy_value(value) for value in row) + "\n")
+                    row_count += 1
+                buffer.seek(0)
+
+                start_time = time.perf_counter()
+                cursor.copy_expert(f"COPY {staging_table['staging_table_name']} ({', '.join(staging_table['columns'])}) FROM STDIN;", buffer)
+                _finish_query_timing(f"bulk_write_with_copy: COPY {staging_table['staging_table_name']}", None, None, start_time, row_count, db_conn, logger)
+                rows_staged[staging_table['staging_table_name']] = row_count
+
+            # Apply the set-based statements in order
+            for operation_name, sql_statement in sql_statements.items():
+
+                start_time = time.perf_counter()
+                cursor.execute(sql_statement)
+                rows_affected[operation_name] = cursor.rowcount
+                _finish_query_timing(f"bulk_write_with_copy: {operation_name}", sql_statement, None, start_time, cursor.rowcount, db_conn, logger)
+
+        _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+        logger.info(f"bulk_write_with_copy(): rows_staged: {rows_staged}, rows_affected: {rows_affected}")
+
+        return {"status": "success", "rows_staged": rows_staged, "rows_affected": rows_affected}
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | bulk_write_with_copy()"
+        error_message = f"bulk_write_with_copy() failed; Error: {e}, SQL Statements: {list(sql_statements.values())}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+
 # %% Excute a SQL statement using executemany, return status message (no data returned)
 # Using tuples in executemany should have psycopg2 do sanitation to prevent any sql injection attack
-def executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger):
+def executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger, statement_name=None):
 
     # Example:
     # tuples = [tuple(x) for x in df_messages[['status', 'sub_group_action_id']].values]
@@ -211,15 +900,19 @@ def executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger
 
         with db_conn.cursor() as cursor:
 
+            start_time = time.perf_counter()
+
             cursor.executemany(sql_statement, tuples)
 
-            db_conn.commit() # note that any other transactions using this db_conn will be committed as well
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            _finish_query_timing(get_statement_identity(sql_statement, statement_name), sql_statement, None, start_time, cursor.rowcount, db_conn, logger)
 
             return cursor.statusmessage # the message like 'INSERT 0 1' that is returned after running a postgresql command
 
     except Exception as e:
 
-        db_conn.rollback() # rollback any changes made to the database during this failed transaction    
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
 
         error_class = f"API | execute_sql_return_status_message()"
         error_message = f"execute_sql_return_status_message() failed; Error: {e}, SQL Statement: {sql_statement}"
@@ -227,3 +920,175 @@ def executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger
         logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
         honeybadger.notify(error_class=error_class, error_message=error_message)        
         raise Exception(error_message)
+
+
+# %% Prepared statements
+# Our hot SQL (e.g., the experimenter log CTE) is fixed text that Postgres would otherwise parse and plan on every call
+# Register it once (at module import) with register_prepared_statement() and run it with execute_prepared_sql_return_df() / execute_prepared_sql_return_status_message()
+# The first time a statement runs on a pooled connection we PREPARE it on that connection; after that we only EXECUTE it by name
+# get_prepared_statement_stats() reports prepares vs. executions for each statement (executions should far outnumber prepares once the pool is warm)
+
+# Example:
+# register_prepared_statement(statement_name = "retrieve_user_id", sql_statement = "SELECT user_id FROM user_lookups WHERE public_user_id = %(public_user_id)s;")
+# df = execute_prepared_sql_return_df(statement_name = "retrieve_user_id", sql_params = {'public_user_id': public_user_id}, db_conn = db_conn, logger = logger)
+
+prepared_statements = {} # statement_name -> {"sql_statement": original SQL using %(name)s parameters, "prepare_statement": PREPARE ... AS ... using $1, $2, ..., "param_names": parameter name for $1, $2, ...}
+prepared_statement_stats = {} # statement_name -> {"prepares": int, "executions": int}
+_prepared_statement_lock = threading.Lock()
+_prepared_statement_names_by_connection = weakref.WeakKeyDictionary() # db_conn -> set of statement_names prepared on that connection (entries disappear with the connection)
+
+def register_prepared_statement(statement_name, sql_statement):
+
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", statement_name):
+        raise ValueError(f"Invalid prepared statement name: {statement_name} (use lowercase letters, digits, underscores)")
+
+    # Convert %(name)s parameters to the $1, $2, ... placeholders PREPARE requires (a repeated parameter reuses its placeholder)
+    param_names = []
+
+    def replace_param(match):
+        if match.group(1) not in param_names:
+            param_names.append(match.group(1))
+        return f"${param_names.index(match.group(1)) + 1}"
+
+    prepare_body = re.sub(r"%\((\w+)\)s", replace_param, sql_statement).replace("%%", "%").strip().rstrip(";")
+
+    with _prepared_statement_lock:
+
+        prepared_statements[statement_name] = {
+            "sql_statement": sql_statement,
+            "prepare_statement": f"PREPARE {statement_name} AS {prepare_body}",
+            "param_names": param_names}
+        prepared_statement_stats.setdefault(statement_name, {"prepares": 0, "executions": 0})
+
+def statement_is_prepared_on_connection(statement_name, db_conn):
+
+    with _prepared_statement_lock:
+        return statement_name in _prepared_statement_names_by_connection.get(db_conn, ())
+
+def record_prepared_statement_prepare(statement_name, db_conn):
+
+    with _prepared_statement_lock:
+        _prepared_statement_names_by_connection.setdefault(db_conn, set()).add(statement_name)
+        prepared_statement_stats[statement_name]["prepares"] += 1
+
+def record_prepared_statement_execution(statement_name):
+
+    with _prepared_statement_lock:
+        prepared_statement_stats[statement_name]["executions"] += 1
+
+def get_prepared_statement_stats():
+
+    with _prepared_statement_lock:
+        return {statement_name: dict(stats) for statement_name, stats in prepared_statement_stats.items()}
+
+# Run a registered statement on a psycopg2 cursor (PREPARE it on this connection first if needed)
+def _execute_prepared_statement(statement_name, sql_params, cursor, db_conn):
+
+    prepared_statement = prepared_statements[statement_name]
+
+    # Prepared statements live for the whole session (a later rollback doesn't remove them), so record the prepare as soon as it succeeds
+    if not statement_is_prepared_on_connection(statement_name, db_conn):
+        cursor.execute(prepared_statement["prepare_statement"])
+        record_prepared_statement_prepare(statement_name, db_conn)
+
+    param_names = prepared_statement["param_names"]
+    if len(param_names) == 0:
+        cursor.execute(f"EXECUTE {statement_name};")
+    else:
+        cursor.execute(
+            f"EXECUTE {statement_name} ({', '.join(['%s'] * len(param_names))});",
+            tuple(sql_params[param_name] for param_name in param_names))
+
+    record_prepared_statement_execution(statement_name)
+
+# %% Excute a registered prepared statement, return dataframe
+def execute_prepared_sql_return_df(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            _execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            data = cursor.fetchall()
+            _finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, len(data), db_conn, logger)
+            col_names = [desc[0] for desc in cursor.description]
+            return pd.DataFrame(data, columns=col_names)
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | execute_prepared_sql_return_df()"
+        error_message = f"execute_prepared_sql_return_df() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+# %% Excute a registered prepared statement, return rows (named tuples; see execute_sql_return_rows())
+def execute_prepared_sql_return_rows(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        with db_conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+
+            start_time = time.perf_counter()
+
+            _execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            rows = cursor.fetchall()
+            _finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, len(rows), db_conn, logger)
+
+            return rows
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | execute_prepared_sql_return_rows()"
+        error_message = f"execute_prepared_sql_return_rows() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+def execute_prepared_sql_return_one_row(statement_name, sql_params, db_conn, logger):
+
+    rows = execute_prepared_sql_return_rows(statement_name=statement_name, sql_params=sql_params, db_conn=db_conn, logger=logger)
+    return get_one_row(rows, f"Prepared Statement: {statement_name}")
+
+# %% Excute a registered prepared statement, return status message (no data returned)
+def execute_prepared_sql_return_status_message(statement_name, sql_params, db_conn, logger):
+
+    try:
+
+        with db_conn.cursor() as cursor:
+
+            start_time = time.perf_counter()
+
+            _execute_prepared_statement(statement_name, sql_params, cursor, db_conn)
+
+            _commit_unless_in_transaction(db_conn) # note that any other transactions using this db_conn will be committed as well (skipped inside transaction(), which commits once at the end)
+
+            _finish_query_timing(statement_name, prepared_statements[statement_name]["sql_statement"], sql_params, start_time, cursor.rowcount, db_conn, logger)
+
+            return {"status": "success", "status_message": cursor.statusmessage} # the message like 'INSERT 0 1' that is returned after running a postgresql command (EXECUTE returns the prepared statement's message)
+
+    except Exception as e:
+
+        _rollback_unless_in_transaction(db_conn) # rollback any changes made to the database during this failed transaction (inside transaction(), the scope rolls back)    
+
+        error_class = f"API | execute_prepared_sql_return_status_message()"
+        error_message = f"execute_prepared_sql_return_status_message() failed; Error: {e}, Prepared Statement: {statement_name}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        
+        return {"status": "failure", "status_message": f"error: {e}"}
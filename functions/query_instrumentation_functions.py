@@ -0,0 +1,141 @@
+import re
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime
+
+# Custom imports
+from logging_functions import get_logger
+
+# %% Query Instrumentation Overview
+
+# Every execute_* helper in postgresql_db_functions.py / async_postgresql_db_functions.py records each statement's wall time and rows returned here
+# Statements are identified by their prepared statement / statement_name (e.g., "experimenter_log", "schedule_messages") or, if they don't have one, by a short fingerprint of their SQL
+# Statements slower than slow_query_threshold_seconds are also written to the slow query log (optionally with their EXPLAIN (ANALYZE, BUFFERS) plan)
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_query_instrumentation(slow_query_threshold_seconds = 0.5, capture_explain_plans = True, slow_query_log_file_path = "slow_queries.log")
+
+# # See how each statement is performing (e.g., is the experimenter log CTE regressing as tables grow?)
+# get_query_timing_stats()["experimenter_log"] -> {"count": 1520, "total_seconds": 91.2, "avg_seconds": 0.06, "max_seconds": 1.3, "total_rows": 30400, "histogram": {"0.005": 0, ..., "+Inf": 0}}
+
+# # Most recent slow queries (also written to the slow query log)
+# get_recent_slow_queries()
+
+# Upper bounds (seconds) of the histogram buckets; anything slower lands in "+Inf"
+QUERY_TIMING_BUCKETS_SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+query_instrumentation_settings = {
+    "slow_query_threshold_seconds": 0.5,
+    "capture_explain_plans": False, # EXPLAIN ANALYZE re-runs the statement, so we only ever do it for read-only statements
+    "slow_query_logger": None} # dedicated logger (e.g., writing to a slow query log file); None logs slow queries with the caller's logger
+
+_query_timing_stats = {} # statement_identity -> {"count", "total_seconds", "max_seconds", "total_rows", "bucket_counts"}
+_recent_slow_queries = deque(maxlen=100)
+_query_instrumentation_lock = threading.Lock()
+
+
+# %% Configure query instrumentation
+def configure_query_instrumentation(slow_query_threshold_seconds=0.5, capture_explain_plans=False, slow_query_log_file_path=None):
+
+    query_instrumentation_settings["slow_query_threshold_seconds"] = slow_query_threshold_seconds
+    query_instrumentation_settings["capture_explain_plans"] = capture_explain_plans
+
+    if slow_query_log_file_path is not None and query_instrumentation_settings["slow_query_logger"] is None:
+        query_instrumentation_settings["slow_query_logger"] = get_logger(log_file_path=slow_query_log_file_path, logger_name="slow_queries")
+
+
+# %% Identify a statement
+# Use the statement_name if we have one; otherwise a readable prefix of the SQL (comments and whitespace removed) plus a hash of the full SQL
+def get_statement_identity(sql_statement, statement_name=None):
+
+    if statement_name is not None:
+        return statement_name
+
+    sql_without_comments = re.sub(r"/\*.*?\*/|--[^\n]*", " ", sql_statement, flags=re.DOTALL)
+    normalized_sql = " ".join(sql_without_comments.split())
+
+    return f"{normalized_sql[:60]} [{hashlib.md5(normalized_sql.encode()).hexdigest()[:8]}]"
+
+# EXPLAIN ANALYZE executes the statement, so only capture plans for statements that can't write
+def statement_is_read_only(sql_statement):
+
+    sql_without_comments = re.sub(r"/\*.*?\*/|--[^\n]*", " ", sql_statement, flags=re.DOTALL)
+
+    return (re.match(r"\s*(SELECT|WITH)\b", sql_without_comments, flags=re.IGNORECASE) is not None and
+            re.search(r"\b(INSERT|UPDATE|DELETE|MERGE|pg_notify|nextval)\b", sql_without_comments, flags=re.IGNORECASE) is None)
+
+
+# %% Record a statement's timing (returns True if the statement was slow)
+def record_query_timing(statement_identity, elapsed_seconds, row_count):
+
+    with _query_instrumentation_lock:
+
+        stats = _query_timing_stats.get(statement_identity)
+        if stats is None:
+            stats = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "total_rows": 0, "bucket_counts": [0] * (len(QUERY_TIMING_BUCKETS_SECONDS) + 1)}
+            _query_timing_stats[statement_identity] = stats
+
+        stats["count"] += 1
+        stats["total_seconds"] += elapsed_seconds
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed_seconds)
+        stats["total_rows"] += row_count if row_count is not None and row_count > 0 else 0
+
+        bucket_index = next((index for index, upper_bound in enumerate(QUERY_TIMING_BUCKETS_SECONDS) if elapsed_seconds <= upper_bound), len(QUERY_TIMING_BUCKETS_SECONDS))
+        stats["bucket_counts"][bucket_index] += 1
+
+    return elapsed_seconds >= query_instrumentation_settings["slow_query_threshold_seconds"]
+
+
+# %% Write a slow statement to the slow query log
+def log_slow_query(statement_identity, sql_statement, sql_params, elapsed_seconds, row_count, explain_plan, logger):
+
+    slow_query = {
+        "logged_datetime": datetime.utcnow(),
+        "statement_identity": statement_identity,
+        "elapsed_seconds": round(elapsed_seconds, 4),
+        "row_count": row_count,
+        "sql_statement": sql_statement,
+        "sql_params": sql_params,
+        "explain_plan": explain_plan}
+
+    with _query_instrumentation_lock:
+        _recent_slow_queries.append(slow_query)
+
+    slow_query_message = f"Slow query: {statement_identity}; elapsed_seconds: {elapsed_seconds:.3f}; row_count: {row_count}; sql_params: {sql_params}; SQL Statement: {sql_statement}"
+    if explain_plan is not None:
+        slow_query_message += f"\nEXPLAIN (ANALYZE, BUFFERS):\n{explain_plan}"
+
+    if query_instrumentation_settings["slow_query_logger"] is None:
+
+        logger.warning(slow_query_message)
+
+    else:
+
+        logger.warning(f"Slow query: {statement_identity} took {elapsed_seconds:.3f} seconds ({row_count} rows); see slow query log")
+        query_instrumentation_settings["slow_query_logger"].warning(slow_query_message)
+
+
+# %% Report on statement timings
+def get_query_timing_stats():
+
+    bucket_labels = [str(upper_bound) for upper_bound in QUERY_TIMING_BUCKETS_SECONDS] + ["+Inf"]
+
+    with _query_instrumentation_lock:
+
+        return {
+            statement_identity: {
+                "count": stats["count"],
+                "total_seconds": stats["total_seconds"],
+                "avg_seconds": stats["total_seconds"] / stats["count"],
+                "max_seconds": stats["max_seconds"],
+                "total_rows": stats["total_rows"],
+                "histogram": dict(zip(bucket_labels, stats["bucket_counts"]))}
+            for statement_identity, stats in _query_timing_stats.items()}
+
+def get_recent_slow_queries():
+
+    with _query_instrumentation_lock:
+        return list(_recent_slow_queries)
@@ -0,0 +1,189 @@
+import threading
+import time
+import itertools
+from contextlib import asynccontextmanager
+
+# %% Read Replica Overview
+
+# Pure reads (e.g., the experimenter log) can be served by read replicas so they don't compete with writes on the primary
+# Reads that lead to side effects outside the database (e.g., the messages schedule_messages() sends) stay on the primary: a lagging replica would hand out work that's already been done
+# Replicas are optional and configured in db_connection_parameters (anything not set on a replica is taken from the primary):
+# PROD_DB_CONNECTION_PARAMETERS={"db": "production_7crrss", "host": "primary.example.com", "user": "admin", "password": "...", "port": "5432",
+#                                "replicas": [{"host": "replica-1.example.com"}, {"host": "localhost", "port": "5433"}],
+#                                "replica_staleness_window_seconds": 10}
+# create_db_connection_pool() / create_async_db_connection_pool() open one pool per replica and attach them to the primary pool (so callers keep passing around a single db_pool)
+
+# Replicas lag the primary slightly, so right after a write we send that routing key's reads (e.g., a public_user_id reading back the observation they just submitted) to the primary
+# for replica_staleness_window_seconds. Writes are recorded per worker process; the window should comfortably exceed the replicas' typical replication lag
+# A replica whose checkout fails is skipped (reads go to the primary / other replicas) for replica_failure_cooldown_seconds
+
+# ## Sample Use
+
+# # Sync (e.g., background tasks)
+# db_conn, read_db_pool = getconn_for_read(db_pool = db_pool, routing_key = public_user_id, logger = logger)
+# try:
+#     df = execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
+# finally:
+#     read_db_pool.putconn(db_conn)
+
+# # Async (endpoints)
+# async with async_read_connection(async_db_pool = async_db_pool, routing_key = public_user_id, logger = logger) as db_conn:
+#     df = await async_execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
+
+# # After a write, keep that key's reads on the primary for a while
+# record_write(routing_key = public_user_id)
+
+DEFAULT_REPLICA_STALENESS_WINDOW_SECONDS = 5
+REPLICA_FAILURE_COOLDOWN_SECONDS = 30
+
+_recent_writes = {} # routing_key -> time.monotonic() of its last write
+_last_write_to_every_key = None # time.monotonic() of the last time we lost track of writes (e.g., the cache invalidation listener reconnected)
+_replica_failures = {} # id(replica_db_pool) -> time.monotonic() of its last failed checkout
+_replica_round_robin = itertools.count()
+_replica_routing_metrics = {"reads_routed_to_replica": 0, "reads_routed_to_primary": 0, "reads_kept_on_primary_after_write": 0, "replica_checkout_failures": 0}
+_replica_routing_lock = threading.Lock()
+
+
+# %% Replica configuration
+# Full connection parameters for each replica (replica values override the primary's)
+def get_replica_connection_parameters(db_connection_parameters):
+
+    primary_connection_parameters = {key: value for key, value in db_connection_parameters.items() if key not in ("replicas", "replica_staleness_window_seconds")}
+
+    return [{**primary_connection_parameters, **replica} for replica in db_connection_parameters.get("replicas", [])]
+
+def get_replica_staleness_window_seconds(db_connection_parameters):
+
+    return float(db_connection_parameters.get("replica_staleness_window_seconds", DEFAULT_REPLICA_STALENESS_WINDOW_SECONDS))
+
+# Attach the replica pools to the primary pool (sync DBConnectionPool or psycopg_pool AsyncConnectionPool)
+def attach_replica_db_pools(db_pool, replica_db_pools, staleness_window_seconds):
+
+    db_pool.replica_db_pools = replica_db_pools
+    db_pool.replica_staleness_window_seconds = staleness_window_seconds
+
+def get_replica_db_pools(db_pool):
+
+    return getattr(db_pool, "replica_db_pools", [])
+
+
+# %% Track writes (so a key's reads stay on the primary until the replicas have caught up)
+def record_write(routing_key):
+
+    if routing_key is None:
+        return
+
+    with _replica_routing_lock:
+
+        now = time.monotonic()
+        _recent_writes[routing_key] = now
+
+        # Keep the dict small (anything older than a minute is past any sensible staleness window)
+        if len(_recent_writes) > 10000:
+            for key, written_at in list(_recent_writes.items()):
+                if now - written_at > 60:
+                    del _recent_writes[key]
+
+# When we may have missed other workers' writes (see listen_for_cache_invalidations()), keep every key's reads on the primary for the staleness window
+def record_write_to_every_key():
+
+    global _last_write_to_every_key
+
+    with _replica_routing_lock:
+        _last_write_to_every_key = time.monotonic()
+
+def _wrote_recently(routing_key, staleness_window_seconds):
+
+    now = time.monotonic()
+
+    if _last_write_to_every_key is not None and now - _last_write_to_every_key < staleness_window_seconds:
+        return True
+
+    written_at = _recent_writes.get(routing_key)
+
+    return written_at is not None and now - written_at < staleness_window_seconds
+
+
+# %% Choose the pool to read from
+# Returns a healthy replica pool (round robin) or db_pool itself (no replicas, all replicas failing, or routing_key wrote recently)
+# routing_key can also be a list of keys (e.g., a batch of public_user_ids): the read stays on the primary if any of them wrote recently
+def choose_read_db_pool(db_pool, routing_key=None):
+
+    replica_db_pools = get_replica_db_pools(db_pool)
+    routing_keys = routing_key if isinstance(routing_key, list) else [routing_key]
+
+    with _replica_routing_lock:
+
+        if len(replica_db_pools) == 0:
+            _replica_routing_metrics["reads_routed_to_primary"] += 1
+            return db_pool
+
+        if any(key is not None and _wrote_recently(key, db_pool.replica_staleness_window_seconds) for key in routing_keys):
+            _replica_routing_metrics["reads_kept_on_primary_after_write"] += 1
+            _replica_routing_metrics["reads_routed_to_primary"] += 1
+            return db_pool
+
+        now = time.monotonic()
+        healthy_replica_db_pools = [replica_db_pool for replica_db_pool in replica_db_pools if now - _replica_failures.get(id(replica_db_pool), -REPLICA_FAILURE_COOLDOWN_SECONDS) >= REPLICA_FAILURE_COOLDOWN_SECONDS]
+
+        if len(healthy_replica_db_pools) == 0:
+            _replica_routing_metrics["reads_routed_to_primary"] += 1
+            return db_pool
+
+        _replica_routing_metrics["reads_routed_to_replica"] += 1
+        return healthy_replica_db_pools[next(_replica_round_robin) % len(healthy_replica_db_pools)]
+
+def _record_replica_failure(replica_db_pool, error, logger):
+
+    with _replica_routing_lock:
+        _replica_failures[id(replica_db_pool)] = time.monotonic()
+        _replica_routing_metrics["replica_checkout_failures"] += 1
+
+    logger.warning(f"Read replica checkout failed; reading from the primary for the next {REPLICA_FAILURE_COOLDOWN_SECONDS} seconds; Error: {error}")
+
+
+# %% Check out a connection for read-only queries (sync)
+# Returns (db_conn, read_db_pool); return the connection with read_db_pool.putconn(db_conn)
+def getconn_for_read(db_pool, routing_key, logger):
+
+    read_db_pool = choose_read_db_pool(db_pool, routing_key)
+
+    if read_db_pool is not db_pool:
+
+        try:
+            return read_db_pool.getconn(), read_db_pool
+        except Exception as e:
+            _record_replica_failure(read_db_pool, e, logger)
+
+    return db_pool.getconn(), db_pool
+
+
+# %% Check out a connection for read-only queries (async)
+@asynccontextmanager
+async def async_read_connection(async_db_pool, routing_key, logger):
+
+    read_db_pool = choose_read_db_pool(async_db_pool, routing_key)
+    db_conn = None
+
+    if read_db_pool is not async_db_pool:
+
+        try:
+            db_conn = await read_db_pool.getconn()
+        except Exception as e:
+            _record_replica_failure(read_db_pool, e, logger)
+            read_db_pool = async_db_pool
+
+    if db_conn is None:
+        db_conn = await async_db_pool.getconn()
+
+    try:
+        yield db_conn
+    finally:
+        await read_db_pool.putconn(db_conn)
+
+
+# %% Report on routing
+def get_replica_routing_metrics():
+
+    with _replica_routing_lock:
+        return dict(_replica_routing_metrics)
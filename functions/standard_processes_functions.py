@@ -8,80 +8,22 @@ from honeybadger import honeybadger
 import traceback
 from sendgrid import SendGridAPIClient
 from datetime import datetime
+from contextlib import closing
+import pandas as pd
 
 # Custom imports
-from postgresql_db_functions import create_db_connection, execute_sql_return_df, executemany_sql_return_status_message
+from postgresql_db_functions import execute_sql_yield_chunks, bulk_write_with_copy
 from short_io_functions import generate_short_url
 from sendgrid_functions import send_email
+from catalog_functions import refresh_catalog_if_changed
 
 
-# Schedule messages to be sent out in the next 72 hours
-def schedule_messages(db_connection_parameters, sendgrid_api_key, short_io_api_key, logger) -> dict:
+# Schedule one chunk of messages (a dataframe of rows from the query in schedule_messages()) and record the outcome in the database
+# Returns a summary of each message (user_email, email_subject, action_datetime, status, status_note) for the status email
+def schedule_message_chunk(df_messages, catalog, sendgrid_client, short_io_api_key, db_conn, logger):
 
     try:
 
-        # Get database connection
-        db_conn = None # initialize db_conn as None so that the finally block doesn't error out if the db_conn variable doesn't exist
-        db_conn = create_db_connection(db_connection_parameters, logger)
-
-        ## Create connection to SendGrid (for sending emails)
-        # Note that you'll need to enable all of the actions you want to take in SendGrid's UI when you create the API key (e.g., scheduledule sends)
-        sendgrid_client = SendGridAPIClient(sendgrid_api_key)
-
-        ## Identify messages to schedule
-        logger.info("Identify messages to schedule")
-
-        # Define sql query (use parameters rather than f-string to avoid SQL injection)
-        sql_params = None
-        sql_statement = """
-SELECT
-    sga.id AS sub_group_action_id,
-	sg.id AS sub_group_id,
-	u.first_name,
-	u.email AS user_email,
-    u.url_stub_experimenter_log,
-	g.group_name,
-	sg.sub_group_name,
-	sgat.email_subject,
-	sgat.email_body,
-    sga.action_datetime,
-    sga.status
-FROM 
-	sub_group_actions sga, 
-	sub_group_action_templates sgat, 
-	sub_groups sg, 
-	groups g, 
-	users u,
-	group_assignments ga
-WHERE
-	sga.status IN ('message_to_be_scheduled', 'message_failed_to_schedule') AND -- restrict to messages that need to be scheduled
-	sga.action_datetime BETWEEN NOW() + interval '30 minutes' AND NOW() + interval '72 hours' AND -- restrict to the message needs to be sent in the next 72 hours (the furtherest in advance that SendGrid will schedule an email), but no earlier than 30 minutes from now (to allow time for the message to be scheduled and SendGrid's 15 minute cutoff for scheduled messages)
-	sgat.id = sga.sub_group_action_template_id AND -- pull on sub_group_action_templates info (email_subject, email_body, sub_group_id)
-	sg.id = sgat.sub_group_id AND -- pull on sub_groups info (sub_group_name, group_id)
-	g.id = sg.group_id AND -- pull on groups info (group_name)
-	u.id = sga.user_id AND -- pull on user info (email, first_name)
-	ga.status = 'active' AND ga.user_id = u.id AND ga.group_id = g.id; -- restrict to messages for groups where the user is an active participant (not paused, canceled). note that we should set sub_group_actions.status = 'canceled' if the user pauses a group, so this is just a double precaution"""
-
-        # Pull data from database
-        df_messages = execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)
-
-        ## If no messages to schedule, send status email and return message
-        if len(df_messages) == 0:
-            
-            logger.info("No messages to schedule")
-
-            send_email(
-                from_email = 'experiments@tryexperimenter.com', 
-                from_display_name = 'Experimenter',
-                to_email = 'tristan@tryexperimenter.com', 
-                subject = f'schedule_messages() - {datetime.now().strftime("%Y-%m-%d")} - no messages to schedule', 
-                message_text_html = 'There were no messages to schedule.', 
-                add_unsubscribe_link = False,
-                sendgrid_client = sendgrid_client, 
-                logger = logger)
-
-            return {"message": "No messages to schedule."}
-
         # Select the sender email address
         df_messages['sender_email'] = 'experiments@tryexperimenter.com'
         df_messages['sender_display_name'] = 'Experimenter'
@@ -92,29 +34,14 @@ WHERE
         ## Identify experiment prompts to include in messages
         logger.info("Identify experiment prompts to include in messages")
 
-        # Define sql query (pull experiment prompts for each sub_group_id associated with a message we want to schedule)
+        # Look up the experiment prompts for each sub_group_id associated with a message we want to schedule in the catalog (static content; see catalog_functions.py)
+        # dict_experiment_prompts: each sub_group_id is a key, and the value is an ordered list of experiment prompts (sub_group_ids without prompts, e.g., rest weeks, are left out)
+        # Example: dict_experiment_prompts = {'0644ddb2baea156e84b8': ['Ask "why do you think this is important?"', "Get a (virtual) coffee with a colleague you don't know that well.", 'Celebrate a colleague (perhaps even publicly).'], '3166b227e57b89f3d68d': ['Learn something from a mistake.', "Play devil's advocate.", 'Practice active listening.']}
         sub_group_ids = tuple(df_messages['sub_group_id'].unique())
-        sql_params = {'sub_group_ids': sub_group_ids}
-        sql_statement = """
-SELECT 
-	sub_group_id,
-	experiment_prompt,
-	display_order
-FROM experiment_prompts
-WHERE sub_group_id IN %(sub_group_ids)s;"""
-
-        # Pull data from database
         logger.info(f"sub_group_ids: {sub_group_ids}")
-        df_experiment_prompts = execute_sql_return_df(sql_statement = sql_statement, sql_params = sql_params, db_conn = db_conn, logger = logger)        
-
-        # Create dictionary of experiment prompts (each sub_group_id is a key, and the value is an ordered list of experiment prompts)
-        # Example
-        # In: df_experiment_prompts = pd.DataFrame([{"sub_group_id":"66cb527749c57fb78d6f","experiment_prompt":"Seek input from a total stranger.","display_order":1},{"sub_group_id":"66cb527749c57fb78d6f","experiment_prompt":"Ask for a favor.","display_order":2},{"sub_group_id":"66cb527749c57fb78d6f","experiment_prompt":"Discuss an \"undiscussable\" issue.","display_order":3},{"sub_group_id":"3166b227e57b89f3d68d","experiment_prompt":"Learn something from a mistake.","display_order":1},{"sub_group_id":"3166b227e57b89f3d68d","experiment_prompt":"Play devil's advocate.","display_order":2},{"sub_group_id":"3166b227e57b89f3d68d","experiment_prompt":"Practice active listening.","display_order":3},{"sub_group_id":"0644ddb2baea156e84b8","experiment_prompt":"Ask \"why do you think this is important?\"","display_order":1},{"sub_group_id":"0644ddb2baea156e84b8","experiment_prompt":"Get a (virtual) coffee with a colleague you don't know that well.","display_order":2},{"sub_group_id":"0644ddb2baea156e84b8","experiment_prompt":"Celebrate a colleague (perhaps even publicly).","display_order":3},{"sub_group_id":"63c09c65c6b1822f11ad","experiment_prompt":"Take an hour (or two) to do something you've been putting off.","display_order":1},{"sub_group_id":"63c09c65c6b1822f11ad","experiment_prompt":"When someone does something that doesn't make sense, take 1 minute think about why they did it.","display_order":2},{"sub_group_id":"63c09c65c6b1822f11ad","experiment_prompt":"Cross one thing off your to do list without actually doing it.","display_order":3}])
-        # Out: dict_experiment_prompts = {'0644ddb2baea156e84b8': ['Ask "why do you think this is important?"', "Get a (virtual) coffee with a colleague you don't know that well.", 'Celebrate a colleague (perhaps even publicly).'], '3166b227e57b89f3d68d': ['Learn something from a mistake.', "Play devil's advocate.", 'Practice active listening.'], '63c09c65c6b1822f11ad': ["Take an hour (or two) to do something you've been putting off.", "When someone does something that doesn't make sense, take 1 minute think about why they did it.", 'Cross one thing off your to do list without actually doing it.'], '66cb527749c57fb78d6f': ['Seek input from a total stranger.', 'Ask for a favor.', 'Discuss an "undiscussable" issue.']}
-        df_experiment_prompts = df_experiment_prompts.sort_values(
-            by=['sub_group_id', 'display_order'],
-            ascending=[True, True])
-        dict_experiment_prompts = df_experiment_prompts.groupby('sub_group_id').agg(list).to_dict()['experiment_prompt']
+        dict_experiment_prompts = {
+            sub_group_id: [experiment_prompt.experiment_prompt for experiment_prompt in catalog.experiment_prompts_by_sub_group[sub_group_id]]
+            for sub_group_id in sub_group_ids if sub_group_id in catalog.experiment_prompts_by_sub_group}
         
         ## Generate URLs to include in messages
         logger.info(f"""Generating URLs to include in messages""")
@@ -275,49 +202,59 @@ WHERE sub_group_id IN %(sub_group_ids)s;"""
                 df_messages.loc[index, ['status_note']] = error_message
 
 
-        ## Update sub_group_actions table
-        logger.info(f"Update sub_group_actions table")
+        ## Update sub_group_actions table (status of every message) and sub_group_action_emails table (messages that were successfully scheduled)
+        # We stage the rows with COPY and apply one UPDATE and one INSERT, all in one transaction (rather than one round trip per message)
+        logger.info(f"Update sub_group_actions table and sub_group_action_emails table")
 
         try:
 
-            tuples = [tuple(x) for x in df_messages[['status', 'sub_group_action_id']].values]
-
-            sql_statement = 'UPDATE sub_group_actions SET status = %s WHERE id = %s;'
-
-            response = executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger)
-
-            logger.info(f"Update sub_group_actions table response: {response}")
-
-        except Exception as e:
-
-            error_message = f"schedule_messages() error updating sub_group_actions table; Error: {e}"
-            logger.error(error_message)
-            logger.error(traceback.format_exc())
-
-
-        ## Update sub_group_action_emails table
-        logger.info(f"Update sub_group_action_emails table")
-
-        try:
+            # Status of every message
+            staging_tables = [{
+                "staging_table_name": "staging_sub_group_action_statuses",
+                "staging_table_query": "SELECT id AS sub_group_action_id, status FROM sub_group_actions",
+                "columns": ["sub_group_action_id", "status"],
+                "rows": df_messages[['sub_group_action_id', 'status']].itertuples(index=False, name=None)}]
+            sql_statements = {
+                "update_sub_group_actions": """
+UPDATE sub_group_actions sga
+SET status = s.status
+FROM staging_sub_group_action_statuses s
+WHERE sga.id = s.sub_group_action_id;"""}
 
             # Only add rows for messages that were successfully scheduled
             df_scheduled_messages = df_messages[df_messages['status'] == 'message_scheduled']
 
             if len(df_scheduled_messages) > 0:
 
-                tuples = [tuple(x) for x in df_scheduled_messages[[
-                    'sub_group_action_id',
-                    'status',
-                    'x_message_id',
-                    'batch_id',
-                    'sender_email',
-                    'user_email',
-                    'email_subject',
-                    'email_body',
-                    'enqueued_datetime',
-                    'action_datetime']].values]
-
-                sql_statement = '''INSERT INTO sub_group_action_emails (
+                staging_tables.append({
+                    "staging_table_name": "staging_sub_group_action_emails",
+                    "staging_table_query": """
+SELECT 
+    sub_group_action_id, 
+    status, 
+    twilio_x_message_id, 
+    twilio_batch_id, 
+    sender, 
+    recipient, 
+    email_subject, 
+    email_body, 
+    enqueued_datetime, 
+    scheduled_datetime
+FROM sub_group_action_emails""",
+                    "columns": ["sub_group_action_id", "status", "twilio_x_message_id", "twilio_batch_id", "sender", "recipient", "email_subject", "email_body", "enqueued_datetime", "scheduled_datetime"],
+                    "rows": df_scheduled_messages[[
+                        'sub_group_action_id',
+                        'status',
+                        'x_message_id',
+                        'batch_id',
+                        'sender_email',
+                        'user_email',
+                        'email_subject',
+                        'email_body',
+                        'enqueued_datetime',
+                        'action_datetime']].itertuples(index=False, name=None)})
+                sql_statements["insert_sub_group_action_emails"] = """
+INSERT INTO sub_group_action_emails (
 sub_group_action_id, 
 status, 
 twilio_x_message_id, 
@@ -328,21 +265,124 @@ email_subject,
 email_body, 
 enqueued_datetime, 
 scheduled_datetime)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'''
+SELECT * FROM staging_sub_group_action_emails;"""
 
-                response = executemany_sql_return_status_message(sql_statement, tuples, db_conn, logger)
-
-                logger.info(f"Update sub_group_action_emails table response: {response}")
             else:
 
                 logger.info(f"No rows to add to sub_group_action_emails table")
 
+            response = bulk_write_with_copy(staging_tables=staging_tables, sql_statements=sql_statements, db_conn=db_conn, logger=logger)
+
+            logger.info(f"Update sub_group_actions table and sub_group_action_emails table response: {response}")
+
         except Exception as e:
-                
-            # Log error
-            error_message = f"schedule_messages() error updating sub_group_action_emails table; Error: {e}"
+
+            error_message = f"schedule_messages() error updating sub_group_actions table and sub_group_action_emails table; Error: {e}"
             logger.error(error_message)
             logger.error(traceback.format_exc())
+
+        return df_messages[['user_email', 'email_subject', 'action_datetime', 'status', 'status_note']]
+
+    except Exception as e:
+
+        error_class = f"API | schedule_message_chunk()"
+        error_message = f"schedule_message_chunk() failed; Error: {e}"
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)        
+        raise Exception(error_message)
+
+
+# Schedule messages to be sent out in the next 72 hours
+def schedule_messages(db_pool, sendgrid_api_key, short_io_api_key, logger, message_chunk_size=200) -> dict:
+
+    try:
+
+        # Get database connections from the pool
+        # read_db_conn streams the messages to schedule (server-side cursor); db_conn does everything else (its commits would close the server-side cursor)
+        # Both are on the primary: the messages we pick up get sent through SendGrid, so we can't read them from a replica that might not have another run's statuses yet (they'd be sent twice)
+        db_conn, read_db_conn = None, None # initialize as None so that the finally block doesn't error out if the variables don't exist
+        db_conn = db_pool.getconn() # check out a connection from the shared pool (created once in main.py)
+        read_db_conn = db_pool.getconn()
+
+        ## Create connection to SendGrid (for sending emails)
+        # Note that you'll need to enable all of the actions you want to take in SendGrid's UI when you create the API key (e.g., scheduledule sends)
+        sendgrid_client = SendGridAPIClient(sendgrid_api_key)
+
+        ## Make sure the catalog (experiment prompts for the messages) is current (one cheap change token query unless the content changed)
+        catalog = refresh_catalog_if_changed(db_conn = db_conn, logger = logger)
+
+        ## Identify messages to schedule
+        logger.info("Identify messages to schedule")
+
+        # Define sql query (use parameters rather than f-string to avoid SQL injection)
+        sql_params = None
+        sql_statement = """
+SELECT
+    sga.id AS sub_group_action_id,
+	sg.id AS sub_group_id,
+	u.first_name,
+	u.email AS user_email,
+    u.url_stub_experimenter_log,
+	g.group_name,
+	sg.sub_group_name,
+	sgat.email_subject,
+	sgat.email_body,
+    sga.action_datetime,
+    sga.status
+FROM 
+	sub_group_actions sga, 
+	sub_group_action_templates sgat, 
+	sub_groups sg, 
+	groups g, 
+	users u,
+	group_assignments ga
+WHERE
+	sga.status IN ('message_to_be_scheduled', 'message_failed_to_schedule') AND -- restrict to messages that need to be scheduled
+	sga.action_datetime BETWEEN NOW() + interval '30 minutes' AND NOW() + interval '72 hours' AND -- restrict to the message needs to be sent in the next 72 hours (the furtherest in advance that SendGrid will schedule an email), but no earlier than 30 minutes from now (to allow time for the message to be scheduled and SendGrid's 15 minute cutoff for scheduled messages)
+	sgat.id = sga.sub_group_action_template_id AND -- pull on sub_group_action_templates info (email_subject, email_body, sub_group_id)
+	sg.id = sgat.sub_group_id AND -- pull on sub_groups info (sub_group_name, group_id)
+	g.id = sg.group_id AND -- pull on groups info (group_name)
+	u.id = sga.user_id AND -- pull on user info (email, first_name)
+	ga.status = 'active' AND ga.user_id = u.id AND ga.group_id = g.id; -- restrict to messages for groups where the user is an active participant (not paused, canceled). note that we should set sub_group_actions.status = 'canceled' if the user pauses a group, so this is just a double precaution"""
+
+        # Pull messages from database in chunks (named server-side cursor on read_db_conn, so memory stays flat however many messages are due at once)
+        # Each chunk is scheduled and written to the database (on db_conn) before we pull the next one; we only keep a small summary of each message for the status email
+        list_df_summaries = []
+        with closing(execute_sql_yield_chunks(sql_statement = sql_statement, sql_params = sql_params, db_conn = read_db_conn, logger = logger, chunk_size = message_chunk_size, statement_name = "schedule_messages")) as message_chunks:
+
+            for df_messages in message_chunks:
+
+                logger.info(f"Scheduling chunk of {len(df_messages)} messages")
+
+                list_df_summaries.append(schedule_message_chunk(
+                    df_messages = df_messages,
+                    catalog = catalog,
+                    sendgrid_client = sendgrid_client,
+                    short_io_api_key = short_io_api_key,
+                    db_conn = db_conn,
+                    logger = logger))
+
+        ## If no messages to schedule, send status email and return message
+        if len(list_df_summaries) == 0:
+            
+            logger.info("No messages to schedule")
+
+            send_email(
+                from_email = 'experiments@tryexperimenter.com', 
+                from_display_name = 'Experimenter',
+                to_email = 'tristan@tryexperimenter.com', 
+                subject = f'schedule_messages() - {datetime.now().strftime("%Y-%m-%d")} - no messages to schedule', 
+                message_text_html = 'There were no messages to schedule.', 
+                add_unsubscribe_link = False,
+                sendgrid_client = sendgrid_client, 
+                logger = logger)
+
+            return {"message": "No messages to schedule."}
+
+        # Combine the summaries of every chunk (user_email, email_subject, action_datetime, status, status_note for each message)
+        df_messages = pd.concat(list_df_summaries, ignore_index = True)
+
                 
         ## Send status email update, return outcome of schedule_messages()
         logger.info(f"Send status email update, return outcome of schedule_messages()")
@@ -424,6 +464,8 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'''
 
     finally:
 
-        # Close database connection if it exists    
+        # Return database connections to the pool if we checked them out
         if db_conn is not None:
-            db_conn.close()        
\ No newline at end of file
+            db_pool.putconn(db_conn)
+        if read_db_conn is not None:
+            db_pool.putconn(read_db_conn)        
\ No newline at end of file
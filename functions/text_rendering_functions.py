@@ -0,0 +1,37 @@
+from functools import lru_cache
+import smartypants
+
+# %% Text Rendering Overview
+
+# Text shown in the experimenter log has "dumb" quotes, dashes, etc. converted to HTML "curly" quotes by smartypants
+# Rather than converting every prompt / observation on every request, we render text once:
+# - observations are rendered when they're written (observations.observation_formatted; see submit_observation() and backfill_observation_formatted())
+# - catalog text (group / sub_group names, experiment / observation prompts) is rendered when the catalog loads and memoized by render_catalog_text()
+
+# ## Sample Use
+
+# render_text('Discuss an "undiscussable" issue.') -> 'Discuss an &#8220;undiscussable&#8221; issue.'
+# render_text(None) -> '' (missing values would otherwise show up as null in the final JSON output)
+
+# Convert "dumb" quotes to HTML "curly" quotes
+def render_text(text):
+
+    if text is None:
+        text = ""
+
+    return smartypants.smartypants(text)
+
+# Memoized for static content; don't use for user text like observations
+# load_catalog() clears it when new content loads (so old prompts don't pile up), and maxsize bounds it in between (comfortably more than one catalog's text)
+@lru_cache(maxsize=10000)
+def render_catalog_text(text):
+
+    return render_text(text)
+
+# Use a stored rendering if we have one (e.g., observation_formatted), otherwise render now (e.g., observations written before observation_formatted existed)
+def render_stored_text(text, text_formatted):
+
+    if text_formatted is not None:
+        return text_formatted
+
+    return render_text(text)
@@ -0,0 +1,288 @@
+import asyncio
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from honeybadger import honeybadger
+
+# Custom imports
+from async_postgresql_db_functions import async_execute_sql_return_scalar
+
+# %% Throttle Overview
+
+# Endpoints that can be brute forced (guessing public_user_ids on /v1/experimenter-log/, auth codes on /v1/schedule-messages/) used to time.sleep() on every miss,
+# which froze the whole event loop (every user on the worker) and made the sleep itself a denial of service. Instead, each policy has:
+# - token buckets per client (IP address) and per key (e.g., the public_user_id / endpoint being guessed); every request takes its tokens up front, in one atomic step per bucket,
+#   and is turned away (429 with Retry-After) before we do any work if that leaves a bucket below 0, so concurrent guesses can't all see a full bucket.
+#   A hit gives its tokens back, so only misses (and turned away requests) use up the bucket; there's no floor, so a burst of them builds up debt that takes as long to refill
+# - an exponential back-off delay on each miss (base_delay_seconds doubling with each consecutive miss from the client, up to max_delay_seconds),
+#   awaited with asyncio.sleep() so only that request waits
+# Buckets live in memory per worker by default; PostgresThrottleBackend shares them across workers / instances (throttle_buckets table, see database_migration_functions.py)
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_throttle(enabled = True, backend = PostgresThrottleBackend(async_db_pool = async_db_pool), trusted_proxy_count = 1)
+
+# # In an endpoint: take the request's tokens, turning the client away if they've used up their misses
+# client_id = get_client_id(request)
+# retry_after_seconds = await async_check_throttle(policy_name = "experimenter_log", client_id = client_id, key = public_user_id, logger = logger)
+# (key = a list of public_user_ids for a request that guesses several at once: one token each)
+# if retry_after_seconds is not None: return 429 with Retry-After
+
+# # On a miss (unknown public_user_id, wrong auth code): back off (without blocking other requests); the token stays taken
+# await async_throttle_failure(policy_name = "experimenter_log", client_id = client_id, key = public_user_id, logger = logger)
+
+# # On a hit: give the tokens back and reset the client's back-off
+# await async_record_throttle_success(policy_name = "experimenter_log", client_id = client_id, key = public_user_id, logger = logger)
+
+# capacity: misses allowed in a burst; refill_per_second: how quickly misses are forgiven
+THROTTLE_POLICIES = {
+    "experimenter_log": { # unknown / inactive public_user_ids
+        "client_capacity": 20, "client_refill_per_second": 20 / 3600,
+        "key_capacity": 5, "key_refill_per_second": 5 / 3600,
+        "base_delay_seconds": 3, "max_delay_seconds": 30},
+    "schedule_messages": { # incorrect auth codes (per client only: a shared bucket for the endpoint would let an attacker lock out our scheduler)
+        "client_capacity": 5, "client_refill_per_second": 5 / 3600,
+        "base_delay_seconds": 10, "max_delay_seconds": 60}}
+
+CONSECUTIVE_FAILURE_RESET_SECONDS = 900 # a client's back-off starts over after 15 minutes without a miss
+
+throttle_settings = {
+    "enabled": True,
+    "backend": None, # None keeps buckets in memory (per worker); PostgresThrottleBackend shares them
+    "trusted_proxy_count": 0} # proxies in front of us that append to X-Forwarded-For (0: use the connecting address)
+
+_consecutive_failures = {} # (policy_name, client_id) -> (consecutive misses, time.monotonic() of the last miss)
+_throttle_metrics = {"checks": 0, "throttled": 0, "failures": 0, "delay_seconds": 0.0, "backend_errors": 0}
+_throttle_lock = threading.Lock()
+
+
+# %% Bucket backends
+# take_tokens() refills the bucket for the time since it was last touched, then takes tokens from it (a negative number gives tokens back, up to capacity)
+# There's no floor: misses past the limit put the bucket into debt. Returns the tokens left (below 0 means the request was over the limit)
+class InMemoryThrottleBackend:
+
+    def __init__(self, max_buckets=100000):
+
+        self.buckets = OrderedDict() # bucket_key -> (tokens, time.monotonic() of the last update); least recently used first
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+    def take_tokens_now(self, bucket_key, capacity, refill_per_second, tokens):
+
+        with self.lock:
+
+            now = time.monotonic()
+            bucket_tokens, updated_at = self.buckets.get(bucket_key, (capacity, now))
+            bucket_tokens = min(capacity, min(capacity, bucket_tokens + (now - updated_at) * refill_per_second) - tokens)
+
+            self.buckets[bucket_key] = (bucket_tokens, now)
+            self.buckets.move_to_end(bucket_key)
+
+            # Evict the least recently used buckets (a client that's still guessing touches its bucket on every request, so it stays)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+            return bucket_tokens
+
+    async def take_tokens(self, bucket_key, capacity, refill_per_second, tokens, logger):
+
+        return self.take_tokens_now(bucket_key, capacity, refill_per_second, tokens)
+
+# Shared across workers / instances (the refill and take happen in one statement, so concurrent requests can't both take the last token)
+class PostgresThrottleBackend:
+
+    TAKE_TOKENS_SQL_STATEMENT = """
+INSERT INTO throttle_buckets (bucket_key, tokens, updated_at)
+VALUES (%(bucket_key)s, LEAST(%(capacity)s, %(capacity)s - %(tokens)s), clock_timestamp())
+ON CONFLICT (bucket_key) DO UPDATE SET
+	tokens = LEAST(%(capacity)s, LEAST(%(capacity)s, throttle_buckets.tokens + EXTRACT(EPOCH FROM clock_timestamp() - throttle_buckets.updated_at) * %(refill_per_second)s) - %(tokens)s),
+	updated_at = clock_timestamp()
+RETURNING tokens;"""
+
+    def __init__(self, async_db_pool):
+
+        self.async_db_pool = async_db_pool
+
+    async def take_tokens(self, bucket_key, capacity, refill_per_second, tokens, logger):
+
+        sql_params = {"bucket_key": bucket_key, "capacity": capacity, "refill_per_second": refill_per_second, "tokens": tokens}
+
+        async with self.async_db_pool.connection() as db_conn:
+            bucket_tokens = await async_execute_sql_return_scalar(sql_statement=self.TAKE_TOKENS_SQL_STATEMENT, sql_params=sql_params, db_conn=db_conn, logger=logger, statement_name="throttle_take_tokens")
+
+        return float(bucket_tokens)
+
+_in_memory_backend = InMemoryThrottleBackend()
+
+
+# %% Configure the throttle
+def configure_throttle(enabled=True, backend=None, trusted_proxy_count=0):
+
+    throttle_settings["enabled"] = enabled
+    throttle_settings["backend"] = backend
+    throttle_settings["trusted_proxy_count"] = trusted_proxy_count
+
+# Client identity for per-client buckets: the connecting address, or, behind trusted_proxy_count proxies, the address the outermost of them appended to X-Forwarded-For
+# (counting from the right: everything to the left of what our proxies appended is whatever the client sent, so a client could pick a fresh bucket on every request)
+def get_client_id(request):
+
+    client_host = request.client.host if request.client is not None else "unknown"
+    trusted_proxy_count = throttle_settings["trusted_proxy_count"]
+
+    if trusted_proxy_count <= 0:
+        return client_host
+
+    forwarded_for = [address.strip() for address in request.headers.get("x-forwarded-for", "").split(",") if address.strip()]
+
+    # Each of our proxies appends one address, so fewer than that means the request didn't come through them
+    if len(forwarded_for) < trusted_proxy_count:
+        return client_host
+
+    return forwarded_for[-trusted_proxy_count]
+
+# The buckets a request takes tokens from: (bucket_key, capacity, refill_per_second, tokens)
+# key: the key being guessed (None if the policy has no key buckets), or a list of keys for a request that guesses several at once (one token from the client's bucket per key)
+def _bucket_keys(policy_name, client_id, key):
+
+    policy = THROTTLE_POLICIES[policy_name]
+    keys = list(dict.fromkeys(key)) if isinstance(key, list) else [key]
+    bucket_keys = [(f"{policy_name}:client:{client_id}", policy["client_capacity"], policy["client_refill_per_second"], len(keys))]
+
+    if "key_capacity" in policy:
+        bucket_keys += [(f"{policy_name}:key:{key}", policy["key_capacity"], policy["key_refill_per_second"], 1) for key in keys if key is not None]
+
+    return bucket_keys
+
+# Use the configured backend, falling back to memory if it errors (e.g., the database is unreachable) so the throttle never takes an endpoint down
+async def _take_tokens(bucket_key, capacity, refill_per_second, tokens, logger):
+
+    backend = throttle_settings["backend"]
+
+    if backend is not None:
+
+        try:
+
+            return await backend.take_tokens(bucket_key, capacity, refill_per_second, tokens, logger)
+
+        except Exception as e:
+
+            with _throttle_lock:
+                _throttle_metrics["backend_errors"] += 1
+
+            error_class = f"API | _take_tokens()"
+            error_message = f"Throttle backend failed, using in-memory buckets; Error: {e}"
+            logger.error(error_message)
+            logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+            honeybadger.notify(error_class=error_class, error_message=error_message)
+
+    return _in_memory_backend.take_tokens_now(bucket_key, capacity, refill_per_second, tokens)
+
+
+# %% Take a request's tokens, and check whether the client / key is throttled (before doing any work)
+# Returns None if the request can go ahead, otherwise the seconds until the same request would (for Retry-After)
+# The tokens are taken either way (a turned away request counts as a miss); async_record_throttle_success() gives them back on a hit
+async def async_check_throttle(policy_name, client_id, key, logger):
+
+    if not throttle_settings["enabled"]:
+        return None
+
+    with _throttle_lock:
+        _throttle_metrics["checks"] += 1
+
+    retry_after_seconds = None
+
+    for bucket_key, capacity, refill_per_second, tokens in _bucket_keys(policy_name, client_id, key):
+
+        bucket_tokens = await _take_tokens(bucket_key, capacity, refill_per_second, tokens, logger=logger)
+
+        if bucket_tokens < 0:
+            retry_after_seconds = max(retry_after_seconds or 0, (tokens - bucket_tokens) / refill_per_second)
+
+    if retry_after_seconds is not None:
+
+        with _throttle_lock:
+            _throttle_metrics["throttled"] += 1
+
+        logger.warning(f"Throttled {policy_name} request from client_id: {client_id}, key: {key}; retry after {retry_after_seconds:.0f} seconds")
+
+    return retry_after_seconds
+
+
+# %% Record a miss: back off (the request's tokens were taken by async_check_throttle() and stay taken)
+def _record_failure(policy_name, client_id):
+
+    policy = THROTTLE_POLICIES[policy_name]
+
+    with _throttle_lock:
+
+        now = time.monotonic()
+        failures, last_failure_at = _consecutive_failures.get((policy_name, client_id), (0, now))
+        if now - last_failure_at > CONSECUTIVE_FAILURE_RESET_SECONDS:
+            failures = 0
+
+        failures += 1
+        _consecutive_failures[(policy_name, client_id)] = (failures, now)
+
+        # Keep the dict small (clients whose back-off has reset don't need an entry)
+        if len(_consecutive_failures) > 100000:
+            for failure_key, (_, failure_at) in list(_consecutive_failures.items()):
+                if now - failure_at > CONSECUTIVE_FAILURE_RESET_SECONDS:
+                    del _consecutive_failures[failure_key]
+
+        delay_seconds = min(policy["max_delay_seconds"], policy["base_delay_seconds"] * 2 ** (failures - 1))
+
+        _throttle_metrics["failures"] += 1
+        _throttle_metrics["delay_seconds"] += delay_seconds
+
+    return delay_seconds
+
+async def async_throttle_failure(policy_name, client_id, key, logger):
+
+    if not throttle_settings["enabled"]:
+        return 0
+
+    delay_seconds = _record_failure(policy_name, client_id)
+    logger.info(f"{policy_name} miss from client_id: {client_id}, key: {key}; delaying response {delay_seconds} seconds")
+
+    await asyncio.sleep(delay_seconds) # only this request waits (other requests on the worker keep being served)
+
+    return delay_seconds
+
+# Sync counterpart for code that runs outside the event loop (blocks the calling thread); doesn't touch the buckets, as no endpoint takes tokens on the sync path
+def throttle_failure(policy_name, client_id, key, logger):
+
+    if not throttle_settings["enabled"]:
+        return 0
+
+    delay_seconds = _record_failure(policy_name, client_id)
+    logger.info(f"{policy_name} miss from client_id: {client_id}, key: {key}; delaying response {delay_seconds} seconds")
+
+    time.sleep(delay_seconds)
+
+    return delay_seconds
+
+# %% Record a hit: give back the tokens async_check_throttle() took (with the same key) and reset the client's back-off
+async def async_record_throttle_success(policy_name, client_id, key, logger):
+
+    if not throttle_settings["enabled"]:
+        return
+
+    for bucket_key, capacity, refill_per_second, tokens in _bucket_keys(policy_name, client_id, key):
+        await _take_tokens(bucket_key, capacity, refill_per_second, -tokens, logger=logger)
+
+    record_throttle_success(policy_name, client_id)
+
+# Sync counterpart (resets the back-off only, see throttle_failure())
+def record_throttle_success(policy_name, client_id):
+
+    with _throttle_lock:
+        _consecutive_failures.pop((policy_name, client_id), None)
+
+
+# %% Report on throttling
+def get_throttle_metrics():
+
+    with _throttle_lock:
+        return dict(_throttle_metrics)
@@ -0,0 +1,116 @@
+# Custom imports
+from cache_invalidation_functions import register_cache_invalidation_handler
+from lru_cache_functions import InvalidatableLRUCache
+
+# %% User Lookup Cache Overview
+
+# Every request resolves its public_user_id through user_lookups, and that mapping almost never changes, so we keep each public_user_id's
+# {"user_lookup_id", "user_id", "status"} (what retrieve_user_id_from_public_user_id() returns) in memory (per worker process)
+# Unknown public_user_ids are cached too (negative entries, user_id = None) for a much shorter time, so probing for public_user_ids doesn't hit the database on every guess
+# and a public_user_id created just after a miss is found again soon
+# Anything that deactivates (or creates) a user_lookup should publish_cache_invalidation(invalidation_keys = {"user_lookup": public_user_id}) in its transaction,
+# which evicts the entry in every worker (its own key, so the "public_user_id" invalidations every observation publishes leave lookups alone);
+# ttl_seconds bounds how long a change made directly in the database can go unnoticed
+
+# ## Sample Use
+
+# # Configure once at startup (main.py does this)
+# configure_user_lookup_cache(max_entries = 100000, ttl_seconds = 3600, negative_ttl_seconds = 30)
+
+# # Look up / store a lookup (retrieve_user_id_from_public_user_id() does this); capture the generation before querying so an invalidation during the query isn't overwritten
+# cache_generation = get_user_lookup_cache_generation(public_user_id)
+# dict_user_id = get_cached_user_lookup(public_user_id) # None on a miss; {"user_lookup_id": None, "user_id": None, "status": None} on a negative hit
+# cached_user_lookup_is_inactive(public_user_id) # True if we recently found no active user_lookup (the experimenter log skips its query)
+# cache_user_lookup(public_user_id, dict_user_id, cache_generation)
+
+# # After a user_lookup changes
+# invalidate_user_lookup_cache(public_user_id)
+
+# # Hit / miss / negative hit counters
+# get_user_lookup_cache_metrics()
+
+user_lookup_cache_settings = {
+    "enabled": True,
+    "max_entries": 100000,
+    "ttl_seconds": 3600,
+    "negative_ttl_seconds": 30}
+
+# A lookup that took longer than this (from get_user_lookup_cache_generation() to cache_user_lookup()) isn't cached,
+# so we only have to remember invalidations for this long to tell whether one happened during the lookup
+USER_LOOKUP_CACHE_MAX_LOOKUP_SECONDS = 60
+
+# public_user_id -> dict_user_id; LRU eviction, expiry, and invalidation tracking are in lru_cache_functions.py
+# Hits on unknown public_user_ids are counted separately (negative_hits)
+_user_lookup_cache = InvalidatableLRUCache(
+    max_entries=user_lookup_cache_settings["max_entries"],
+    max_build_seconds=USER_LOOKUP_CACHE_MAX_LOOKUP_SECONDS,
+    metric_names=["negative_hits"],
+    hit_metric_name=lambda dict_user_id: "hits" if dict_user_id["user_id"] is not None else "negative_hits")
+
+
+# %% Configure the cache
+def configure_user_lookup_cache(enabled=True, max_entries=100000, ttl_seconds=3600, negative_ttl_seconds=30):
+
+    user_lookup_cache_settings["enabled"] = enabled
+    user_lookup_cache_settings["max_entries"] = max_entries
+    user_lookup_cache_settings["ttl_seconds"] = ttl_seconds
+    user_lookup_cache_settings["negative_ttl_seconds"] = negative_ttl_seconds
+
+    _user_lookup_cache.configure(enabled=enabled, max_entries=max_entries)
+
+
+# %% Look up a cached lookup (None on a miss)
+# The cached dictionary is shared between requests, so callers must not modify it
+def get_cached_user_lookup(public_user_id):
+
+    return _user_lookup_cache.get(public_user_id)
+
+# For callers that resolve the public_user_id in their own query (e.g., the experimenter log's identified_user CTE), so a cached lookup can't save them a query but a cached miss can:
+# True if the cache says the public_user_id has no active user_lookup (counted as a negative hit); a miss isn't counted, as these callers don't store the lookup
+def cached_user_lookup_is_inactive(public_user_id):
+
+    dict_user_id = _user_lookup_cache.peek(public_user_id)
+
+    if dict_user_id is None or dict_user_id["status"] == "active":
+        return False
+
+    _user_lookup_cache.count("negative_hits")
+
+    return True
+
+
+# %% Store a lookup (dict_user_id with user_id = None for an unknown public_user_id)
+# cache_generation: get_user_lookup_cache_generation() from before the query; if the public_user_id was invalidated since, the lookup may be stale so we don't store it
+def get_user_lookup_cache_generation(public_user_id):
+
+    return _user_lookup_cache.get_generation()
+
+def cache_user_lookup(public_user_id, dict_user_id, cache_generation):
+
+    ttl_seconds = user_lookup_cache_settings["ttl_seconds"] if dict_user_id["user_id"] is not None else user_lookup_cache_settings["negative_ttl_seconds"]
+
+    _user_lookup_cache.put(public_user_id, dict_user_id, ttl_seconds=ttl_seconds, cache_generation=cache_generation)
+
+
+# %% Invalidate a public_user_id's cached lookup (e.g., after its user_lookup is deactivated)
+def invalidate_user_lookup_cache(public_user_id):
+
+    _user_lookup_cache.invalidate(public_user_id)
+
+# Clear every cached lookup (e.g., when the invalidation listener reconnects and may have missed invalidations)
+def clear_user_lookup_cache():
+
+    _user_lookup_cache.clear()
+
+# Evict a public_user_id's entry when another worker changes its user_lookup
+register_cache_invalidation_handler(key_name="user_lookup", invalidation_handler=invalidate_user_lookup_cache, clear_handler=clear_user_lookup_cache)
+
+
+# %% Report on the cache
+def get_user_lookup_cache_metrics():
+
+    metrics = _user_lookup_cache.get_metrics()
+    lookups = metrics["hits"] + metrics["negative_hits"] + metrics["misses"]
+    metrics["hit_rate"] = (metrics["hits"] + metrics["negative_hits"]) / lookups if lookups > 0 else 0.0
+
+    return metrics
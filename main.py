@@ -4,8 +4,9 @@
 import os, sys
 import uvicorn
 import json
-from time import sleep
-from fastapi import FastAPI, APIRouter, BackgroundTasks
+import math
+from fastapi import FastAPI, APIRouter, BackgroundTasks, Request, Response, Header
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import dotenv_values # pip install python-dotenv
 from datetime import datetime
@@ -19,13 +20,22 @@ import traceback
 
 # %%% Import custom modules
 sys.path.append("./functions")
-from data_retrieval_functions import get_experimenter_log_data
+from data_retrieval_functions import async_get_experimenter_log_response, async_get_experimenter_log_page, async_get_experimenter_log_changes, async_get_experimenter_log_batch, get_experimenter_log_etag_metrics, EXPERIMENTER_LOG_DEFAULT_PAGE_SIZE, EXPERIMENTER_LOG_MAX_BATCH_SIZE
 from logging_functions import get_logger
-from json_response_processing_functions import create_json_response
-from analytics_functions import log_api_call
-from postgresql_db_functions import create_db_connection
+from json_response_processing_functions import create_json_bytes_response, create_not_modified_response, configure_response_compression, get_json_response_metrics
+from analytics_functions import async_log_api_call
+from postgresql_db_functions import create_db_connection_pool, get_prepared_statement_stats
+from async_postgresql_db_functions import create_async_db_connection_pool
 from standard_processes_functions import schedule_messages
-from data_submission_functions import submit_observation
+from query_instrumentation_functions import configure_query_instrumentation, get_query_timing_stats
+from read_replica_functions import get_replica_db_pools, get_replica_routing_metrics
+from experimenter_log_cache_functions import configure_experimenter_log_cache, get_experimenter_log_cache_metrics
+from user_lookup_cache_functions import configure_user_lookup_cache, get_user_lookup_cache_metrics
+from cache_invalidation_functions import start_cache_invalidation_listener, stop_cache_invalidation_listener, get_cache_invalidation_metrics
+from catalog_functions import start_catalog_refresher, stop_catalog_refresher, get_catalog_metrics
+from throttle_functions import configure_throttle, PostgresThrottleBackend, get_client_id, async_check_throttle, async_throttle_failure, async_record_throttle_success, get_throttle_metrics
+from idempotency_functions import configure_idempotency, PostgresIdempotencyBackend, async_begin_idempotent_request, async_finish_idempotent_request, get_idempotency_metrics
+from data_submission_functions import async_submit_observation, async_submit_observations
 
 # %%% Set up logging
 if 'logger' not in locals():
@@ -54,6 +64,49 @@ db_connection_parameters: dict = json.loads(env_vars.get("PROD_DB_CONNECTION_PAR
 sendgrid_api_key = env_vars.get('SENDGRID_API_KEY')
 short_io_api_key = env_vars.get('SHORT_IO_API_KEY')
 
+# Database connection pool settings (optional; defaults keep us well under the provider's connection cap)
+db_pool_min_connections = int(env_vars.get('DB_POOL_MIN_CONNECTIONS', 1))
+db_pool_max_connections = int(env_vars.get('DB_POOL_MAX_CONNECTIONS', 10))
+db_pool_checkout_timeout_seconds = float(env_vars.get('DB_POOL_CHECKOUT_TIMEOUT_SECONDS', 30))
+db_pool_health_check_after_idle_seconds = float(env_vars.get('DB_POOL_HEALTH_CHECK_AFTER_IDLE_SECONDS', 30))
+db_pool_max_idle_seconds = float(env_vars.get('DB_POOL_MAX_IDLE_SECONDS', 300))
+
+# Query instrumentation settings (optional; see query_instrumentation_functions.py)
+slow_query_threshold_seconds = float(env_vars.get('SLOW_QUERY_THRESHOLD_SECONDS', 0.5))
+capture_slow_query_explain_plans = env_vars.get('CAPTURE_SLOW_QUERY_EXPLAIN_PLANS', 'false').lower() == 'true'
+slow_query_log_file_path = env_vars.get('SLOW_QUERY_LOG_FILE_PATH') # None logs slow queries to the api logger
+
+# Experimenter log query mode: "catalog" (only query the user's rows, stitch in content from the in-memory catalog), "rows" (nest the flat rows in Python), or "json" (Postgres returns the nested document); see data_retrieval_functions.py
+experimenter_log_query_mode = env_vars.get('EXPERIMENTER_LOG_QUERY_MODE', 'catalog')
+
+# How often the catalog of static content checks for changes (see catalog_functions.py)
+catalog_refresh_interval_seconds = float(env_vars.get('CATALOG_REFRESH_INTERVAL_SECONDS', 60))
+
+# Brute force throttle (see throttle_functions.py); THROTTLE_BACKEND: "memory" (per worker) or "postgres" (shared; needs the create_throttle_buckets migration)
+throttle_enabled = env_vars.get('THROTTLE_ENABLED', 'true').lower() == 'true'
+throttle_backend = env_vars.get('THROTTLE_BACKEND', 'memory')
+throttle_trusted_proxy_count = int(env_vars.get('THROTTLE_TRUSTED_PROXY_COUNT', 0)) # proxies (e.g., the load balancer) that append the client's address to X-Forwarded-For
+
+# Idempotency-Key handling for observation submissions (see idempotency_functions.py); IDEMPOTENCY_BACKEND: "memory" (per worker) or "postgres" (shared; needs the create_idempotency_keys migration)
+idempotency_enabled = env_vars.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+idempotency_backend = env_vars.get('IDEMPOTENCY_BACKEND', 'memory')
+idempotency_ttl_seconds = float(env_vars.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+
+# Response compression (negotiated gzip / brotli for bodies of at least RESPONSE_COMPRESSION_MIN_BYTES; see json_response_processing_functions.py)
+response_compression_enabled = env_vars.get('RESPONSE_COMPRESSION_ENABLED', 'true').lower() == 'true'
+response_compression_min_bytes = int(env_vars.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+
+# Experimenter log response cache (optional; see experimenter_log_cache_functions.py)
+experimenter_log_cache_enabled = env_vars.get('EXPERIMENTER_LOG_CACHE_ENABLED', 'true').lower() == 'true'
+experimenter_log_cache_max_entries = int(env_vars.get('EXPERIMENTER_LOG_CACHE_MAX_ENTRIES', 10000))
+experimenter_log_cache_max_ttl_seconds = float(env_vars.get('EXPERIMENTER_LOG_CACHE_MAX_TTL_SECONDS', 300))
+
+# public_user_id -> user_id lookup cache, including short-lived entries for unknown public_user_ids (optional; see user_lookup_cache_functions.py)
+user_lookup_cache_enabled = env_vars.get('USER_LOOKUP_CACHE_ENABLED', 'true').lower() == 'true'
+user_lookup_cache_max_entries = int(env_vars.get('USER_LOOKUP_CACHE_MAX_ENTRIES', 100000))
+user_lookup_cache_ttl_seconds = float(env_vars.get('USER_LOOKUP_CACHE_TTL_SECONDS', 3600))
+user_lookup_cache_negative_ttl_seconds = float(env_vars.get('USER_LOOKUP_CACHE_NEGATIVE_TTL_SECONDS', 30))
+
 
 # %%% Create service accounts
 logger.info("Configure Honeybadger monitoring")
@@ -61,6 +114,57 @@ honeybadger.configure(
     api_key=honeybadger_api_key,
     environment=environment)
 
+# %%% Configure query instrumentation (timing of every SQL statement + slow query log)
+configure_query_instrumentation(
+    slow_query_threshold_seconds=slow_query_threshold_seconds,
+    capture_explain_plans=capture_slow_query_explain_plans,
+    slow_query_log_file_path=slow_query_log_file_path)
+
+# %%% Configure the experimenter log response cache
+configure_experimenter_log_cache(
+    enabled=experimenter_log_cache_enabled,
+    max_entries=experimenter_log_cache_max_entries,
+    max_ttl_seconds=experimenter_log_cache_max_ttl_seconds)
+
+# %%% Configure the user lookup cache
+configure_user_lookup_cache(
+    enabled=user_lookup_cache_enabled,
+    max_entries=user_lookup_cache_max_entries,
+    ttl_seconds=user_lookup_cache_ttl_seconds,
+    negative_ttl_seconds=user_lookup_cache_negative_ttl_seconds)
+
+# %%% Configure response compression
+configure_response_compression(
+    enabled=response_compression_enabled,
+    min_bytes=response_compression_min_bytes)
+
+# %%% Configure the brute force throttle (in memory until the async pool exists; see startup_open_async_db_connection_pool())
+configure_throttle(enabled=throttle_enabled, trusted_proxy_count=throttle_trusted_proxy_count)
+
+# %%% Configure Idempotency-Key handling (in memory until the async pool exists; see startup_open_async_db_connection_pool())
+configure_idempotency(enabled=idempotency_enabled, ttl_seconds=idempotency_ttl_seconds)
+
+# %%% Create database connection pools
+# Created once at startup and shared by every function in functions/ (rather than each function opening / closing its own connection)
+# db_pool (psycopg2) serves the sync functions that run outside the event loop (e.g., schedule_messages() as a background task)
+# async_db_pool (psycopg 3) serves our async endpoints; it has to be opened inside the event loop so it's created in startup_open_async_db_connection_pool()
+logger.info("Creating database connection pool")
+db_pool = create_db_connection_pool(
+    db_connection_parameters=db_connection_parameters,
+    logger=logger,
+    min_connections=db_pool_min_connections,
+    max_connections=db_pool_max_connections,
+    checkout_timeout_seconds=db_pool_checkout_timeout_seconds,
+    health_check_after_idle_seconds=db_pool_health_check_after_idle_seconds,
+    max_idle_seconds=db_pool_max_idle_seconds)
+
+# %%% Load the catalog of static content (groups, sub_groups, prompts) and keep it fresh in the background
+logger.info("Loading catalog")
+start_catalog_refresher(
+    db_pool=db_pool,
+    logger=logger,
+    refresh_interval_seconds=catalog_refresh_interval_seconds)
+
 
 
 # %% Set up FastAPI
@@ -96,8 +200,91 @@ app.add_middleware(
 app.router.route_class = HoneybadgerRoute
 router = APIRouter(route_class=HoneybadgerRoute)
 
+# Open the async database connection pool once the event loop is running
+async_db_pool = None
+cache_invalidation_listener_task = None
+
+@app.on_event("startup")
+async def startup_open_async_db_connection_pool():
+
+    global async_db_pool, cache_invalidation_listener_task
+
+    logger.info("Creating async database connection pool")
+    async_db_pool = await create_async_db_connection_pool(
+        db_connection_parameters=db_connection_parameters,
+        logger=logger,
+        min_connections=db_pool_min_connections,
+        max_connections=db_pool_max_connections,
+        checkout_timeout_seconds=db_pool_checkout_timeout_seconds,
+        max_idle_seconds=db_pool_max_idle_seconds)
+
+    # Share the throttle's token buckets across workers if configured
+    if throttle_backend == "postgres":
+        configure_throttle(enabled=throttle_enabled, backend=PostgresThrottleBackend(async_db_pool=async_db_pool), trusted_proxy_count=throttle_trusted_proxy_count)
+
+    # Share Idempotency-Keys across workers if configured
+    if idempotency_backend == "postgres":
+        configure_idempotency(enabled=idempotency_enabled, ttl_seconds=idempotency_ttl_seconds, backend=PostgresIdempotencyBackend(async_db_pool=async_db_pool))
+
+    # Evict cached data when another worker handles a write (see cache_invalidation_functions.py)
+    cache_invalidation_listener_task = start_cache_invalidation_listener(db_connection_parameters=db_connection_parameters, logger=logger)
+
+# Close database connections when the server shuts down
+@app.on_event("shutdown")
+async def shutdown_close_db_connection_pools():
+
+    logger.info(f"Prepared statement stats (prepares vs. executions): {get_prepared_statement_stats()}")
+    logger.info(f"Query timing stats: {get_query_timing_stats()}")
+
+    logger.info(f"Read replica routing metrics: {get_replica_routing_metrics()}")
+    logger.info(f"Experimenter log cache metrics: {get_experimenter_log_cache_metrics()}")
+    logger.info(f"User lookup cache metrics: {get_user_lookup_cache_metrics()}")
+    logger.info(f"Cache invalidation metrics: {get_cache_invalidation_metrics()}")
+    logger.info(f"Catalog metrics: {get_catalog_metrics()}")
+    logger.info(f"Throttle metrics: {get_throttle_metrics()}")
+    logger.info(f"Idempotency metrics: {get_idempotency_metrics()}")
+    logger.info(f"JSON response metrics: {get_json_response_metrics()}")
+    logger.info(f"Experimenter log ETag metrics: {get_experimenter_log_etag_metrics()}")
+
+    stop_catalog_refresher()
+
+    if cache_invalidation_listener_task is not None:
+        await stop_cache_invalidation_listener(cache_invalidation_listener_task)
+
+    logger.info(f"Closing database connection pool; metrics: {db_pool.get_metrics()}")
+    for replica_db_pool in get_replica_db_pools(db_pool):
+        replica_db_pool.closeall()
+    db_pool.closeall()
+
+    if async_db_pool is not None:
+        logger.info(f"Closing async database connection pool; stats: {async_db_pool.get_stats()}")
+        for replica_async_db_pool in get_replica_db_pools(async_db_pool):
+            await replica_async_db_pool.close()
+        await async_db_pool.close()
+
 # %% Define routes
 
+# Response for a client that's used up its misses (see throttle_functions.py)
+def create_throttled_response(retry_after_seconds):
+
+    return JSONResponse(
+        status_code=429,
+        content={"error": "True", "message": "Too many requests. Please try again later."},
+        headers={"Retry-After": str(math.ceil(retry_after_seconds))})
+
+# Response for a request whose Idempotency-Key can't be used (see idempotency_functions.py): still running elsewhere (409; retry shortly), or sent with a different request / malformed (422)
+def create_idempotency_rejected_response(idempotent_request):
+
+    if idempotent_request["status"] == "in_progress":
+        return JSONResponse(
+            status_code=409,
+            content={"status": "failure", "end_user_error_message": "We're still adding your observation. Please try again in a moment."},
+            headers={"Retry-After": "1"})
+
+    return JSONResponse(
+        status_code=422,
+        content={"status": "failure", "end_user_error_message": "Unfortunately, we had an issue adding your observation to our database. Please try again later. If the issue persists, please contact us at support@tryexperimenter.com."})
+
 @app.get("/")
 def endpoint_home():
 
@@ -122,21 +309,29 @@ async def endpoint_user(id: int) -> dict:
     return { "message": "The user id is: " + str(id)}
 
 @app.get("/v1/schedule-messages/")
-async def endpoint_schedule_messages(auth_code: str, background_tasks: BackgroundTasks):
+async def endpoint_schedule_messages(auth_code: str, background_tasks: BackgroundTasks, request: Request):
+
+    # Turn away clients that have already guessed wrong too many times
+    client_id = get_client_id(request)
+    retry_after_seconds = await async_check_throttle(policy_name="schedule_messages", client_id=client_id, key=None, logger=logger)
+    if retry_after_seconds is not None:
+        return create_throttled_response(retry_after_seconds)
 
     # Check that the auth_code is correct to ensure someone can't maliciously call the endpoint (e.g., /v1/schedule_messages/?auth_code=rFLrsTdXGcA8VyoyaBMY-L*mMe@enU was called)
     if auth_code == "rFLrsTdXGcA8VyoyaBMY-L*mMe@enU": 
 
         try:
 
+            await async_record_throttle_success(policy_name="schedule_messages", client_id=client_id, key=None, logger=logger)
+
             # Log API call
             endpoint = f"/v1/schedule-messages/?auth_code={auth_code}"
             logger.info(f"Endpoint called: {endpoint}")
-            log_api_call(environment=environment, endpoint=endpoint, db_connection_parameters=db_connection_parameters, logger=logger)
+            await async_log_api_call(environment=environment, endpoint=endpoint, async_db_pool=async_db_pool, logger=logger)
 
             # Schedule messages (call as a background task so that the API call doesn't take too long. more info: https://fastapi.tiangolo.com/tutorial/background-tasks/)
             logger.info("Calling schedule_messages()")
-            background_tasks.add_task(schedule_messages, db_connection_parameters=db_connection_parameters, sendgrid_api_key=sendgrid_api_key, short_io_api_key=short_io_api_key, logger=logger)
+            background_tasks.add_task(schedule_messages, db_pool=db_pool, sendgrid_api_key=sendgrid_api_key, short_io_api_key=short_io_api_key, logger=logger)
 
             return {"message": "schedule_messages() called successfully as a background task"}
         
@@ -152,28 +347,40 @@ async def endpoint_schedule_messages(auth_code: str, background_tasks: Backgroun
         
     else:
 
-        sleep(10) # sleep prevent brute force attacks
+        await async_throttle_failure(policy_name="schedule_messages", client_id=client_id, key=None, logger=logger) # delay (backing off with repeated misses) to prevent brute force attacks, without blocking other requests
         return {"error": "True", "message": f"authorization code incorrect: {auth_code}"}
 
 # %% Get Experimenter Log Data
 
 @app.get("/v1/experimenter-log/")
-async def endpoint_experimenter_log(public_user_id: str):
+async def endpoint_experimenter_log(public_user_id: str, request: Request):
+
+    # Turn away clients that have already requested too many unknown public_user_ids
+    client_id = get_client_id(request)
+    retry_after_seconds = await async_check_throttle(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+    if retry_after_seconds is not None:
+        return create_throttled_response(retry_after_seconds)
 
     try:
 
         # Log API call
         endpoint = f"/v1/experimenter-log/?public_user_id={public_user_id}"
         logger.info(f"Endpoint called: {endpoint}")
-        log_api_call(environment=environment, endpoint=endpoint, db_connection_parameters=db_connection_parameters, logger=logger)
+        await async_log_api_call(environment=environment, endpoint=endpoint, async_db_pool=async_db_pool, logger=logger)
 
-        # Get experimenter log data
-        logger.info("Calling get_experimenter_log_data()")
-        dict_response = get_experimenter_log_data(public_user_id=public_user_id, db_connection_parameters=db_connection_parameters, logger=logger)
+        # Get experimenter log data (unless the client's copy, identified by its If-None-Match ETag, is still current)
+        logger.info("Calling async_get_experimenter_log_response()")
+        dict_response, etag = await async_get_experimenter_log_response(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger, query_mode=experimenter_log_query_mode, client_id=client_id, if_none_match=request.headers.get("if-none-match"))
 
-        # Format response as JSON
-        logger.info("Calling create_json_response()")
-        json_response = create_json_response(dict_response=dict_response, logger=logger)
+        if dict_response is None:
+            logger.info("Returning 304 Not Modified")
+            return create_not_modified_response(etag=etag)
+
+        # Serialize the response once (compressed if the client accepts it and it's large enough)
+        # Cache-Control: no-cache has the browser keep the response but revalidate it (If-None-Match) on every view
+        logger.info("Calling create_json_bytes_response()")
+        headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag is not None else None
+        json_response = create_json_bytes_response(dict_response=dict_response, accept_encoding=request.headers.get("accept-encoding"), logger=logger, headers=headers)
 
         logger.info("Returning json_response")
         return json_response
@@ -189,6 +396,135 @@ async def endpoint_experimenter_log(public_user_id: str):
 
         return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
 
+# One page of the experimenter log (newest first); pass the response's next_cursor as cursor to get the next page (next_cursor is None on the last page)
+# group_id (optional) restricts the log to one group
+@app.get("/v2/experimenter-log/")
+async def endpoint_experimenter_log_page(public_user_id: str, request: Request, page_size: int = EXPERIMENTER_LOG_DEFAULT_PAGE_SIZE, cursor: str = None, group_id: str = None):
+
+    # Turn away clients that have already requested too many unknown public_user_ids
+    client_id = get_client_id(request)
+    retry_after_seconds = await async_check_throttle(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+    if retry_after_seconds is not None:
+        return create_throttled_response(retry_after_seconds)
+
+    try:
+
+        # Log API call
+        endpoint = f"/v2/experimenter-log/?public_user_id={public_user_id}&page_size={page_size}&cursor={cursor}&group_id={group_id}"
+        logger.info(f"Endpoint called: {endpoint}")
+        await async_log_api_call(environment=environment, endpoint=endpoint, async_db_pool=async_db_pool, logger=logger)
+
+        # Get the page of experimenter log data
+        logger.info("Calling async_get_experimenter_log_page()")
+        dict_response = await async_get_experimenter_log_page(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger, page_size=page_size, cursor=cursor, group_id=group_id, client_id=client_id)
+
+        # Serialize the response once (compressed if the client accepts it and it's large enough)
+        logger.info("Calling create_json_bytes_response()")
+        json_response = create_json_bytes_response(dict_response=dict_response, accept_encoding=request.headers.get("accept-encoding"), logger=logger)
+
+        logger.info("Returning json_response")
+        return json_response
+    
+    except Exception as e:
+        
+        error_class = f"API | /v2/experimenter-log/?public_user_id={public_user_id}"
+        error_message = f"Error with /v2/experimenter-log/?public_user_id={public_user_id}&page_size={page_size}&cursor={cursor}&group_id={group_id}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+# Changes to the experimenter log since the client's copy (insert / update / remove operations); pass the response's next_cursor as cursor next time
+# Without a cursor, every displayed sub_group is an insert (a first sync)
+@app.get("/v2/experimenter-log/changes/")
+async def endpoint_experimenter_log_changes(public_user_id: str, request: Request, cursor: str = None):
+
+    # Turn away clients that have already requested too many unknown public_user_ids
+    client_id = get_client_id(request)
+    retry_after_seconds = await async_check_throttle(policy_name="experimenter_log", client_id=client_id, key=public_user_id, logger=logger)
+    if retry_after_seconds is not None:
+        return create_throttled_response(retry_after_seconds)
+
+    try:
+
+        # Log API call
+        endpoint = f"/v2/experimenter-log/changes/?public_user_id={public_user_id}&cursor={cursor}"
+        logger.info(f"Endpoint called: {endpoint}")
+        await async_log_api_call(environment=environment, endpoint=endpoint, async_db_pool=async_db_pool, logger=logger)
+
+        # Get the changes since the cursor
+        logger.info("Calling async_get_experimenter_log_changes()")
+        dict_response = await async_get_experimenter_log_changes(public_user_id=public_user_id, async_db_pool=async_db_pool, logger=logger, cursor=cursor, client_id=client_id)
+
+        # Serialize the response once (compressed if the client accepts it and it's large enough)
+        logger.info("Calling create_json_bytes_response()")
+        json_response = create_json_bytes_response(dict_response=dict_response, accept_encoding=request.headers.get("accept-encoding"), logger=logger)
+
+        logger.info("Returning json_response")
+        return json_response
+    
+    except Exception as e:
+        
+        error_class = f"API | /v2/experimenter-log/changes/?public_user_id={public_user_id}"
+        error_message = f"Error with /v2/experimenter-log/changes/?public_user_id={public_user_id}&cursor={cursor}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": f"Error collecting Experimenter Log data for public_user_id: {public_user_id}"}
+
+# Experimenter logs for several users in one call (e.g., dashboards / coach views): {"public_user_ids": [...]}
+# Returns {"status": "success", "experimenter_logs": {public_user_id: what /v1/experimenter-log/ returns for that user}}
+class ExperimenterLogBatch(BaseModel):
+    public_user_ids: list[str]
+
+@app.post("/v1/experimenter-logs/")
+async def endpoint_experimenter_log_batch(item: ExperimenterLogBatch, request: Request):
+
+    # Turn away clients that don't have a token left for every public_user_id in the batch (each one is a guess, as if it were its own /v1/experimenter-log/ request;
+    # async_get_experimenter_log_batch() gives back the tokens of the ones it finds)
+    if len(set(item.public_user_ids)) > EXPERIMENTER_LOG_MAX_BATCH_SIZE:
+        return {"status": "failure", "end_user_error_message": f"Batches can have at most {EXPERIMENTER_LOG_MAX_BATCH_SIZE} public_user_ids"}
+
+    client_id = get_client_id(request)
+    retry_after_seconds = await async_check_throttle(policy_name="experimenter_log", client_id=client_id, key=item.public_user_ids, logger=logger)
+    if retry_after_seconds is not None:
+        return create_throttled_response(retry_after_seconds)
+
+    try:
+
+        # Log API call
+        endpoint = f"/v1/experimenter-logs/"
+        logger.info(f"Endpoint called: {endpoint}")
+        logger.info(f"Request type: POST")
+        logger.info(f"Payload: {item}")
+        await async_log_api_call(environment=environment, endpoint=endpoint, async_db_pool=async_db_pool, logger=logger)
+
+        # Get experimenter log data for every user (one query for those that aren't cached)
+        logger.info("Calling async_get_experimenter_log_batch()")
+        dict_experimenter_logs = await async_get_experimenter_log_batch(public_user_ids=item.public_user_ids, async_db_pool=async_db_pool, logger=logger, client_id=client_id)
+
+        # Serialize the response once (compressed if the client accepts it and it's large enough)
+        logger.info("Calling create_json_bytes_response()")
+        json_response = create_json_bytes_response(dict_response={"status": "success", "experimenter_logs": dict_experimenter_logs}, accept_encoding=request.headers.get("accept-encoding"), logger=logger)
+
+        logger.info("Returning json_response")
+        return json_response
+    
+    except Exception as e:
+        
+        error_class = f"API | /v1/experimenter-logs/"
+        error_message = f"POST Request: {item}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": "Error collecting Experimenter Log data"}
+
 
 # %% Submit Observation
 
@@ -198,22 +534,38 @@ class Observation(BaseModel):
     visibility: str
     observation: str
 
+# Clients can send an Idempotency-Key header (reused on retries) so a retried submission returns the original result instead of writing the observation again
 @app.post("/v1/submit-observation/")
-async def endpoint_submit_observation(item: Observation):
+async def endpoint_submit_observation(item: Observation, http_response: Response, idempotency_key: str = Header(default=None)):
 
     try:
 
         logger.info(f"Endpoint called: /v1/submit-observation/")
         logger.info(f"Request type: POST")
         logger.info(f"Payload: {item}")
-        
-        response = submit_observation(
-            public_user_id=item.public_user_id, 
-            observation_prompt_id=item.observation_prompt_id, 
-            visibility=item.visibility, 
-            observation=item.observation, 
-            db_connection_parameters=db_connection_parameters, 
-            logger=logger)
+
+        idempotent_request = await async_begin_idempotent_request(scope="submit_observation", idempotency_key=idempotency_key, request_payload=item.dict(), logger=logger)
+
+        if idempotent_request["status"] in ["in_progress", "mismatch", "invalid"]:
+            return create_idempotency_rejected_response(idempotent_request)
+
+        if idempotent_request["status"] == "replay":
+
+            logger.info(f"Replaying the result for Idempotency-Key: {idempotency_key}")
+            http_response.headers["Idempotent-Replayed"] = "true"
+            response = idempotent_request["response"]
+
+        else:
+
+            response = await async_submit_observation(
+                public_user_id=item.public_user_id, 
+                observation_prompt_id=item.observation_prompt_id, 
+                visibility=item.visibility, 
+                observation=item.observation, 
+                async_db_pool=async_db_pool, 
+                logger=logger)
+
+            await async_finish_idempotent_request(idempotent_request=idempotent_request, response=response, logger=logger)
 
         if response["status"] == "success":
 
@@ -239,6 +591,71 @@ async def endpoint_submit_observation(item: Observation):
         return {"status": "failure", "end_user_error_message": "Unfortunately, we had an issue adding your observation to our database. Please try again later. If the issue persists, please contact us at support@tryexperimenter.com."}
 
 
+# Several observations for one user in one request (e.g., the observations page's prompts for the week), written together; the response has one {"status": ...} per item, in order
+@app.post("/v1/submit-observations/")
+async def endpoint_submit_observations(items: list[Observation], http_response: Response, idempotency_key: str = Header(default=None)):
+
+    try:
+
+        logger.info(f"Endpoint called: /v1/submit-observations/")
+        logger.info(f"Request type: POST")
+        logger.info(f"Payload: {items}")
+
+        public_user_ids = {item.public_user_id for item in items}
+
+        if len(public_user_ids) != 1:
+
+            logger.info(f"submit_observations() needs observations for exactly one public_user_id, not: {public_user_ids}")
+
+            return {"status": "failure", "end_user_error_message": "Unfortunately, we had an issue adding your observations to our database. Please try again later. If the issue persists, please contact us at support@tryexperimenter.com."}
+
+        idempotent_request = await async_begin_idempotent_request(scope="submit_observations", idempotency_key=idempotency_key, request_payload=[item.dict() for item in items], logger=logger)
+
+        if idempotent_request["status"] in ["in_progress", "mismatch", "invalid"]:
+            return create_idempotency_rejected_response(idempotent_request)
+
+        if idempotent_request["status"] == "replay":
+
+            logger.info(f"Replaying the result for Idempotency-Key: {idempotency_key}")
+            http_response.headers["Idempotent-Replayed"] = "true"
+            response = idempotent_request["response"]
+
+        else:
+
+            response = await async_submit_observations(
+                public_user_id=items[0].public_user_id,
+                observations=[{"observation_prompt_id": item.observation_prompt_id, "visibility": item.visibility, "observation": item.observation} for item in items],
+                async_db_pool=async_db_pool,
+                logger=logger)
+
+            # Only replay a submission that wrote something (if every item failed, a retry should run again)
+            submission_succeeded = response["status"] == "success" and any(dict_result["status"] == "success" for dict_result in response["observations"])
+            await async_finish_idempotent_request(idempotent_request=idempotent_request, response=response, logger=logger, succeeded=submission_succeeded)
+
+        if response["status"] == "success":
+
+            logger.info(f"submit_observations() successful")
+
+            return {"status": "success", "observations": [{"status": dict_result["status"]} for dict_result in response["observations"]]}
+
+        else:
+
+            logger.info(f"submit_observations() unsuccessful")
+
+            return {"status": "failure", "end_user_error_message": "Unfortunately, we had an issue adding your observations to our database. Please try again later. If the issue persists, please contact us at support@tryexperimenter.com."}
+
+    except Exception as e:
+
+        error_class = f"API | /v1/submit-observations/"
+        error_message = f"POST Request: {items}; Error: {e}"
+        logger.error(error_class)
+        logger.error(error_message)
+        logger.error(traceback.format_exc()) # provide the full traceback of everything that caused the error
+        honeybadger.notify(error_class=error_class, error_message=error_message)
+
+        return {"status": "failure", "end_user_error_message": "Unfortunately, we had an issue adding your observations to our database. Please try again later. If the issue persists, please contact us at support@tryexperimenter.com."}
+
+
 # %% Run app
 if __name__ == "__main__":
 
@@ -0,0 +1,180 @@
+# %% Experimenter Log Shaping Benchmark Overview
+
+# Times format_experimenter_log_data() (the one-pass nesting of the rows mode query's rows) against the dataframe implementation it replaced,
+# on synthetic rows for users with 13 / 52 / 104 / 208 weeks of experiments, and checks both produce the same JSON
+# No database needed: the rows are built in memory in the order EXPERIMENTER_LOG_SQL_STATEMENT returns them (display_datetime descending)
+
+# ## Sample Use
+
+# # From the repository root
+# python scripts/benchmark_experimenter_log_shaping.py
+
+# # Other sizes / more repetitions
+# python scripts/benchmark_experimenter_log_shaping.py --weeks 26 520 --repeat 10
+
+# %% Set Up
+
+# %%% Import standard modules
+import os, sys
+import argparse
+import json
+import random
+import time
+import logging
+from datetime import datetime, timedelta
+import pytz
+import numpy as np
+import pandas as pd
+import smartypants
+
+# %%% Import custom modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+from data_retrieval_functions import format_experimenter_log_data, ExperimenterLogRow
+
+logger = logging.getLogger("benchmark")
+
+
+# %% Build synthetic rows
+# Each week is one sub_group per group, with 3 experiments x 2 observation prompts; about 60% of the observation prompts have an observation,
+# half of which have a stored observation_formatted (like observations written before / after observation_formatted existed)
+def make_experimenter_log_rows(weeks, groups=2, seed=1):
+
+    random_generator = random.Random(seed)
+    now = pytz.timezone('UTC').localize(datetime.utcnow())
+    rows = []
+
+    for week in range(weeks):
+        for group in range(groups):
+
+            display_datetime = now - timedelta(days=7 * week, hours=group)
+
+            for experiment in [3, 1, 2]: # experiment_prompt_ids aren't in display order, so the sort by experiment_prompt_id is exercised
+                for observation_prompt in range(2):
+
+                    observation = None if random_generator.random() < 0.4 else f"It's \"observation\" {week}-{group}-{experiment}-{observation_prompt}"
+                    observation_formatted = smartypants.smartypants(observation) if observation is not None and random_generator.random() < 0.5 else None
+
+                    rows.append(ExperimenterLogRow(
+                        first_name="Ann's",
+                        next_display_datetime=None,
+                        display_datetime=display_datetime,
+                        group_id=f"g{group}",
+                        group_name=f"Group's {group}",
+                        sub_group_id=f"sg{week}-{group}",
+                        sub_group_name=f"Week \"{week}\"",
+                        experiment_prompt_id=f"e{week}-{group}-{experiment}",
+                        experiment_prompt=f"Try -- {experiment}",
+                        observation_prompt_id=f"op{week}-{group}-{experiment}-{observation_prompt}",
+                        observation_prompt=f"Why's {observation_prompt}?",
+                        observation_id=None if observation is None else f"o{week}-{group}-{experiment}-{observation_prompt}",
+                        observation=observation,
+                        observation_formatted=observation_formatted))
+
+    rows.sort(key=lambda row: row.display_datetime, reverse=True)
+
+    return rows
+
+
+# %% Dataframe implementation (what get_experimenter_log_data() did before the one-pass nesting), kept here as the baseline
+# Re-filters the dataframe for every group / sub_group, so it's quadratic in the number of weeks of experiments
+def format_experimenter_log_data_dataframe(rows, public_user_id):
+
+    df = pd.DataFrame(rows, columns=ExperimenterLogRow._fields)
+
+    dict_response = {}
+    dict_response["public_user_id"] = public_user_id
+    dict_response["first_name"] = df.first_name.get(0)
+    dict_response['experiments_to_display'] = "True"
+    dict_response['status'] = "success"
+
+    if len(df) == 1 and df.group_name.get(0) == None:
+        dict_response['experiments_to_display'] = "False"
+        return dict_response
+
+    # Observations were rendered with curly quotes here (observation_formatted didn't exist yet)
+    df = df.drop(columns=["next_display_datetime", "observation_formatted"])
+    df.replace({np.nan: ""}, inplace = True)
+    text_vars = ["group_name", "sub_group_name", "experiment_prompt", "observation_prompt", "observation"]
+    for text_var in text_vars:
+        df[text_var] = df[text_var].apply(lambda x: smartypants.smartypants(x))
+
+    dict_response["days_of_experimenting"] = (pytz.timezone('UTC').localize(datetime.utcnow()) - df['display_datetime'].min()).days + 1
+
+    array_groups = []
+
+    for group_id in df.group_id.unique():
+
+        df_group = df.query("group_id == '" + group_id  + "'").reset_index()
+
+        array_sub_groups = []
+
+        for sub_group_id in df_group.sub_group_id.unique():
+
+            df_sub_group = df_group.query("sub_group_id == '" + sub_group_id  + "'").reset_index()
+
+            primary_cols = ['experiment_prompt_id', 'experiment_prompt']
+            data_cols = ['observation_prompt_id', 'observation_prompt', 'observation']
+            dict_experiments = (df_sub_group.groupby(primary_cols)[data_cols]
+                .apply(lambda x: x.to_dict('records'))
+                .reset_index(name='observations')
+                .to_dict(orient='records'))
+
+            for index in range(0, len(dict_experiments)):
+                if dict_experiments[index]['observations'] == [{'observation_prompt_id': '', 'observation_prompt': '', 'observation': ''}]:
+                    dict_experiments[index]['observations'] = "None"
+
+            array_sub_groups.append(
+                {"sub_group_id": sub_group_id,
+                "sub_group_name": df_sub_group.sub_group_name.get(0),
+                "sub_group_display_date": df_sub_group.display_datetime.get(0).strftime("%B %#d, %Y"),
+                "experiments": dict_experiments})
+
+        array_groups.append(
+            {"group_id": group_id,
+            "group_name": df_group.group_name.get(0),
+            "sub_groups": array_sub_groups})
+
+    dict_response['groups'] = array_groups
+
+    return dict_response
+
+
+# %% Time a formatting function (best of repeat runs, in milliseconds)
+def time_formatting(format_function, rows, repeat):
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        format_function(rows)
+        timings.append(time.perf_counter() - start_time)
+
+    return min(timings) * 1000
+
+
+# %% Run the benchmark
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark experimenter log response shaping")
+    parser.add_argument("--weeks", type=int, nargs="+", default=[13, 52, 104, 208], help="weeks of experiments per synthetic user")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per size (the fastest is reported)")
+    args = parser.parse_args()
+
+    format_one_pass = lambda rows: format_experimenter_log_data(rows=rows, public_user_id="benchmark", logger=logger)
+    format_dataframe = lambda rows: format_experimenter_log_data_dataframe(rows=rows, public_user_id="benchmark")
+
+    ## Check both implementations produce the same response (including a user with no experiments)
+    user_without_experiments = [ExperimenterLogRow(first_name="Bob", **{field: None for field in ExperimenterLogRow._fields[1:]})]
+    for rows in [make_experimenter_log_rows(weeks=1), make_experimenter_log_rows(weeks=5), user_without_experiments]:
+        if json.dumps(format_one_pass(rows)) != json.dumps(format_dataframe(rows)):
+            print(f"Responses differ for {len(rows)} rows")
+            sys.exit(1)
+
+    ## Time each size
+    print(f"{'weeks':>6} {'rows':>6} {'dataframe (ms)':>15} {'one pass (ms)':>14} {'speedup':>8}")
+    for weeks in args.weeks:
+
+        rows = make_experimenter_log_rows(weeks=weeks)
+        dataframe_ms = time_formatting(format_dataframe, rows, args.repeat)
+        one_pass_ms = time_formatting(format_one_pass, rows, args.repeat)
+
+        print(f"{weeks:>6} {len(rows):>6} {dataframe_ms:>15.1f} {one_pass_ms:>14.2f} {dataframe_ms / one_pass_ms:>7.0f}x")
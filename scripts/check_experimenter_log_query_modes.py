@@ -0,0 +1,63 @@
+# %% Experimenter Log Query Mode Parity Check Overview
+
+# Builds each given user's experimenter log with every query mode (EXPERIMENTER_LOG_QUERY_MODES: "rows", "json", "catalog") against a live database
+# and checks the responses are identical to the rows mode's (see check_experimenter_log_query_modes_match()); run it before switching EXPERIMENTER_LOG_QUERY_MODE
+# The json mode is built by Postgres, so it can only be checked here; code_test.py checks the catalog mode against the rows mode without a database
+# Reads PROD_DB_CONNECTION_PARAMETERS the same way main.py does (.env, overridden by environment variables); only reads from the database
+# Exits with status 1 if any user's responses differ (the differing responses are logged)
+
+# ## Sample Use
+
+# # From the repository root (so .env is found)
+# python scripts/check_experimenter_log_query_modes.py 66cb527749c57fb78d6f 1f0a9d2c44b8e3a7c6d5
+
+# %% Set Up
+
+# %%% Import standard modules
+import os, sys
+import argparse
+import json
+from dotenv import dotenv_values # pip install python-dotenv
+
+# %%% Import custom modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+from logging_functions import get_logger
+from postgresql_db_functions import create_db_connection_pool
+from catalog_functions import load_catalog
+from data_retrieval_functions import check_experimenter_log_query_modes_match
+
+logger = get_logger(logger_name="check_experimenter_log_query_modes")
+
+
+# %% Run the check
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check every experimenter log query mode returns the same response")
+    parser.add_argument("public_user_ids", nargs="+", help="public_user_ids to check")
+    args = parser.parse_args()
+
+    ## Load variables from .env file or OS environment variables
+    env_vars = {
+        **dotenv_values(".env"),
+        **os.environ,  # override loaded values with environment variables
+    }
+    db_connection_parameters: dict = json.loads(env_vars.get("PROD_DB_CONNECTION_PARAMETERS"))
+
+    db_pool = create_db_connection_pool(db_connection_parameters=db_connection_parameters, logger=logger, min_connections=1, max_connections=2)
+
+    # The catalog mode stitches in groups / prompts from the catalog, so load it once up front (main.py does this with start_catalog_refresher())
+    db_conn = db_pool.getconn()
+    try:
+        load_catalog(db_conn=db_conn, logger=logger)
+    finally:
+        db_pool.putconn(db_conn)
+
+    mismatched_public_user_ids = [public_user_id for public_user_id in args.public_user_ids if not check_experimenter_log_query_modes_match(public_user_id=public_user_id, db_pool=db_pool, logger=logger)]
+
+    db_pool.closeall()
+
+    if len(mismatched_public_user_ids) > 0:
+        logger.error(f"Experimenter log query modes differ for public_user_ids: {mismatched_public_user_ids}")
+        sys.exit(1)
+
+    logger.info(f"Experimenter log query modes match for all {len(args.public_user_ids)} public_user_ids")